@@ -0,0 +1,59 @@
+import os
+import sys
+import timeit
+
+# Adding the backend directory so local imports work when running this file directly:
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Providing defaults for the settings that security.py (and its imports) read at import time:
+os.environ.setdefault("DB_URI", "sqlite://")
+os.environ.setdefault("HASH_KEY", "benchmark-secret")
+os.environ.setdefault("HASH_ALGORITHM", "HS256")
+os.environ.setdefault("TOKEN_TTL", "30")
+os.environ.setdefault("REFRESH_TOKEN_TTL", "600")
+
+import security
+from exceptions import JWTException
+
+# decode_token runs at least twice per authenticated request (rate limiter and get_current_user):
+DECODES_PER_REQUEST = 2
+ITERATIONS = 20000
+
+
+def _clear_caches() -> None:
+    security._verified_tokens.clear()
+    security._rejected_tokens.clear()
+
+
+def _decode(token: str, clear: bool) -> None:
+    if clear: _clear_caches()
+    try:
+        for _ in range(DECODES_PER_REQUEST):
+            security.decode_token(token)
+    except JWTException:
+        pass
+
+
+def _report(label: str, seconds: float) -> None:
+    print(f"{label:<36} {seconds / ITERATIONS * 1e6:>10.2f} µs/request")
+
+
+def main() -> None:
+    valid_token = security._create_token(1)
+    expired_token = security._create_token(1, ttl=security.timedelta(minutes=-5))
+
+    cases = [
+        ("valid token, no cache", valid_token, True),
+        ("valid token, cached", valid_token, False),
+        ("expired token, no cache", expired_token, True),
+        ("expired token, cached rejection", expired_token, False),
+    ]
+
+    for label, token, clear in cases:
+        _clear_caches()
+        seconds = timeit.timeit(lambda: _decode(token, clear), number=ITERATIONS)
+        _report(label, seconds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import random
+from collections import OrderedDict
+from typing import AsyncGenerator
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+# A minimal OpenAI-compatible chat completions server, for benchmarking without calling real providers.
+# Point OPENAI_BASE_URL and GEMINI_BASE_URL at it (e.g. http://127.0.0.1:8100/v1/).
+
+# Delay before the first token, and the rate at which the remaining tokens are produced:
+TTFT_MS = float(os.getenv("FAKE_LLM_TTFT_MS", 400))
+TOKENS_PER_SECOND = float(os.getenv("FAKE_LLM_TOKENS_PER_SECOND", 60))
+COMPLETION_TOKENS = int(os.getenv("FAKE_LLM_COMPLETION_TOKENS", 30))
+
+# Random jitter applied to the TTFT, as a fraction of it:
+TTFT_JITTER = float(os.getenv("FAKE_LLM_TTFT_JITTER", 0.2))
+
+# Prompt caching is simulated like OpenAI's: prompts of at least 1024 tokens are cached in 128-token steps,
+# and a request reuses the longest step it shares with an earlier prompt, cutting its TTFT by up to this fraction:
+CACHE_MIN_TOKENS = 1024
+CACHE_STEP_TOKENS = 128
+CACHED_TTFT_SAVING = float(os.getenv("FAKE_LLM_CACHED_TTFT_SAVING", 0.5))
+CACHE_SIZE = 100_000
+
+WORDS = (
+    "likely to ask about budget next suggest sharing timeline early they want clear owner for "
+    "follow up expect pushback on pricing offer phased rollout confirm scope before committing"
+).split()
+
+app = FastAPI()
+_cached_prefixes: OrderedDict = OrderedDict()
+
+
+def _ttft_seconds(cached_share: float = 0.0) -> float:
+    jitter = random.uniform(-TTFT_JITTER, TTFT_JITTER)
+    return max(0.0, TTFT_MS * (1 + jitter) * (1 - CACHED_TTFT_SAVING * cached_share) / 1000)
+
+
+def _tokens() -> list:
+    return [f"{random.choice(WORDS)} " for _ in range(COMPLETION_TOKENS)]
+
+
+def _prompt_text(body: dict) -> str:
+    return "".join(f"{message.get('role')}:{message.get('content', '')}\n" for message in body.get("messages", []))
+
+
+def _prompt_tokens(body: dict) -> int:
+    # Approximating the prompt size as 4 characters per token:
+    return max(1, len(_prompt_text(body)) // 4)
+
+
+def _cached_tokens(body: dict) -> int:
+    # Finding the longest cached step of this prompt, then caching all of its steps for later requests:
+    text = _prompt_text(body)
+    cached, hit = 0, True
+    for end in range(CACHE_MIN_TOKENS * 4, len(text) + 1, CACHE_STEP_TOKENS * 4):
+        key = hash(text[:end])
+        if hit and key in _cached_prefixes:
+            cached = end // 4
+            _cached_prefixes.move_to_end(key)
+        else:
+            hit = False
+            _cached_prefixes[key] = True
+
+    while len(_cached_prefixes) > CACHE_SIZE:
+        _cached_prefixes.popitem(last=False)
+    return cached
+
+
+def _usage(body: dict, cached_tokens: int) -> dict:
+    prompt_tokens = _prompt_tokens(body)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": COMPLETION_TOKENS,
+        "total_tokens": prompt_tokens + COMPLETION_TOKENS,
+        "prompt_tokens_details": {"cached_tokens": cached_tokens},
+    }
+
+
+def _structured_content(response_format: dict) -> str:
+    # Filling every property of the requested JSON schema with a placeholder of the right type:
+    schema = response_format.get("json_schema", {}).get("schema", {})
+    placeholders = {"string": "".join(_tokens()).strip(), "number": 0, "integer": 0, "boolean": False, "array": []}
+    return json.dumps({
+        name: placeholders.get(definition.get("type"), None)
+        for name, definition in schema.get("properties", {}).items()
+    })
+
+
+def _chunk(completion_id: str, model: str, delta: dict, finish_reason=None, usage=None) -> str:
+    chunk = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [] if usage else [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    if usage: chunk["usage"] = usage
+    return f"data: {json.dumps(chunk)}\n\n"
+
+
+async def _stream(body: dict) -> AsyncGenerator[str, None]:
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    model = body.get("model", "fake")
+    cached_tokens = _cached_tokens(body)
+
+    await asyncio.sleep(_ttft_seconds(cached_tokens / _prompt_tokens(body)))
+    yield _chunk(completion_id, model, {"role": "assistant", "content": ""})
+
+    for token in _tokens():
+        yield _chunk(completion_id, model, {"content": token})
+        await asyncio.sleep(1 / TOKENS_PER_SECOND)
+
+    yield _chunk(completion_id, model, {}, finish_reason="stop")
+
+    if body.get("stream_options", {}).get("include_usage"):
+        yield _chunk(completion_id, model, {}, usage=_usage(body, cached_tokens))
+
+    yield "data: [DONE]\n\n"
+
+
+@app.post("/v1/chat/completions")
+@app.post("/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+
+    if body.get("stream"):
+        return StreamingResponse(_stream(body), media_type="text/event-stream")
+
+    # Non-streaming completions wait for the whole generation:
+    cached_tokens = _cached_tokens(body)
+    await asyncio.sleep(_ttft_seconds(cached_tokens / _prompt_tokens(body)) + COMPLETION_TOKENS / TOKENS_PER_SECOND)
+
+    response_format = body.get("response_format")
+    if response_format and response_format.get("type") == "json_schema":
+        content = _structured_content(response_format)
+    else:
+        content = "".join(_tokens()).strip()
+
+    return JSONResponse({
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "fake"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content, "refusal": None},
+            "finish_reason": "stop",
+        }],
+        "usage": _usage(body, cached_tokens),
+    })
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="127.0.0.1", port=int(os.getenv("FAKE_LLM_PORT", 8100)), log_level="warning")
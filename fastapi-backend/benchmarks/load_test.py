@@ -0,0 +1,280 @@
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import tempfile
+import statistics
+import subprocess
+from typing import Dict, List, Optional
+
+import httpx
+
+# Replays realistic recording sessions against the API, with a fake LLM server standing in for OpenAI/Gemini.
+# Usage (from fastapi-backend/): python benchmarks/load_test.py --sessions 20 --duration 60
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORDS = (
+    "so the main thing we need to decide today is whether we ship the new pricing before the quarter "
+    "ends I think the team is ready but legal still has questions about the contract terms and we "
+    "should probably loop in finance before we commit to anything with the customer"
+).split()
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="End-to-end load test for the conversation API.")
+    parser.add_argument("--sessions", type=int, default=10, help="Concurrent recording sessions.")
+    parser.add_argument("--users", type=int, default=5, help="Users the sessions are spread across.")
+    parser.add_argument("--duration", type=float, default=60, help="Length of each recording session (seconds).")
+    parser.add_argument("--segment-interval", type=float, default=1.5, help="Seconds between finalized segments.")
+    parser.add_argument("--prediction-interval", type=float, default=4, help="Seconds between prediction requests.")
+    parser.add_argument("--ttft-ms", type=float, default=400, help="Fake LLM time to first token.")
+    parser.add_argument("--tokens-per-second", type=float, default=60, help="Fake LLM generation rate.")
+    parser.add_argument("--completion-tokens", type=int, default=30, help="Tokens per fake completion.")
+    parser.add_argument("--db-uri", default=None, help="Database to run against (defaults to a temporary SQLite file).")
+    parser.add_argument("--app-port", type=int, default=8099)
+    parser.add_argument("--llm-port", type=int, default=8100)
+    parser.add_argument("--workers", type=int, default=1, help="Uvicorn workers for the API.")
+    return parser.parse_args()
+
+
+def _percentile(values: List[float], percentile: float) -> float:
+    if not values: return float("nan")
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(percentile / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _metric_total(text: str, name: str, labels: Optional[Dict[str, str]] = None) -> float:
+    # Summing all samples of a metric in Prometheus text format, optionally filtered by labels:
+    total = 0.0
+    for line in text.splitlines():
+        if not line.startswith(name) or line.startswith("#"): continue
+        series, _, value = line.rpartition(" ")
+        metric_name = series.split("{", 1)[0]
+        if metric_name != name: continue
+        if labels and not all(f'{key}="{label}"' in series for key, label in labels.items()): continue
+        total += float(value)
+    return total
+
+
+def _start_process(module: str, port: int, env: dict, workers: int = 1) -> subprocess.Popen:
+    command = [sys.executable, "-m", "uvicorn", module, "--host", "127.0.0.1", "--port", str(port),
+               "--log-level", "warning", "--workers", str(workers)]
+    return subprocess.Popen(command, cwd=BACKEND_DIR, env=env)
+
+
+async def _wait_until_ready(client: httpx.AsyncClient, url: str, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            await client.get(url)
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not become ready in {timeout} seconds.")
+
+
+class Results:
+    def __init__(self):
+        self.ttfts: List[float] = []
+        self.prediction_durations: List[float] = []
+        self.prediction_errors = 0
+        self.saves = 0
+        self.save_errors = 0
+        # (elapsed seconds, transcript segments, request body bytes) for every transcript upload:
+        self.uploads: List[tuple] = []
+
+
+async def _login(client: httpx.AsyncClient, index: int) -> Dict[str, str]:
+    email = f"load-{uuid.uuid4().hex[:8]}-{index}@example.com"
+    password = "load-test-password"
+
+    response = await client.post("/user/", json={"name": f"Load Tester {index}", "email": email, "password": password})
+    response.raise_for_status()
+
+    response = await client.post("/auth/token", data={"username": email, "password": password})
+    response.raise_for_status()
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+async def _predict(client: httpx.AsyncClient, headers: dict, conversation_id: int, transcript: list, results: Results, start: float) -> None:
+    body = json.dumps({"id": conversation_id, "transcript": transcript})
+    results.uploads.append((time.monotonic() - start, len(transcript), len(body)))
+
+    sent = time.perf_counter()
+    first_chunk = None
+    try:
+        async with client.stream(
+            "POST", f"/conversations/{conversation_id}/prediction_stream",
+            headers={**headers, "Content-Type": "application/json"}, content=body
+        ) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line: continue
+                if first_chunk is None:
+                    first_chunk = time.perf_counter()
+                if json.loads(line).get("error"):
+                    results.prediction_errors += 1
+    except httpx.HTTPError:
+        results.prediction_errors += 1
+        return
+
+    if first_chunk is not None:
+        results.ttfts.append(first_chunk - sent)
+    results.prediction_durations.append(time.perf_counter() - sent)
+
+
+async def _session(client: httpx.AsyncClient, headers: dict, args: argparse.Namespace, results: Results, start: float) -> None:
+    response = await client.post("/conversations/", headers=headers)
+    response.raise_for_status()
+    conversation_id = response.json()["id"]
+
+    transcript = []
+    session_start = time.monotonic()
+    next_segment = session_start
+    next_prediction = session_start + args.prediction_interval * random.random()
+    predictions = set()
+
+    # Growing the transcript at a steady pace, with a prediction request every few seconds:
+    while time.monotonic() - session_start < args.duration:
+        now = time.monotonic()
+        if now >= next_segment:
+            transcript.append({
+                "id": len(transcript) + 1,
+                "text": " ".join(random.choices(WORDS, k=random.randint(6, 25))),
+                "speaker": f"S{random.randint(1, 3)}",
+                "translations": [],
+                "timestamp": int(time.time() * 1000),
+            })
+            next_segment += args.segment_interval
+
+        if now >= next_prediction and transcript:
+            task = asyncio.create_task(_predict(client, headers, conversation_id, list(transcript), results, start))
+            predictions.add(task)
+            task.add_done_callback(predictions.discard)
+            next_prediction += args.prediction_interval
+
+        await asyncio.sleep(max(0.0, min(next_segment, next_prediction) - time.monotonic()))
+
+    await asyncio.gather(*predictions, return_exceptions=True)
+
+    # Saving the final transcript with AI insights, as the PWA does when recording stops:
+    try:
+        response = await client.put(
+            f"/conversations/{conversation_id}", params={"ai_insights": "true"}, headers=headers,
+            json={"id": conversation_id, "transcript": transcript}
+        )
+        response.raise_for_status()
+        results.saves += 1
+    except httpx.HTTPError:
+        results.save_errors += 1
+
+
+def _report(results: Results, elapsed: float, before: str, after: str) -> None:
+    predictions = len(results.prediction_durations)
+    print(f"\nPredictions completed:   {predictions} ({predictions / elapsed:.2f}/s), errors: {results.prediction_errors}")
+    print(f"Final saves:             {results.saves}, errors: {results.save_errors}")
+    print(f"Client TTFT p50 / p99:   {_percentile(results.ttfts, 50) * 1000:.0f} ms / {_percentile(results.ttfts, 99) * 1000:.0f} ms")
+    print(f"Prediction total p50/p99: {_percentile(results.prediction_durations, 50) * 1000:.0f} ms / "
+          f"{_percentile(results.prediction_durations, 99) * 1000:.0f} ms")
+
+    lag_count = _metric_total(after, "event_loop_lag_seconds_count") - _metric_total(before, "event_loop_lag_seconds_count")
+    lag_sum = _metric_total(after, "event_loop_lag_seconds_sum") - _metric_total(before, "event_loop_lag_seconds_sum")
+    if lag_count:
+        print(f"Event loop lag (mean):   {lag_sum / lag_count * 1000:.1f} ms over {int(lag_count)} samples")
+
+    prompt_tokens = _metric_total(after, "llm_prompt_tokens_total") - _metric_total(before, "llm_prompt_tokens_total")
+    cached_tokens = _metric_total(after, "llm_cached_prompt_tokens_total") - _metric_total(before, "llm_cached_prompt_tokens_total")
+    if prompt_tokens:
+        print(f"Prompt tokens:           {int(prompt_tokens)}, cached: {int(cached_tokens)} ({cached_tokens / prompt_tokens:.0%})")
+
+    for kind in ("insert", "update", "select"):
+        statements = _metric_total(after, "db_statements_total", {"kind": kind}) - _metric_total(before, "db_statements_total", {"kind": kind})
+        written = (_metric_total(after, "db_statement_parameter_bytes_total", {"kind": kind})
+                   - _metric_total(before, "db_statement_parameter_bytes_total", {"kind": kind}))
+        print(f"DB {kind:<7} statements:  {int(statements)}, parameter bytes: {written / 1e6:.2f} MB")
+
+    # Showing how the size of each transcript write grows over the session:
+    if results.uploads:
+        print("\nTranscript upload size as sessions progress:")
+        print(f"{'segments':>10} {'uploads':>8} {'mean KB':>9}")
+        buckets: Dict[int, List[int]] = {}
+        for _, segments, size in results.uploads:
+            buckets.setdefault(segments // 10 * 10, []).append(size)
+        for segments in sorted(buckets):
+            sizes = buckets[segments]
+            print(f"{segments:>10} {len(sizes):>8} {statistics.mean(sizes) / 1024:>9.1f}")
+
+
+async def _run(args: argparse.Namespace) -> None:
+    app_url = f"http://127.0.0.1:{args.app_port}"
+    limits = httpx.Limits(max_connections=args.sessions * 4, max_keepalive_connections=args.sessions * 4)
+
+    async with httpx.AsyncClient(base_url=app_url, timeout=60, limits=limits) as client:
+        await _wait_until_ready(client, f"http://127.0.0.1:{args.llm_port}/")
+        await _wait_until_ready(client, "/")
+
+        users = [await _login(client, index) for index in range(max(1, min(args.users, args.sessions)))]
+        before = (await client.get("/metrics")).text
+
+        results = Results()
+        start = time.monotonic()
+        await asyncio.gather(*[
+            _session(client, users[index % len(users)], args, results, start) for index in range(args.sessions)
+        ])
+        elapsed = time.monotonic() - start
+
+        after = (await client.get("/metrics")).text
+        _report(results, elapsed, before, after)
+
+
+def main() -> None:
+    args = _parse_args()
+    database_dir = tempfile.mkdtemp(prefix="load-test-")
+    llm_url = f"http://127.0.0.1:{args.llm_port}/v1/"
+
+    llm_env = {
+        **os.environ,
+        "FAKE_LLM_TTFT_MS": str(args.ttft_ms),
+        "FAKE_LLM_TOKENS_PER_SECOND": str(args.tokens_per_second),
+        "FAKE_LLM_COMPLETION_TOKENS": str(args.completion_tokens),
+    }
+    app_env = {
+        # Sensible defaults for a local run, which can be overridden from the environment:
+        "HASH_KEY": "load-test-secret",
+        "HASH_ALGORITHM": "HS256",
+        "TOKEN_TTL": "120",
+        "REFRESH_TOKEN_TTL": "1440",
+        "VERIFICATION_CODE_TTL": "10",
+        "RESET_PASSWORD_CODE_TTL": "10",
+        "AWS_EC2_METADATA_DISABLED": "true",
+        **os.environ,
+        "DB_URI": args.db_uri or f"sqlite:///{os.path.join(database_dir, 'load_test.db')}",
+        "OPENAI_BASE_URL": llm_url,
+        "OPENAI_API_KEY": "fake",
+        "GEMINI_BASE_URL": llm_url,
+        "GEMINI_API_KEY": "fake",
+        "METRICS_ENABLED": "true",
+        "RATE_LIMIT_ENABLED": "false",
+    }
+
+    processes = [
+        _start_process("benchmarks.fake_llm_server:app", args.llm_port, llm_env),
+        _start_process("main:app", args.app_port, app_env, args.workers),
+    ]
+    try:
+        asyncio.run(_run(args))
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import os
+import sys
+import time
+import tempfile
+from collections import Counter
+from typing import Any, Dict, List, Tuple
+
+# Counts the SQL statements each endpoint runs, and fails when one exceeds its budget, to catch extra round trips
+# (e.g. a refresh after commit, or a lazy load in a loop) before they reach production.
+# Usage (from fastapi-backend/): python benchmarks/statement_budget.py [--verbose]
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Providing defaults for the settings read at import time, against a throwaway SQLite file:
+os.environ.setdefault("DB_URI", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'statement_budget.db')}")
+for key, value in {
+    "HASH_KEY": "benchmark-secret", "HASH_ALGORITHM": "HS256", "TOKEN_TTL": "30", "REFRESH_TOKEN_TTL": "600",
+    "VERIFICATION_CODE_TTL": "10", "RESET_PASSWORD_CODE_TTL": "10", "OPENAI_API_KEY": "unused",
+    "GEMINI_API_KEY": "unused", "AWS_REGION": "us-east-1", "AWS_DEFAULT_REGION": "us-east-1",
+    # The budgets are for the request path only, not the background workers:
+    "SEMANTIC_SEARCH_ENABLED": "false", "LOOP_BLOCKED_THRESHOLD_MS": "0",
+}.items():
+    os.environ.setdefault(key, value)
+
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+
+import main
+from database import engine
+
+# Maximum statements per request. Lower these when an endpoint gets cheaper, never raise them without a reason:
+BUDGETS: Dict[str, int] = {
+    "POST /user/": 2,
+    "POST /auth/token": 1,
+    "GET /user/": 1,
+    "PATCH /user/": 2,
+    "POST /conversations/": 3,
+    "PUT /conversations/{id}": 7,
+    "GET /conversations/{id}": 2,
+    "GET /conversations/": 2,
+    "GET /conversations/{id}/stats": 2,
+    "DELETE /conversations/{id}": 5,
+    "DELETE /user/": 10,
+}
+
+TRANSCRIPT = [
+    {"id": 1, "text": "so when do we ship the new pricing", "speaker": "S1", "timestamp": 0},
+    {"id": 2, "text": "after legal signs off on the contract terms", "speaker": "S2", "timestamp": 2500},
+]
+
+
+class StatementCounter:
+    def __init__(self):
+        self.statements: List[str] = []
+        event.listen(engine, "before_cursor_execute", self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        self.statements.append(" ".join(statement.split()))
+
+    def measure(self, client: TestClient, method: str, path: str, **kwargs) -> Tuple[Any, List[str]]:
+        self.statements = []
+        response = client.request(method, path, **kwargs)
+        assert response.status_code < 400, f"{method} {path}: {response.status_code} {response.text}"
+        return response, list(self.statements)
+
+
+def main_() -> int:
+    verbose = "--verbose" in sys.argv
+    counter = StatementCounter()
+    results: Dict[str, List[str]] = {}
+
+    with TestClient(main.app) as client:
+        # Letting the background workers finish their first pass, so that their statements are not counted:
+        time.sleep(1)
+
+        def run(name: str, method: str, path: str, **kwargs):
+            response, statements = counter.measure(client, method, path, **kwargs)
+            results[name] = statements
+            return response
+
+        run("POST /user/", "POST", "/user/", json={"name": "budget user", "email": "budget@example.com", "password": "secret1"})
+        token = run(
+            "POST /auth/token", "POST", "/auth/token", data={"username": "budget@example.com", "password": "secret1"}
+        ).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+
+        run("GET /user/", "GET", "/user/", headers=headers)
+        run("PATCH /user/", "PATCH", "/user/", headers=headers, json={"name": "renamed user"})
+        conversation_id = run("POST /conversations/", "POST", "/conversations/", headers=headers).json()["id"]
+        run("PUT /conversations/{id}", "PUT", f"/conversations/{conversation_id}", headers=headers,
+            json={"id": conversation_id, "name": "Pricing", "transcript": TRANSCRIPT})
+        run("GET /conversations/{id}", "GET", f"/conversations/{conversation_id}", headers=headers)
+        run("GET /conversations/", "GET", "/conversations/", headers=headers)
+        run("GET /conversations/{id}/stats", "GET", f"/conversations/{conversation_id}/stats", headers=headers)
+        run("DELETE /conversations/{id}", "DELETE", f"/conversations/{conversation_id}", headers=headers)
+        run("DELETE /user/", "DELETE", "/user/", headers=headers)
+
+    failures = 0
+    for name, statements in results.items():
+        budget = BUDGETS[name]
+        over = len(statements) > budget
+        failures += over
+        print(f"{'OVER' if over else 'ok':<5} {name:<32} {len(statements):>3} / {budget}")
+        if verbose or over:
+            for kind, count in Counter(statement.split()[0] for statement in statements).items():
+                print(f"{'':<6}{kind} x{count}")
+            for statement in statements:
+                print(f"{'':<8}{statement[:160]}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_())
@@ -1,15 +1,85 @@
 import os
+import time
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.ext.declarative import declarative_base
 
+import metrics
+
+
+DB_URI = os.getenv("DB_URI")
+
+POOL_CHECKOUT_WAIT = metrics.registry.histogram(
+    "db_pool_checkout_wait_seconds", "Time spent waiting to check a connection out of the pool."
+)
+
+
+class TimedQueuePool(QueuePool):
+    # QueuePool that records how long each checkout waited for a connection:
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_CHECKOUT_WAIT.observe(time.perf_counter() - start)
+
+
+def _pool_arguments(uri: str) -> dict:
+    # Only swapping in the timed pool where the dialect would use a QueuePool anyway (e.g. not in-memory SQLite):
+    if not metrics.METRICS_ENABLED: return {}
+    url = make_url(uri)
+    if url.get_dialect().get_pool_class(url) is not QueuePool: return {}
+    return {"poolclass": TimedQueuePool}
+
 
 # Declaring the engine to connect with the DB:
-engine = create_engine(os.getenv("DB_URI"), pool_pre_ping=True)
+engine = create_engine(DB_URI, pool_pre_ping=True, **_pool_arguments(DB_URI))
+
+# SQLite only enforces foreign keys, and so ON DELETE CASCADE, when each connection asks for it:
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine, "connect")
+    def _enable_foreign_keys(dbapi_connection, connection_record) -> None:
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys = ON")
+        cursor.close()
+
+# Pool gauges are read when the metrics are scraped:
+if isinstance(engine.pool, QueuePool):
+    metrics.registry.gauge("db_pool_size", "Configured size of the connection pool.", lambda: engine.pool.size())
+    metrics.registry.gauge("db_pool_checked_out", "Connections currently in use.", lambda: engine.pool.checkedout())
+    metrics.registry.gauge("db_pool_overflow", "Connections opened beyond the pool size.", lambda: engine.pool.overflow())
+
+DB_STATEMENTS = metrics.registry.counter("db_statements_total", "SQL statements executed, by statement type.")
+DB_PARAMETER_BYTES = metrics.registry.counter(
+    "db_statement_parameter_bytes_total", "Bytes of string parameters sent with SQL statements, by statement type."
+)
+
+
+def _record_statement(conn, cursor, statement, parameters, context, executemany) -> None:
+    kind = statement.lstrip().split(None, 1)[0].lower() if statement.strip() else "unknown"
+    DB_STATEMENTS.inc(kind=kind)
+
+    # Only counting string and binary parameters, which is where transcripts end up.
+    # Batched inserts ("insertmanyvalues") pass one flat sequence of values even though executemany is set:
+    rows = parameters if executemany else [parameters]
+    size = 0
+    for row in rows:
+        values = row.values() if isinstance(row, dict) else row if isinstance(row, (list, tuple)) else (row,)
+        size += sum(len(value) for value in values if isinstance(value, (str, bytes)))
+    if size: DB_PARAMETER_BYTES.inc(size, kind=kind)
+
+
+if metrics.METRICS_ENABLED:
+    event.listen(engine, "before_cursor_execute", _record_statement)
 
-# sessionmaker class is used to create session objects to connect & interact with the DB:
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# sessionmaker class is used to create session objects to connect & interact with the DB.
+# Objects are not expired on commit, since sessions live for one request and the responses are built from what was
+# just written; server-generated columns are returned by the INSERT/UPDATE itself (see eager_defaults in models):
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
 
 
 # declarative_base function is used to create a base class for all data models:
@@ -6,6 +6,7 @@ from sqlalchemy.orm import Session
 
 from exceptions import JWTException, UserNotFoundException, AdminStatusException, UnverifiedUserException
 from database import SessionLocal
+from replicas import read_session
 from models import User
 from security import decode_token
 
@@ -41,10 +42,33 @@ auth_dependency = Annotated[OAuth2PasswordRequestForm, Depends(OAuth2PasswordReq
 token_dependency = Annotated[str, Depends(OAuth2PasswordBearer(tokenUrl="auth/token"))]
 
 
+# Sessions for read-only endpoints, which may be routed to a replica (see replicas.read_session).
+# The user ID is read from the token, so that users who have just written are kept on the primary:
+def get_read_db(token: token_dependency) -> Generator[Session, None, None]:
+    user_id: Optional[int] = decode_token(token).get("sub")
+    if user_id is None: raise JWTException
+
+    db = read_session(int(user_id))
+    try:
+        yield db
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+read_db_dependency = Annotated[Session, Depends(get_read_db)]
+
+
 def get_user(db: db_dependency, user_id: int, require_verification: bool = True) -> User:
     user = db.query(User).filter_by(id=user_id).first()
 
-    if user is None: raise UserNotFoundException
+    # Noting the user the session acts for, so that their writes pin their reads to the primary:
+    db.info["user_id"] = user_id
+
+    # Accounts that are being deleted in the background are treated as already gone:
+    if user is None or user.deletion_requested_at is not None: raise UserNotFoundException
     if require_verification and not user.is_verified: raise UnverifiedUserException
     return user
 
@@ -71,6 +95,13 @@ def get_current_unverified_user(db: db_dependency, token: token_dependency) -> U
 
 
 user_dependency = Annotated[User, Depends(get_current_verified_user)]
+
+
+def get_current_read_user(db: read_db_dependency, token: token_dependency) -> User:
+    return get_current_user(db, token, require_verification=True)
+
+
+read_user_dependency = Annotated[User, Depends(get_current_read_user)]
 unverified_user_dependency = Annotated[User, Depends(get_current_unverified_user)]
 
 
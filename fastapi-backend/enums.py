@@ -6,6 +6,19 @@ class CodeType(Enum):
     RESET_PASSWORD = "reset_password"
 
 
+class DescriptionCategory(Enum):
+    SCENE = "scene"
+    PEOPLE = "people"
+    ACTIVITY = "activity"
+    EMOTION = "emotion"
+    ATMOSPHERE = "atmosphere"
+    COLOR = "color"
+    TEXT = "text"
+    OBJECTS = "objects"
+    DETAIL = "detail"
+    CONCISENESS = "conciseness"
+
+
 class AIModel(Enum):
     GPT_4O = "gpt-4o"
     GPT_4O_MINI = "gpt-4o-mini"
@@ -28,14 +41,18 @@ class AIModel(Enum):
     @property
     def supports_structured_outputs(self) -> bool:
         return AI_MODEL_CAPABILITIES[self]["supports_structured_outputs"]
+
+    @property
+    def supports_stream_usage(self) -> bool:
+        return AI_MODEL_CAPABILITIES[self]["supports_stream_usage"]
     
     
 AI_MODEL_CAPABILITIES = {
-    AIModel.GPT_4O: {"supports_images": True, "supports_functions": True, "supports_developer_messages": True, "supports_structured_outputs": True},
-    AIModel.GPT_4O_MINI: {"supports_images": True, "supports_functions": True, "supports_developer_messages": True, "supports_structured_outputs": True},
-    AIModel.O1: {"supports_images": False, "supports_functions": False, "supports_developer_messages": False, "supports_structured_outputs": False},
-    AIModel.O3_MINI: {"supports_images": False, "supports_functions": False, "supports_developer_messages": False, "supports_structured_outputs": False},
-    AIModel.GEMINI_1_5_FLASH: {"supports_images": True, "supports_functions": True, "supports_developer_messages": True, "supports_structured_outputs": False}, # Does not support the structured outputs we use
+    AIModel.GPT_4O: {"supports_images": True, "supports_functions": True, "supports_developer_messages": True, "supports_structured_outputs": True, "supports_stream_usage": True},
+    AIModel.GPT_4O_MINI: {"supports_images": True, "supports_functions": True, "supports_developer_messages": True, "supports_structured_outputs": True, "supports_stream_usage": True},
+    AIModel.O1: {"supports_images": False, "supports_functions": False, "supports_developer_messages": False, "supports_structured_outputs": False, "supports_stream_usage": True},
+    AIModel.O3_MINI: {"supports_images": False, "supports_functions": False, "supports_developer_messages": False, "supports_structured_outputs": False, "supports_stream_usage": True},
+    AIModel.GEMINI_1_5_FLASH: {"supports_images": True, "supports_functions": True, "supports_developer_messages": True, "supports_structured_outputs": False, "supports_stream_usage": False}, # Does not support the structured outputs we use
 }
 
 OPENAI_MODELS = {AIModel.GPT_4O, AIModel.GPT_4O_MINI, AIModel.O1, AIModel.O3_MINI}
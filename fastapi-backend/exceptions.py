@@ -60,3 +60,38 @@ class ConversationNotFoundException(HTTPException):
 class ConversationUpdateException(HTTPException):
     def __init__(self, detail="Failed to update the conversation."):
         super().__init__(status_code=st.HTTP_400_BAD_REQUEST, detail=detail)
+
+
+class InvalidSearchCursorException(HTTPException):
+    def __init__(self, detail="The search cursor is invalid. Please start the search again."):
+        super().__init__(status_code=st.HTTP_400_BAD_REQUEST, detail=detail)
+
+
+class SemanticSearchUnavailableException(HTTPException):
+    def __init__(self, detail="Semantic search is not available. Please try again later."):
+        super().__init__(status_code=st.HTTP_503_SERVICE_UNAVAILABLE, detail=detail)
+
+
+class SegmentNotFoundException(HTTPException):
+    def __init__(self, detail="The specified segment was not found."):
+        super().__init__(status_code=st.HTTP_404_NOT_FOUND, detail=detail)
+
+
+class QuotaExceededException(HTTPException):
+    def __init__(self, detail="You have used your AI allowance for today. Please try again tomorrow."):
+        super().__init__(status_code=st.HTTP_429_TOO_MANY_REQUESTS, detail=detail)
+
+
+class LLMBusyException(HTTPException):
+    def __init__(self, detail="The assistant is busy. Please try again shortly."):
+        super().__init__(status_code=st.HTTP_503_SERVICE_UNAVAILABLE, detail=detail)
+
+
+class ProfilerBusyException(HTTPException):
+    def __init__(self, detail="A profile is already running on this worker. Please try again when it finishes."):
+        super().__init__(status_code=st.HTTP_409_CONFLICT, detail=detail)
+
+
+class ProfilerUnavailableException(HTTPException):
+    def __init__(self, detail="CPU profiling is not supported on this platform."):
+        super().__init__(status_code=st.HTTP_501_NOT_IMPLEMENTED, detail=detail)
@@ -1,45 +1,68 @@
-LLM_CONTEXT = """
-    You are a smart assistant built into a real-time conversation transcription/translation app.
-    Please create a friendly and concise, casual summary of the conversation. 
-    Keep in mind the user reading the summary also has the transcript, so don't just repeat what is said.
+# Prompts are laid out so that everything that changes least comes first: the static instructions, then the
+# conversation context, then the transcript one segment per line. Each request then starts with the same bytes
+# as the previous one, up to the newest segments, which lets providers serve that prefix from their prompt cache.
+# The instructions must therefore never contain per-request values.
 
-    Important information:
-    - The user's name is {user_name}. However, the user may not be speaking in the conversation at all.
+SUMMARY_INSTRUCTIONS = """You are a smart assistant built into a real-time conversation transcription/translation app.
+Please create a friendly and concise, casual summary of the conversation.
+Keep in mind the user reading the summary also has the transcript, so don't just repeat what is said.
 
-    Conversation transcript:
-    {transcript}
+Important information:
+- The user's name is given before the transcript. However, the user may not be speaking in the conversation at all.
 """
 
-PREDICTION_CONTEXT = """
-    You are an AI conversation prediction assistant integrated into a real-time transcription app.
-    Your job is to predict what might happen next in an ongoing conversation.
-    
-    Focus on being forward-looking - predict what hasn't happened yet rather than summarizing the conversation.
-    Your predictions should be specific, actionable, and concise (one or two sentences maximum).
-    
-    Based on the conversation so far, predict ONE of the following that seems most likely:
-    - The next question or topic the other participants might raise
-    - An imminent objection or concern they may voice
-    - A request for clarification they might make
-    - A potential shift in sentiment or tone
-    - The next action or decision they might propose
-    
-    Format your prediction as a very short, direct statement of your prediction.
-
-    THE PREDICTION IS THE MOST IMPORTANT PART - DO YOUR BEST TO PREDICT THE FUTURE WITH EACH MESSAGE
-
-    If applicable, provide a short suggestion for what the person should do to reach the best outcome.
-    Your answers do not need to be grammatically correct, make every single word count and remove words that don't add meaning.
-    The key thing is what you are saying to be understood in as few words as possible, and read as easily as possible.
-
-    NEVER use 'may' or 'might' in your predictions - you are predicting, not guessing. Use phrases such as 'likely to'.
-
-    NEVER RE-STATE WHAT IS SAID IN THE CONVERSATION AS YOUR PREDICTION!
-    ALWAYS CREATE A PREDICTION THAT GOES BEYOND WHAT IS SAID IN THE CONVERSATION!!
-
-    Conversation Context:
-    {context}
-    
-    Conversation transcript:
-    {transcript}
-"""
\ No newline at end of file
+PREDICTION_INSTRUCTIONS = """You are an AI conversation prediction assistant integrated into a real-time transcription app.
+Your job is to predict what might happen next in an ongoing conversation.
+
+Focus on being forward-looking - predict what hasn't happened yet rather than summarizing the conversation.
+Your predictions should be specific, actionable, and concise (one or two sentences maximum).
+
+Based on the conversation so far, predict ONE of the following that seems most likely:
+- The next question or topic the other participants might raise
+- An imminent objection or concern they may voice
+- A request for clarification they might make
+- A potential shift in sentiment or tone
+- The next action or decision they might propose
+
+Format your prediction as a very short, direct statement of your prediction.
+
+THE PREDICTION IS THE MOST IMPORTANT PART - DO YOUR BEST TO PREDICT THE FUTURE WITH EACH MESSAGE
+
+If applicable, provide a short suggestion for what the person should do to reach the best outcome.
+Your answers do not need to be grammatically correct, make every single word count and remove words that don't add meaning.
+The key thing is what you are saying to be understood in as few words as possible, and read as easily as possible.
+
+NEVER use 'may' or 'might' in your predictions - you are predicting, not guessing. Use phrases such as 'likely to'.
+
+NEVER RE-STATE WHAT IS SAID IN THE CONVERSATION AS YOUR PREDICTION!
+ALWAYS CREATE A PREDICTION THAT GOES BEYOND WHAT IS SAID IN THE CONVERSATION!!
+
+The conversation context and transcript follow, with one "speaker: text" line per transcript segment,
+the main topics of the conversation so far, and statistics on who has been talking and how much.
+Use them to judge who is likely to speak next and how.
+"""
+
+
+def format_segment(segment: dict) -> str:
+    # One line per segment, which is far fewer tokens than the JSON, and only changes when the segment does:
+    text = " ".join(str(segment.get("text") or "").split())
+    speaker = segment.get("speaker")
+    return f"{speaker}: {text}" if speaker else text
+
+
+def format_transcript(transcript: list) -> str:
+    return "\n".join(format_segment(segment) for segment in transcript or [])
+
+
+def format_prediction_input(transcript: list, context: str, stats: str = "", topics: str = "") -> str:
+    prompt = f"Conversation context:\n{context or 'None'}\n\nConversation transcript:\n{format_transcript(transcript)}"
+
+    # Topics and statistics change as segments arrive, so they go after the transcript to keep the prefix stable.
+    # Topics change least often, so they come first:
+    if topics: prompt += f"\n\nMain topics so far: {topics}"
+    if stats: prompt += f"\n\nConversation statistics so far:\n{stats}"
+    return prompt
+
+
+def format_summary_input(user_name: str, transcript: str) -> str:
+    return f"The user's name is {user_name}.\n\nConversation transcript:\n{transcript}"
@@ -0,0 +1,134 @@
+import os
+import sys
+import copy
+import queue
+import atexit
+import random
+import logging
+from datetime import datetime, UTC
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional
+
+import orjson
+
+import metrics
+
+
+# Level for every logger, overridden per logger with e.g. LOG_LEVELS="services.llm_service=DEBUG,sqlalchemy.engine=INFO":
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+
+# "json" for one JSON object per line (for log pipelines), or "text" for reading in a terminal:
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+
+# Fraction of records kept from high-frequency loggers (and the loggers below them), e.g. one prediction chunk in 100:
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "services.conversation_service.chunks=0.01")
+
+# Records waiting for the writer thread. Once full, new records are dropped rather than blocking the caller:
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10_000))
+
+LOG_RECORDS_DROPPED = metrics.registry.counter(
+    "log_records_dropped_total", "Log records dropped because the writer thread could not keep up."
+)
+
+# Attributes every LogRecord has, so that anything else was passed through extra= and belongs in the JSON output:
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_listener: Optional[QueueListener] = None
+
+
+def _parse_settings(setting: str) -> Dict[str, str]:
+    # Parsing "name=value,name=value" settings:
+    pairs = (item.split("=", 1) for item in setting.split(",") if "=" in item)
+    return {name.strip(): value.strip() for name, value in pairs}
+
+
+class JSONFormatter(logging.Formatter):
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, UTC).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES})
+        if record.exc_text: entry["exception"] = record.exc_text
+        if record.stack_info: entry["stack"] = record.stack_info
+        return orjson.dumps(entry, default=str).decode()
+
+
+class SamplingFilter(logging.Filter):
+    # Keeps a random fraction of the records from the configured loggers and their children:
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+        self._resolved: Dict[str, Optional[float]] = {}
+
+    def _rate(self, name: str) -> Optional[float]:
+        rate = self._resolved.get(name, False)
+        if rate is not False: return rate
+
+        # Using the rate of the closest configured ancestor, once per logger name:
+        rate, prefix = None, name
+        while prefix:
+            if prefix in self.rates:
+                rate = self.rates[prefix]
+                break
+            prefix = prefix.rpartition(".")[0]
+        self._resolved[name] = rate
+        return rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self._rate(record.name)
+        return rate is None or random.random() < rate
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    # Hands records to the writer thread, so that slow log destinations never stall the event loop:
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Resolving the message and traceback in the caller, since arguments and tracebacks may not outlive it,
+        # but leaving the formatting to the writer thread:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+
+def configure_logging() -> None:
+    # Routing every logger through one queue, drained by a writer thread. Only the first call has an effect:
+    global _listener
+    if _listener is not None: return
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(
+        JSONFormatter() if LOG_FORMAT == "json" else logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    )
+
+    records = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    handler = NonBlockingQueueHandler(records)
+    handler.addFilter(SamplingFilter({name: float(rate) for name, rate in _parse_settings(LOG_SAMPLE_RATES).items()}))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+    for name, level in _parse_settings(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level.upper())
+
+    _listener = QueueListener(records, output, respect_handler_level=True)
+    _listener.start()
+    # Writing out what is still queued when the process exits:
+    atexit.register(_listener.stop)
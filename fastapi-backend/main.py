@@ -1,5 +1,7 @@
 import os
 import sys
+import asyncio
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
@@ -16,14 +18,57 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 # Loading environment variables and declaring FastAPI instance before local imports:
 load_dotenv()
 
+# Configuring logging before anything logs, so that every logger writes through the non-blocking queue:
+from logging_config import configure_logging
+configure_logging()
+
 from handlers import validation_exception_handler
-from routers import root, users, auth, conversations
+from routers import root, users, auth, conversations, admin, metrics as metrics_router
 from database import engine
+from replicas import replicas, monitor_replicas
+from metrics import METRICS_ENABLED, MetricsMiddleware, monitor_event_loop_lag
+from profiler import LOOP_BLOCKED_THRESHOLD_MS, run_loop_watchdog
+from services.archive_service import ARCHIVE_AFTER_DAYS, run_archival_periodically
+from services.embedding_service import SEMANTIC_SEARCH_ENABLED, run_embedding_worker
+from services.search_service import run_search_backfill
+from services.tagging_service import TOPIC_TAGGING_ENABLED, run_tagging_worker
+from services.usage_service import run_usage_flush_periodically
+from services.user_service import run_code_sweeper_periodically, run_user_deletion_worker
 import models
 from rate_limiter import limiter
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Starting background tasks that live as long as the application:
+    tasks = [
+        asyncio.create_task(run_usage_flush_periodically()),
+        asyncio.create_task(run_code_sweeper_periodically()),
+        asyncio.create_task(run_user_deletion_worker()),
+        asyncio.create_task(run_search_backfill()),
+    ]
+    if METRICS_ENABLED:
+        tasks.append(asyncio.create_task(monitor_event_loop_lag()))
+    if LOOP_BLOCKED_THRESHOLD_MS > 0:
+        tasks.append(asyncio.create_task(run_loop_watchdog()))
+    if ARCHIVE_AFTER_DAYS > 0:
+        tasks.append(asyncio.create_task(run_archival_periodically()))
+    if SEMANTIC_SEARCH_ENABLED:
+        tasks.append(asyncio.create_task(run_embedding_worker()))
+    if TOPIC_TAGGING_ENABLED:
+        tasks.append(asyncio.create_task(run_tagging_worker()))
+    if replicas:
+        tasks.append(asyncio.create_task(monitor_replicas()))
+
+    yield
+
+    for task in tasks:
+        task.cancel()
+    # Waiting for the tasks to finish, so that they can write any state they hold in memory:
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
 # Initializing FastAPI:
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Adding CORS middleware before other middleware:
 app.add_middleware(
@@ -39,6 +84,11 @@ app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 app.add_middleware(SlowAPIMiddleware)
 
+# Adding stage timing and per-route latency metrics only when enabled, so there is no overhead otherwise:
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+    app.include_router(metrics_router.router)
+
 # Adding custom exception handler for request validation errors:
 app.add_exception_handler(RequestValidationError, validation_exception_handler)
 
@@ -46,7 +96,7 @@ app.add_exception_handler(RequestValidationError, validation_exception_handler)
 models.Base.metadata.create_all(bind=engine)
 
 # Adding all routers:
-for module in [root, users, auth, conversations]:
+for module in [root, users, auth, conversations, admin]:
     app.include_router(module.router)
 
 
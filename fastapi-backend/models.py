@@ -1,12 +1,15 @@
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
-from sqlalchemy import Column, Integer, String, ForeignKey, Enum, DateTime, Boolean, JSON
+from sqlalchemy import Column, Integer, String, ForeignKey, Enum, DateTime, Date, Boolean, Float, JSON, LargeBinary, Text, DDL, event, Index, UniqueConstraint
 
 from database import Base
+from transcript_codec import compression_enabled, encode_transcript, decode_transcript
 
 
 class User(Base):
     __tablename__ = "users"
+    # Fetching server-generated columns (id, created_at) with RETURNING, rather than with a SELECT after the commit:
+    __mapper_args__ = {"eager_defaults": True}
 
     id = Column(Integer, primary_key=True)
     
@@ -19,32 +22,175 @@ class User(Base):
     is_admin = Column(Boolean, default=False)
     is_verified = Column(Boolean, default=True)
 
-    verification_code = Column(String, nullable=True, index=True)
+    # Codes are stored as keyed HMACs (see security.hash_code), which are never looked up, so are not indexed:
+    verification_code = Column(String, nullable=True)
     verification_code_expires = Column(DateTime(timezone=True), nullable=True)
+    verification_code_attempts = Column(Integer, nullable=False, default=0, server_default="0")
 
-    reset_password_code = Column(String, nullable=True, index=True)
+    reset_password_code = Column(String, nullable=True)
     reset_password_code_expires = Column(DateTime(timezone=True), nullable=True)
+    reset_password_code_attempts = Column(Integer, nullable=False, default=0, server_default="0")
     
     created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
 
-    conversations = relationship("Conversation", back_populates="user", cascade="all, delete-orphan")
+    # Set when a large account is being deleted in the background (see user_service.delete_user):
+    deletion_requested_at = Column(DateTime(timezone=True), nullable=True)
+
+    # Child rows are removed by ON DELETE CASCADE rather than loaded by the ORM to be deleted one by one:
+    conversations = relationship("Conversation", back_populates="user", cascade="all, delete-orphan", passive_deletes=True)
 
 
 class Conversation(Base):
     __tablename__ = "conversations"
-    
+    __mapper_args__ = {"eager_defaults": True}
+
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), index=True, nullable=False)
     
     name = Column(String, nullable=False, default="New Conversation")
-    transcript = Column(JSON, nullable=True, default=[])
+
+    # The transcript is stored either as plain JSON or as a compressed blob (see transcript_codec):
+    transcript_json = Column("transcript", JSON, nullable=True, default=[])
+    transcript_blob = Column(LargeBinary, nullable=True)
+
     summary = Column(String, nullable=True, default="")
     
     context = Column(String, nullable=True, default="")
     
     created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
+
+    # Set when the transcript has been moved to the cold archive table:
+    archived_at = Column(DateTime(timezone=True), nullable=True)
     
     user = relationship("User", back_populates="conversations")
+    archive = relationship("ConversationArchive", uselist=False, cascade="all, delete-orphan", passive_deletes=True)
+    search_documents = relationship("SearchDocument", cascade="all, delete-orphan", passive_deletes=True)
+    stats = relationship("ConversationStats", uselist=False, cascade="all, delete-orphan", passive_deletes=True)
+
+    @property
+    def transcript(self):
+        if self.transcript_blob is None: return self.transcript_json
+
+        # Caching the decoded segments against the blob they came from:
+        cached = self.__dict__.get("_decoded_transcript")
+        if cached is None or cached[0] is not self.transcript_blob:
+            cached = (self.transcript_blob, decode_transcript(self.transcript_blob))
+            self.__dict__["_decoded_transcript"] = cached
+        return cached[1]
+
+    @transcript.setter
+    def transcript(self, segments):
+        for column, value in transcript_values(segments).items():
+            setattr(self, column, value)
+
+
+def transcript_values(segments) -> dict:
+    # Column values for storing a transcript with the configured encoding:
+    if compression_enabled():
+        return {"transcript_json": None, "transcript_blob": encode_transcript(segments)}
+    return {"transcript_json": segments, "transcript_blob": None}
+
+
+class ConversationArchive(Base):
+    # Cold storage for transcripts of conversations that have not been updated for a long time:
+    __tablename__ = "conversation_archives"
+
+    conversation_id = Column(Integer, ForeignKey("conversations.id", ondelete="CASCADE"), primary_key=True)
+    transcript_blob = Column(LargeBinary, nullable=False)
+    archived_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+
+class ConversationStats(Base):
+    # Per-speaker analytics of a conversation, updated from transcript diffs rather than recomputed (see stats_service):
+    __tablename__ = "conversation_stats"
+
+    conversation_id = Column(Integer, ForeignKey("conversations.id", ondelete="CASCADE"), primary_key=True)
+    stats = Column(JSON, nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
+
+
+class TokenUsage(Base):
+    # LLM token usage per user, model and (UTC) day, written in batches by the usage service:
+    __tablename__ = "token_usage"
+    __table_args__ = (UniqueConstraint("user_id", "model", "day"),)
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), index=True, nullable=False)
+    model = Column(String, nullable=False)
+    day = Column(Date, nullable=False)
+
+    requests = Column(Integer, nullable=False, default=0)
+    prompt_tokens = Column(Integer, nullable=False, default=0)
+    cached_tokens = Column(Integer, nullable=False, default=0)
+    completion_tokens = Column(Integer, nullable=False, default=0)
+
+
+class UserPreferenceFeatures(Base):
+    # A user's recent interest in each DescriptionCategory as float32 bytes (in enum order), decayed on every update
+    # so that prediction is a single keyed read (see preference_service):
+    __tablename__ = "user_preference_features"
+
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    features = Column(LargeBinary, nullable=False)
+    message_count = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
+
+
+class SegmentTag(Base):
+    # The top topic categories of a final transcript segment, scored once by the tagging worker (see tagging_service).
+    # Removed with their conversation by ON DELETE CASCADE alone, since the table has always had it:
+    __tablename__ = "segment_tags"
+    __table_args__ = (
+        Index("ix_segment_tags_segment", "conversation_id", "segment_id"),
+        Index("ix_segment_tags_user_category", "user_id", "category"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    conversation_id = Column(Integer, ForeignKey("conversations.id", ondelete="CASCADE"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    segment_id = Column(String, nullable=False)
+    category = Column(String, nullable=False)
+    score = Column(Float, nullable=False)
+
+
+class SearchDocument(Base):
+    # One row per searchable piece of text: a conversation's name, its summary, or one transcript segment.
+    # The full-text index itself is created per dialect below (tsvector + GIN on Postgres, FTS5 on SQLite):
+    __tablename__ = "conversation_search_documents"
+
+    id = Column(Integer, primary_key=True)
+    conversation_id = Column(Integer, ForeignKey("conversations.id", ondelete="CASCADE"), index=True, nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), index=True, nullable=False)
+
+    field = Column(String, nullable=False)
+    segment_id = Column(String, nullable=True)
+    content = Column(Text, nullable=False, default="")
+
+    # Sentence embedding of the content as float16 bytes, filled in asynchronously by the embedding worker:
+    embedding = Column(LargeBinary, nullable=True)
+
 
+event.listen(SearchDocument.__table__, "after_create", DDL("""
+    ALTER TABLE conversation_search_documents
+    ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (to_tsvector('english', coalesce(content, ''))) STORED;
+    CREATE INDEX ix_conversation_search_documents_vector ON conversation_search_documents USING GIN (search_vector);
+""").execute_if(dialect="postgresql"))
 
+# SQLite runs one statement per DDL, and keeps the external-content FTS5 table in sync through triggers:
+for statement in (
+    """CREATE VIRTUAL TABLE conversation_search_fts USING fts5(
+        content, content='conversation_search_documents', content_rowid='id'
+    )""",
+    """CREATE TRIGGER conversation_search_documents_ai AFTER INSERT ON conversation_search_documents BEGIN
+        INSERT INTO conversation_search_fts(rowid, content) VALUES (new.id, new.content);
+    END""",
+    """CREATE TRIGGER conversation_search_documents_ad AFTER DELETE ON conversation_search_documents BEGIN
+        INSERT INTO conversation_search_fts(conversation_search_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END""",
+    """CREATE TRIGGER conversation_search_documents_au AFTER UPDATE OF content ON conversation_search_documents BEGIN
+        INSERT INTO conversation_search_fts(conversation_search_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO conversation_search_fts(rowid, content) VALUES (new.id, new.content);
+    END""",
+):
+    event.listen(SearchDocument.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
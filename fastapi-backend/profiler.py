@@ -0,0 +1,136 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+from collections import Counter, deque
+from typing import Deque, Dict, Optional, Tuple
+
+import metrics
+
+
+# Upper bound on how long a single on-demand profile may run, so that a forgotten request cannot keep sampling:
+PROFILER_MAX_SECONDS = float(os.getenv("PROFILER_MAX_SECONDS", 60))
+
+# The event loop is reported as blocked when it has not run for this long, where 0 disables the watchdog:
+LOOP_BLOCKED_THRESHOLD_MS = float(os.getenv("LOOP_BLOCKED_THRESHOLD_MS", 500))
+
+LOOP_BLOCKED = metrics.registry.counter("event_loop_blocked_total", "Times the event loop was blocked past the threshold.")
+
+logger = logging.getLogger(__name__)
+
+# Only one profile runs at a time per worker, since sampling itself takes the GIL:
+_profile_lock = threading.Lock()
+
+# The most recent blocked-loop reports, as (time, blocked seconds, stack), for the admin endpoint:
+blocked_loop_reports: Deque[Tuple[float, float, str]] = deque(maxlen=20)
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _collapse(thread_name: str, frame) -> str:
+    # One "root;...;leaf" line per stack, as expected by flamegraph.pl and speedscope:
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    names.append(thread_name)
+    return ";".join(reversed(names))
+
+
+def _thread_cpu_time(native_id: Optional[int]) -> Optional[float]:
+    # Reading the CPU time of a thread by its kernel thread ID from /proc (Linux only), which fails cleanly
+    # when the thread has exited since it was listed, unlike passing its pthread ID to pthread_getcpuclockid:
+    if native_id is None: return None
+    try:
+        with open(f"/proc/self/task/{native_id}/schedstat") as schedstat:
+            return int(schedstat.read().split()[0]) / 1e9
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def cpu_mode_supported() -> bool:
+    return _thread_cpu_time(threading.get_native_id()) is not None
+
+
+def sample_stacks(seconds: float, interval: float, cpu: bool = False) -> Optional[str]:
+    # Sampling every thread in the worker (the event loop and the threadpool alike) from the calling thread.
+    # In CPU mode, a thread is only counted when it used CPU since the previous sample, so threads that are
+    # waiting on locks, sockets or the DB drop out and what is left is where the CPU time goes.
+    # Returns None if another profile is already running:
+    if not _profile_lock.acquire(blocking=False): return None
+    try:
+        own_id = threading.get_ident()
+        stacks: Counter = Counter()
+        cpu_times: Dict[int, float] = {}
+        deadline = time.monotonic() + min(seconds, PROFILER_MAX_SECONDS)
+
+        while time.monotonic() < deadline:
+            threads = {thread.ident: thread for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id: continue
+
+                thread = threads.get(thread_id)
+                if cpu:
+                    now = _thread_cpu_time(thread.native_id if thread is not None else None)
+                    previous = cpu_times.get(thread_id)
+                    if now is not None: cpu_times[thread_id] = now
+                    if now is None or previous is None or now <= previous: continue
+
+                stacks[_collapse(thread.name if thread is not None else f"thread-{thread_id}", frame)] += 1
+            del frame
+            time.sleep(interval)
+
+        return "\n".join(f"{stack} {count}" for stack, count in stacks.most_common())
+    finally:
+        _profile_lock.release()
+
+
+class LoopWatchdog:
+    # A thread that reports the event loop's stack when the loop stops running for longer than the threshold,
+    # which catches synchronous work on the loop (blocking I/O, DB calls, long loops) as it happens:
+
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        self.last_beat = time.monotonic()
+        self.loop_thread_id: Optional[int] = None
+        self._stopped = threading.Event()
+
+    async def heartbeat(self) -> None:
+        self.loop_thread_id = threading.get_ident()
+        thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        thread.start()
+        try:
+            while True:
+                self.last_beat = time.monotonic()
+                await asyncio.sleep(self.threshold / 4)
+        finally:
+            self._stopped.set()
+
+    def _watch(self) -> None:
+        reported = False
+        while not self._stopped.wait(self.threshold / 4):
+            blocked = time.monotonic() - self.last_beat
+            if blocked < self.threshold:
+                reported = False
+                continue
+
+            # Reporting each blocked period once, with the stack at the time it crossed the threshold:
+            if reported: continue
+            reported = True
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None: continue
+
+            stack = "".join(traceback.format_stack(frame))
+            LOOP_BLOCKED.inc()
+            blocked_loop_reports.append((time.time(), blocked, stack))
+            logger.warning("Event loop blocked for %.0f ms at:\n%s", blocked * 1000, stack)
+
+
+async def run_loop_watchdog() -> None:
+    await LoopWatchdog(LOOP_BLOCKED_THRESHOLD_MS / 1000).heartbeat()
@@ -0,0 +1,180 @@
+import os
+import asyncio
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, Dict, List
+
+
+# Where topics live: "local" keeps them in this process, and a redis:// URL shares them between workers and hosts:
+PUBSUB_URL = os.getenv("PUBSUB_URL", "local")
+
+
+class TopicAborted(Exception):
+    # Raised to subscribers when a topic ends without all of its messages, e.g. its producer failed, was cancelled,
+    # or went quiet for longer than the read timeout:
+    pass
+
+
+class PubSub(ABC):
+    # Topics are replayable streams of messages with a single producer. Subscribers receive every message from the start,
+    # then new ones as they are published, until the producer closes the topic.
+    # Listeners are counted across every worker, so that a producer is only cancelled once nobody anywhere is listening:
+
+    @abstractmethod
+    async def claim(self, topic: str, ttl: float) -> bool:
+        # Returns whether the caller is now the topic's only producer, which lasts until it closes the topic (or for ttl):
+        ...
+
+    @abstractmethod
+    async def publish(self, topic: str, message: bytes) -> None:
+        ...
+
+    @abstractmethod
+    async def close(self, topic: str, retain: float, aborted: bool = False) -> None:
+        # Ending the topic, keeping its messages for late subscribers for retain seconds (0 drops them straight away).
+        # Subscribers of an aborted topic get TopicAborted rather than a clean end:
+        ...
+
+    @abstractmethod
+    def subscribe(self, topic: str) -> AsyncIterator[bytes]:
+        ...
+
+    @abstractmethod
+    async def join(self, topic: str, ttl: float) -> None:
+        ...
+
+    @abstractmethod
+    async def leave(self, topic: str) -> int:
+        # Returns how many listeners are left on every worker:
+        ...
+
+    @abstractmethod
+    async def listeners(self, topic: str) -> int:
+        ...
+
+
+class _LocalTopic:
+
+    def __init__(self):
+        self.messages: List[bytes] = []
+        self.closed = False
+        self.aborted = False
+        self.changed = asyncio.Condition()
+
+
+class LocalPubSub(PubSub):
+    # In-process topics, for single-worker deployments and tests:
+
+    def __init__(self):
+        self._topics: Dict[str, _LocalTopic] = {}
+        self._listeners: Dict[str, int] = {}
+
+    async def claim(self, topic: str, ttl: float) -> bool:
+        if topic in self._topics: return False
+        self._topics[topic] = _LocalTopic()
+        return True
+
+    async def publish(self, topic: str, message: bytes) -> None:
+        state = self._topics[topic]
+        async with state.changed:
+            state.messages.append(message)
+            state.changed.notify_all()
+
+    async def close(self, topic: str, retain: float, aborted: bool = False) -> None:
+        state = self._topics.get(topic)
+        if state is None: return
+        async with state.changed:
+            state.closed = True
+            state.aborted = aborted
+            state.changed.notify_all()
+
+        def drop():
+            if self._topics.get(topic) is state: del self._topics[topic]
+
+        if retain > 0:
+            asyncio.get_running_loop().call_later(retain, drop)
+        else:
+            drop()
+
+    async def subscribe(self, topic: str) -> AsyncIterator[bytes]:
+        # A topic that is already gone was dropped without being retained, which only happens to aborted ones:
+        state = self._topics.get(topic)
+        if state is None: raise TopicAborted(topic)
+
+        position = 0
+        while True:
+            async with state.changed:
+                await state.changed.wait_for(lambda: position < len(state.messages) or state.closed)
+                messages = state.messages[position:]
+                closed = state.closed
+            position += len(messages)
+            for message in messages:
+                yield message
+            if closed:
+                if state.aborted: raise TopicAborted(topic)
+                return
+
+    async def join(self, topic: str, ttl: float) -> None:
+        self._listeners[topic] = self._listeners.get(topic, 0) + 1
+
+    async def leave(self, topic: str) -> int:
+        remaining = self._listeners.get(topic, 1) - 1
+        if remaining > 0: self._listeners[topic] = remaining
+        else: self._listeners.pop(topic, None)
+        return max(remaining, 0)
+
+    async def listeners(self, topic: str) -> int:
+        return self._listeners.get(topic, 0)
+
+
+class RedisPubSub(PubSub):
+    # Topics as Redis streams, so that a producer on one worker serves subscribers on every worker:
+
+    def __init__(self, url: str, read_timeout: float = 30):
+        # Imported lazily, so that redis is only needed when it is configured:
+        import redis.asyncio as redis
+        self._redis = redis.from_url(url)
+        self._read_timeout_ms = int(read_timeout * 1000)
+
+    async def claim(self, topic: str, ttl: float) -> bool:
+        return bool(await self._redis.set(f"{topic}:producer", 1, nx=True, ex=max(1, int(ttl))))
+
+    async def publish(self, topic: str, message: bytes) -> None:
+        await self._redis.xadd(topic, {"m": message})
+
+    async def close(self, topic: str, retain: float, aborted: bool = False) -> None:
+        # Subscribers that are still reading need the end marker, so even dropped topics live for a second:
+        pipeline = self._redis.pipeline()
+        pipeline.xadd(topic, {"end": int(aborted)})
+        pipeline.expire(topic, max(1, int(retain)))
+        pipeline.expire(f"{topic}:producer", max(1, int(retain)))
+        await pipeline.execute()
+
+    async def subscribe(self, topic: str) -> AsyncIterator[bytes]:
+        last_id = "0"
+        while True:
+            response = await self._redis.xread({topic: last_id}, block=self._read_timeout_ms)
+            # Giving up when the producer has gone quiet for the whole timeout (e.g. its worker died):
+            if not response: raise TopicAborted(topic)
+            for last_id, fields in response[0][1]:
+                if b"end" in fields:
+                    if fields[b"end"] != b"0": raise TopicAborted(topic)
+                    return
+                yield fields[b"m"]
+
+    async def join(self, topic: str, ttl: float) -> None:
+        # Expiring the count with the claim, so that listeners on workers that died are not counted for ever:
+        pipeline = self._redis.pipeline()
+        pipeline.incr(f"{topic}:listeners")
+        pipeline.expire(f"{topic}:listeners", max(1, int(ttl)))
+        await pipeline.execute()
+
+    async def leave(self, topic: str) -> int:
+        return max(int(await self._redis.decr(f"{topic}:listeners")), 0)
+
+    async def listeners(self, topic: str) -> int:
+        return int(await self._redis.get(f"{topic}:listeners") or 0)
+
+
+def create_pubsub() -> PubSub:
+    if PUBSUB_URL == "local": return LocalPubSub()
+    return RedisPubSub(PUBSUB_URL)
@@ -1,3 +1,5 @@
+import os
+
 from slowapi import Limiter
 from slowapi.util import get_remote_address
 from starlette.requests import Request
@@ -28,4 +30,7 @@ def user_or_ip_key_func(request: Request) -> str:
     return get_remote_address(request)
 
 
-limiter = Limiter(key_func=user_or_ip_key_func, default_limits=["100/second"])
+# Rate limiting can be switched off for load testing:
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+
+limiter = Limiter(key_func=user_or_ip_key_func, default_limits=["100/second"], enabled=RATE_LIMIT_ENABLED)
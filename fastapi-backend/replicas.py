@@ -0,0 +1,156 @@
+import os
+import random
+import asyncio
+import logging
+import threading
+from typing import List, Optional
+
+from cachetools import TTLCache
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session, sessionmaker
+from starlette.concurrency import run_in_threadpool
+
+import metrics
+from database import SessionLocal, _pool_arguments, _record_statement
+
+
+# Comma-separated URIs of read replicas of DB_URI. Without any, every session goes to the primary:
+DB_REPLICA_URIS = [uri.strip() for uri in os.getenv("DB_REPLICA_URIS", "").split(",") if uri.strip()]
+
+# Replicas further behind the primary than this (in seconds) are not read from until they catch up:
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", 5))
+REPLICA_CHECK_SECONDS = float(os.getenv("REPLICA_CHECK_SECONDS", 2))
+
+# After writing, a user's reads go to the primary for this long, so that they always see their own writes.
+# Replicas are only used while within REPLICA_MAX_LAG_SECONDS, so this should be at least as long:
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", 10))
+
+READ_SESSIONS = metrics.registry.counter("db_read_sessions_total", "Read-only sessions, by where they were routed and why.")
+REPLICA_LAG = metrics.registry.gauge("db_replica_lag_seconds", "Replication lag of each replica at its last check.")
+
+# How far behind the primary a replica is, per dialect. Dialects without one (e.g. SQLite in tests) report no lag:
+LAG_QUERIES = {
+    "postgresql": """
+        SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END
+    """,
+}
+
+logger = logging.getLogger(__name__)
+
+
+def _reject_writes(session, flush_context, instances) -> None:
+    raise RuntimeError("Read-only sessions cannot write. Use db_dependency for endpoints that write.")
+
+
+class Replica:
+    # A read replica's engine and whether it is currently read from:
+
+    def __init__(self, index: int, uri: str):
+        self.name = f"replica-{index}"
+        self.url = make_url(uri).render_as_string(hide_password=True)
+        self.engine = create_engine(uri, pool_pre_ping=True, **_pool_arguments(uri))
+        self.sessions = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=self.engine)
+
+        # Not read from until the first check has passed:
+        self.healthy = False
+
+        event.listen(self.sessions, "before_flush", _reject_writes)
+        event.listen(self.engine, "handle_error", self._on_error)
+        if metrics.METRICS_ENABLED:
+            event.listen(self.engine, "before_cursor_execute", _record_statement)
+
+    def _on_error(self, context) -> None:
+        # Taking the replica out of rotation as soon as it cannot be reached, rather than at the next check:
+        if context.is_disconnect or isinstance(context.sqlalchemy_exception, OperationalError):
+            self._set_healthy(False, "it could not be reached")
+
+    def _set_healthy(self, healthy: bool, reason: str) -> None:
+        if healthy != self.healthy:
+            logger.warning("%s (%s) is %s: %s.", self.name, self.url, "back in rotation" if healthy else "out of rotation", reason)
+        self.healthy = healthy
+
+    def check(self) -> None:
+        try:
+            with self.engine.connect() as connection:
+                query = LAG_QUERIES.get(self.engine.dialect.name)
+                lag = float(connection.execute(text(query)).scalar() or 0) if query else 0.0
+        except Exception as e:
+            self._set_healthy(False, f"the health check failed ({type(e).__name__})")
+            return
+
+        REPLICA_LAG.set(lag, replica=self.name)
+        if lag > REPLICA_MAX_LAG_SECONDS:
+            self._set_healthy(False, f"it is {lag:.1f}s behind")
+        else:
+            self._set_healthy(True, f"it is {lag:.1f}s behind")
+
+
+replicas: List[Replica] = [Replica(index, uri) for index, uri in enumerate(DB_REPLICA_URIS)]
+
+# Users who wrote within READ_YOUR_WRITES_SECONDS. Pins are per worker process, so deployments with several
+# workers should route each user to the same worker (or accept that a read on another worker may briefly lag):
+_pinned_users: TTLCache = TTLCache(maxsize=100_000, ttl=READ_YOUR_WRITES_SECONDS)
+_pinned_lock = threading.Lock()
+
+
+def pin_to_primary(user_id: int) -> None:
+    with _pinned_lock:
+        _pinned_users[user_id] = True
+
+
+def read_session(user_id: Optional[int] = None) -> Session:
+    # A session for reads that may be slightly stale: a healthy replica, or the primary when the user has written
+    # recently or no replica is usable:
+    if not replicas: return SessionLocal()
+
+    with _pinned_lock:
+        pinned = user_id is not None and user_id in _pinned_users
+    if pinned:
+        READ_SESSIONS.inc(target="primary", reason="recent_write")
+        return SessionLocal()
+
+    healthy = [replica for replica in replicas if replica.healthy]
+    if not healthy:
+        READ_SESSIONS.inc(target="primary", reason="no_healthy_replica")
+        return SessionLocal()
+
+    replica = random.choice(healthy)
+    READ_SESSIONS.inc(target=replica.name, reason="replica")
+    return replica.sessions()
+
+
+# Noting which primary sessions wrote, through the ORM or through bulk statements, and pinning their user on commit.
+# The user is the one authenticated for the session (see dependencies.get_user):
+def _note_flush(session, flush_context) -> None:
+    session.info["wrote"] = True
+
+
+def _note_statement(orm_execute_state) -> None:
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info["wrote"] = True
+
+
+def _pin_writer(session) -> None:
+    if session.info.pop("wrote", False) and session.info.get("user_id") is not None:
+        pin_to_primary(session.info["user_id"])
+
+
+def _forget_writes(session) -> None:
+    session.info.pop("wrote", None)
+
+
+if replicas:
+    event.listen(SessionLocal, "after_flush", _note_flush)
+    event.listen(SessionLocal, "do_orm_execute", _note_statement)
+    event.listen(SessionLocal, "after_commit", _pin_writer)
+    event.listen(SessionLocal, "after_rollback", _forget_writes)
+
+
+async def monitor_replicas() -> None:
+    while True:
+        for replica in replicas:
+            await run_in_threadpool(replica.check)
+        await asyncio.sleep(REPLICA_CHECK_SECONDS)
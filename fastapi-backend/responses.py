@@ -0,0 +1,37 @@
+from typing import Any, Dict, Iterable, Optional
+
+import orjson
+from fastapi.responses import Response
+
+
+def dumps(content: Any) -> bytes:
+    # orjson serializes datetimes (UTC as "Z", like Pydantic) and numpy types natively, and much faster than the stdlib:
+    return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_UTC_Z)
+
+
+def splice_json(fields: Dict[str, Any], raw_fields: Dict[str, Optional[bytes]]) -> bytes:
+    # Serializing the fields normally, then appending fields that are already JSON (e.g. stored transcripts) verbatim:
+    body = dumps(fields)
+    if not raw_fields: return body
+
+    spliced = b"".join(
+        b"," + dumps(name) + b":" + (raw if raw is not None else b"null")
+        for name, raw in raw_fields.items()
+    )
+    # Dropping the leading comma when there are no normal fields:
+    return body[:-1] + (spliced[1:] if body == b"{}" else spliced) + b"}"
+
+
+class RawJSONResponse(Response):
+    # Response for bodies that have already been serialized to JSON bytes:
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, (bytes, bytearray)): return bytes(content)
+        if isinstance(content, str): return content.encode("utf-8")
+        return dumps(content)
+
+    @classmethod
+    def from_parts(cls, parts: Iterable[bytes], **kwargs) -> "RawJSONResponse":
+        # Building a JSON array from already serialized items:
+        return cls(b"[" + b",".join(parts) + b"]", **kwargs)
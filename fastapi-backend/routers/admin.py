@@ -0,0 +1,38 @@
+from datetime import datetime, UTC
+from typing import Literal
+
+from fastapi import APIRouter, Query
+from fastapi.responses import PlainTextResponse
+from starlette.concurrency import run_in_threadpool
+
+import profiler
+from dependencies import admin_dependency
+from exceptions import ProfilerBusyException, ProfilerUnavailableException
+
+
+router = APIRouter(prefix="/admin", tags=["Admin"])
+
+
+@router.get("/profile", response_class=PlainTextResponse)
+async def profile_worker(
+    admin: admin_dependency,
+    seconds: float = Query(10, gt=0, le=profiler.PROFILER_MAX_SECONDS),
+    interval_ms: float = Query(10, ge=1, le=1000),
+    mode: Literal["wall", "cpu"] = "wall"
+):
+    # Profiling the worker that serves this request, and returning collapsed stacks (one "frames count" per line)
+    # for flamegraph.pl or speedscope. Sampling runs on a threadpool thread, so the event loop keeps serving:
+    if mode == "cpu" and not profiler.cpu_mode_supported(): raise ProfilerUnavailableException
+
+    stacks = await run_in_threadpool(profiler.sample_stacks, seconds, interval_ms / 1000, mode == "cpu")
+    if stacks is None: raise ProfilerBusyException
+    return PlainTextResponse(stacks)
+
+
+@router.get("/loop-stalls", response_class=PlainTextResponse)
+async def get_loop_stalls(admin: admin_dependency):
+    # The most recent times the event loop was blocked past the threshold, with the stack that was blocking it:
+    return PlainTextResponse("\n".join(
+        f"{datetime.fromtimestamp(at, UTC).isoformat()} blocked {blocked * 1000:.0f} ms\n{stack}"
+        for at, blocked, stack in reversed(profiler.blocked_loop_reports)
+    ))
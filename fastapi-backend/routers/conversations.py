@@ -1,16 +1,19 @@
-from fastapi import APIRouter, Path, Body, Request
+from fastapi import APIRouter, Path, Body, Request, Query, WebSocket
 from typing import List
 
 from starlette import status as st
 from starlette.responses import StreamingResponse
+from fastapi.responses import ORJSONResponse
 
-from dependencies import db_dependency, user_dependency
-from services import conversation_service
-from schemas import ConversationResponse, ConversationUpdate
+from dependencies import db_dependency, user_dependency, read_db_dependency, read_user_dependency
+from services import conversation_service, session_service, search_service, embedding_service, stats_service
+from schemas import ConversationResponse, ConversationUpdate, SearchResponse, SimilarMomentsResponse, ConversationStatsResponse
+from responses import RawJSONResponse
 
 router = APIRouter(
     prefix="/conversations",
-    tags=["Conversations"]
+    tags=["Conversations"],
+    default_response_class=ORJSONResponse
 )
 
 
@@ -19,14 +22,40 @@ async def create_conversation(db: db_dependency, user: user_dependency, request:
     return conversation_service.create_conversation(db, user)
 
 
+# Declared before /{conversation_id}, so that "search" is not parsed as a conversation ID:
+@router.get("/search", response_model=SearchResponse)
+async def search_conversations(
+    db: read_db_dependency,
+    user: read_user_dependency,
+    request: Request,
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=100),
+    cursor: str | None = None,
+    category: str | None = Query(None, max_length=50)
+):
+    return search_service.search_conversations(db, user, q, limit, cursor, category)
+
+
+@router.get("/similar", response_model=SimilarMomentsResponse)
+async def find_similar_moments(
+    db: db_dependency,
+    user: user_dependency,
+    request: Request,
+    q: str = Query(..., min_length=1, max_length=1000),
+    k: int = Query(10, ge=1, le=50)
+):
+    return await embedding_service.find_similar_moments(db, user, q, k)
+
+
 @router.get("/{conversation_id}", response_model=ConversationResponse)
-async def get_conversation(db: db_dependency, user: user_dependency, request: Request, conversation_id: int = Path(..., ge=1)):
-    return conversation_service.get_conversation(db, user, conversation_id)
+async def get_conversation(db: read_db_dependency, user: read_user_dependency, request: Request, conversation_id: int = Path(..., ge=1)):
+    # Returning the stored transcript JSON as-is, rather than parsing and re-serializing it:
+    return RawJSONResponse(conversation_service.get_conversation_json(db, user, conversation_id))
 
 
 @router.get("/", response_model=List[ConversationResponse])
-async def get_conversations(db: db_dependency, user: user_dependency, request: Request):
-    return conversation_service.get_conversations(db, user)
+async def get_conversations(db: read_db_dependency, user: read_user_dependency, request: Request):
+    return RawJSONResponse.from_parts(conversation_service.get_conversations_json(db, user))
 
 
 @router.put("/{conversation_id}", response_model=ConversationResponse)
@@ -58,9 +87,36 @@ async def stream_conversation_predictions(
     update_data: ConversationUpdate = Body(...),
 ):
     
-    generator = conversation_service.stream_conversation_predictions(
+    generator = await conversation_service.stream_conversation_predictions(
         db=db,
         user=user,
         update_data=update_data
     )
-    return StreamingResponse(generator, media_type="application/json")
\ No newline at end of file
+    return StreamingResponse(generator, media_type="application/json")
+
+
+@router.get("/{conversation_id}/stats", response_model=ConversationStatsResponse)
+async def get_conversation_stats(db: db_dependency, user: user_dependency, request: Request, conversation_id: int = Path(..., ge=1)):
+    return stats_service.get_conversation_stats(db, user, conversation_id)
+
+
+@router.get("/{conversation_id}/segments/{segment_id}/similar", response_model=SimilarMomentsResponse)
+async def find_moments_like_segment(
+    db: db_dependency,
+    user: user_dependency,
+    request: Request,
+    conversation_id: int = Path(..., ge=1),
+    segment_id: str = Path(...),
+    k: int = Query(10, ge=1, le=50)
+):
+    return await embedding_service.find_moments_like_segment(db, user, conversation_id, segment_id, k)
+
+
+@router.websocket("/{conversation_id}/session")
+async def conversation_session(
+    websocket: WebSocket,
+    conversation_id: int = Path(..., ge=1),
+    token: str = Query(...)
+):
+    # Browsers cannot set headers on WebSocket requests, so the access token is passed as a query parameter:
+    await session_service.run_transcript_session(websocket, conversation_id, token)
@@ -1,9 +1,9 @@
-from fastapi import APIRouter, status as st, BackgroundTasks
+from fastapi import APIRouter, status as st, BackgroundTasks, Response
 from starlette.requests import Request
 
 from rate_limiter import limiter
 from schemas import UserRequest, UserResponse, UserVerificationRequest, UpdateUserRequest, ResetPasswordRequest
-from dependencies import db_dependency, user_dependency, unverified_user_dependency
+from dependencies import db_dependency, user_dependency, unverified_user_dependency, read_user_dependency
 import services.user_service as us
 
 
@@ -29,7 +29,7 @@ async def verify_user(db: db_dependency, user: unverified_user_dependency, verif
 
 
 @router.get("/", response_model=UserResponse, status_code=st.HTTP_200_OK)
-async def read_current_user(user: user_dependency, request: Request):
+async def read_current_user(user: read_user_dependency, request: Request):
     return user
 
 
@@ -38,9 +38,10 @@ def update_user(db: db_dependency, user: user_dependency, user_data: UpdateUserR
     return us.update_user(db, user, user_data.name)
 
 
-@router.delete("/", status_code=st.HTTP_204_NO_CONTENT)
+@router.delete("/", status_code=st.HTTP_204_NO_CONTENT, responses={202: {"description": "Deletion continues in the background."}})
 async def delete_user(db: db_dependency, user: user_dependency, request: Request):
-    us.delete_user(db, user)
+    if not us.delete_user(db, user):
+        return Response(status_code=st.HTTP_202_ACCEPTED)
 
 
 @router.post("/request-password-reset", status_code=st.HTTP_202_ACCEPTED)
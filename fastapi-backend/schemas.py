@@ -1,8 +1,8 @@
 from __future__ import annotations
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Literal, Union
 from datetime import datetime
 
-from pydantic import BaseModel, Field, EmailStr
+from pydantic import BaseModel, Field, EmailStr, ConfigDict, TypeAdapter
 
 
 class AgentResponse(BaseModel):
@@ -59,11 +59,26 @@ class ResetPasswordRequest(BaseModel):
     new_password: str
 
 
+class TranscriptSegment(BaseModel):
+    # Unknown keys are kept, so that fields added by the client are not silently dropped:
+    model_config = ConfigDict(extra="allow")
+
+    id: Union[int, str]
+    text: str = ""
+    speaker: str = ""
+    translations: List[str] = []
+    timestamp: Union[int, float, None] = None
+
+
+# Compiled once and reused wherever transcripts are validated or serialized outside of a request body:
+TRANSCRIPT_ADAPTER = TypeAdapter(List[TranscriptSegment])
+
+
 class ConversationUpdate(BaseModel):
     id: int
     name: Optional[str] = None
     context: Optional[str] = None
-    transcript: Optional[List[Dict[str, Any]]] = None
+    transcript: Optional[List[TranscriptSegment]] = None
     summary: Optional[str] = None
     
 
@@ -71,7 +86,7 @@ class ConversationResponse(BaseModel):
     id: int
     user_id: int
     name: str
-    transcript: List[Dict[str, Any]] | None = None
+    transcript: List[TranscriptSegment] | None = None
     summary: str = ""
     created_at: datetime
     updated_at: datetime
@@ -80,9 +95,63 @@ class ConversationResponse(BaseModel):
         from_attributes = True
 
 
+class SpeakerStats(BaseModel):
+    speaker: str
+    words: int
+    segments: int
+    turns: int
+    talk_time_seconds: float
+    talk_time_share: float
+    words_per_minute: Optional[float] = None
+
+
+class ConversationStatsResponse(BaseModel):
+    conversation_id: int
+    segments: int
+    words: int
+    duration_seconds: float
+    words_per_minute: Optional[float] = None
+    speakers: List[SpeakerStats]
+
+
+class SearchResult(BaseModel):
+    conversation_id: int
+    conversation_name: str
+    field: str
+    segment_id: Optional[str] = None
+    snippet: str
+    rank: float
+
+
+class SearchResponse(BaseModel):
+    results: List[SearchResult]
+    next_cursor: Optional[str] = None
+
+
+class SimilarMoment(BaseModel):
+    conversation_id: int
+    conversation_name: str
+    field: str
+    segment_id: Optional[str] = None
+    text: str
+    score: float
+
+
+class SimilarMomentsResponse(BaseModel):
+    results: List[SimilarMoment]
+
+
 class PredictionResponse(BaseModel):
     text: str
     timestamp: float
     complete: bool = False
     new: bool = True
     error: bool = False
+
+
+class SessionMessage(BaseModel):
+    # Frames sent by the client over a recording session WebSocket:
+    type: Literal["segments", "context", "predict", "flush"] = "segments"
+    segments: List[TranscriptSegment] = []
+    context: Optional[str] = None
+    predict: bool = False
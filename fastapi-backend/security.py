@@ -1,7 +1,12 @@
 import os
-import traceback
+import hmac
+import time
+import hashlib
+import logging
+import threading
 from datetime import datetime, timedelta, UTC
 
+from cachetools import TLRUCache, TTLCache
 from jose import jwt, JWTError
 from passlib.context import CryptContext
 from schemas import DualTokenResponse, AccessTokenResponse
@@ -17,10 +22,44 @@ bcrypt_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 HASH_KEY = os.getenv("HASH_KEY")
 HASH_ALGORITHM = os.getenv("HASH_ALGORITHM")
 
+# Server-side secret for one-time codes. If it is not set, a separate key is derived from HASH_KEY:
+CODE_PEPPER = (os.getenv("CODE_PEPPER") or hmac.new(HASH_KEY.encode(), b"one-time-codes", hashlib.sha256).hexdigest()).encode()
+
 # The time to live for the JWT:
 TOKEN_TTL = timedelta(minutes=int(os.getenv("TOKEN_TTL")))
 REFRESH_TOKEN_TTL = timedelta(minutes=int(os.getenv("REFRESH_TOKEN_TTL")))
 
+# Bounds for the caches of recently verified and recently rejected tokens:
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 10000))
+REJECTED_TOKEN_CACHE_SIZE = int(os.getenv("REJECTED_TOKEN_CACHE_SIZE", 10000))
+REJECTED_TOKEN_CACHE_TTL = int(os.getenv("REJECTED_TOKEN_CACHE_TTL", 60))
+
+logger = logging.getLogger(__name__)
+
+# Verified tokens are mapped to their claims, and each entry expires at the token's own "exp" claim.
+# The cache uses wall-clock time so that the expiry can be compared with the claim directly:
+_verified_tokens = TLRUCache(
+    maxsize=TOKEN_CACHE_SIZE,
+    ttu=lambda token, payload, now: payload["exp"],
+    timer=time.time
+)
+
+# Rejected tokens are remembered briefly, so that clients retrying with a bad token are turned away cheaply:
+_rejected_tokens = TTLCache(maxsize=REJECTED_TOKEN_CACHE_SIZE, ttl=REJECTED_TOKEN_CACHE_TTL, timer=time.time)
+
+# cachetools caches are not thread-safe, and sync dependencies run in the threadpool:
+_token_cache_lock = threading.Lock()
+
+
+def hash_code(user_id: int, purpose: str, code: str) -> str:
+    # One-time codes are short-lived and attempt-limited, so a keyed HMAC protects them without the cost of bcrypt.
+    # Binding the user and purpose means a code cannot be replayed for another user or code type:
+    return hmac.new(CODE_PEPPER, f"{user_id}:{purpose}:{code}".encode(), hashlib.sha256).hexdigest()
+
+
+def verify_code_hash(user_id: int, purpose: str, code: str, code_hash: str) -> bool:
+    return hmac.compare_digest(hash_code(user_id, purpose, code), code_hash)
+
 
 def _create_token(user_id: int, ttl: timedelta = TOKEN_TTL) -> str:
     expiry = datetime.now(UTC) + ttl
@@ -55,13 +94,34 @@ def create_access_token(user_id: int) -> AccessTokenResponse:
     )
 
 
-def decode_token(token: str) -> dict:
+def _verify_token(token: str) -> dict:
     try:
-        payload = jwt.decode(token, HASH_KEY, algorithms=[HASH_ALGORITHM])
-        user_id = payload.get("sub")
-
-        if user_id is None: raise UserNotFoundException
-    except JWTError: 
-        traceback.print_exc()
+        return jwt.decode(token, HASH_KEY, algorithms=[HASH_ALGORITHM])
+    except JWTError as e:
+        # Logging without a traceback, since rejected tokens are expected (e.g. clients retrying after expiry):
+        logger.info("Rejected token: %s", e)
+        with _token_cache_lock:
+            _rejected_tokens[token] = True
         raise JWTException
-    return payload
+
+
+def decode_token(token: str) -> dict:
+    with _token_cache_lock:
+        payload = _verified_tokens.get(token)
+        rejected = payload is None and token in _rejected_tokens
+
+    if rejected: raise JWTException
+
+    if payload is None:
+        payload = _verify_token(token)
+
+        # Only caching tokens that carry an expiry, so that no entry outlives its token:
+        if isinstance(payload.get("exp"), (int, float)):
+            with _token_cache_lock:
+                _verified_tokens[token] = payload
+
+    user_id = payload.get("sub")
+    if user_id is None: raise UserNotFoundException
+
+    # Returning a copy, so that callers cannot modify the cached claims:
+    return dict(payload)
@@ -0,0 +1,108 @@
+import os
+import asyncio
+import logging
+from datetime import datetime, timedelta, UTC
+
+from sqlalchemy import select, update, insert, delete
+from sqlalchemy.orm.attributes import set_committed_value
+from starlette.concurrency import run_in_threadpool
+
+from database import SessionLocal
+from dependencies import db_dependency
+from models import Conversation, ConversationArchive, transcript_values
+from transcript_codec import TRANSCRIPT_COMPRESSION, encode_transcript, decode_transcript
+
+# Conversations not updated for this many days are archived (0 disables the archival job):
+ARCHIVE_AFTER_DAYS = int(os.getenv("TRANSCRIPT_ARCHIVE_AFTER_DAYS", 0))
+ARCHIVE_BATCH_SIZE = int(os.getenv("TRANSCRIPT_ARCHIVE_BATCH_SIZE", 200))
+ARCHIVE_INTERVAL_SECONDS = int(os.getenv("TRANSCRIPT_ARCHIVE_INTERVAL_SECONDS", 3600))
+
+# Archived transcripts are always compressed, even when live ones are stored as plain JSON:
+ARCHIVE_CODEC = "zstd" if TRANSCRIPT_COMPRESSION == "zstd" else "zlib"
+
+logger = logging.getLogger(__name__)
+
+
+def archive_stale_conversations(db: db_dependency, days: int = ARCHIVE_AFTER_DAYS, batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    # Moving one batch of stale transcripts to the archive table, returning how many were moved:
+    cutoff = datetime.now(UTC) - timedelta(days=days)
+    rows = db.execute(
+        select(Conversation.id, Conversation.transcript_json, Conversation.transcript_blob)
+        .where(Conversation.updated_at < cutoff, Conversation.archived_at.is_(None))
+        .limit(batch_size)
+    ).all()
+    if not rows: return 0
+
+    # Repeating the staleness check in the UPDATE, so that a transcript written since the SELECT is left alone,
+    # and only archiving the copies of the rows that were actually cleared:
+    archived_ids = set(db.scalars(
+        update(Conversation)
+        .where(
+            Conversation.id.in_([row.id for row in rows]),
+            Conversation.updated_at < cutoff,
+            Conversation.archived_at.is_(None),
+        )
+        # Keeping updated_at as it was, since archiving is not a user-visible change:
+        .values(transcript_json=None, transcript_blob=None, archived_at=datetime.now(UTC), updated_at=Conversation.updated_at)
+        .returning(Conversation.id)
+        .execution_options(synchronize_session=False)
+    ))
+
+    archives = [
+        {
+            "conversation_id": row.id,
+            # Reusing blobs that are already compressed:
+            "transcript_blob": row.transcript_blob if row.transcript_blob is not None else encode_transcript(
+                row.transcript_json or [], codec=ARCHIVE_CODEC
+            ),
+        }
+        for row in rows if row.id in archived_ids
+    ]
+    if archives: db.execute(insert(ConversationArchive), archives)
+    db.commit()
+    return len(archives)
+
+
+def rehydrate_conversation(db: db_dependency, conversation: Conversation) -> Conversation:
+    # Moving an archived transcript back into the conversation row, using the configured encoding:
+    archive = db.get(ConversationArchive, conversation.id)
+    segments = decode_transcript(archive.transcript_blob) if archive is not None else []
+
+    db.execute(
+        update(Conversation)
+        .where(Conversation.id == conversation.id)
+        .values(**transcript_values(segments), archived_at=None, updated_at=Conversation.updated_at)
+        .execution_options(synchronize_session=False)
+    )
+    db.execute(delete(ConversationArchive).where(ConversationArchive.conversation_id == conversation.id))
+    db.commit()
+
+    # Updating the loaded object to match the statements above, rather than reloading it:
+    for column, value in {**transcript_values(segments), "archived_at": None}.items():
+        set_committed_value(conversation, column, value)
+    return conversation
+
+
+def _archive_all_stale() -> int:
+    db = SessionLocal()
+    try:
+        total = 0
+        while True:
+            moved = archive_stale_conversations(db)
+            total += moved
+            if moved < ARCHIVE_BATCH_SIZE: return total
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+async def run_archival_periodically() -> None:
+    while True:
+        try:
+            moved = await run_in_threadpool(_archive_all_stale)
+            if moved: logger.info("Archived %d stale conversation transcripts.", moved)
+        except Exception:
+            logger.exception("Transcript archival failed.")
+        await asyncio.sleep(ARCHIVE_INTERVAL_SECONDS)
@@ -84,8 +84,9 @@ async def oauth_google_callback(db: db_dependency, request: Request):
             oauth_provider="google"
         )
         db.add(user)
+        db.flush()
+        db.info["user_id"] = user.id
         db.commit()
-        db.refresh(user)
 
     # Generating tokens:
     return create_tokens(user.id)
@@ -1,9 +1,29 @@
+import os
+import asyncio
+import hashlib
+import logging
 from datetime import datetime
-from typing import List, Dict, Any, AsyncGenerator
-import json
-from models import Conversation
-from .llm_service import send_message, stream_message
-from llm_context import PREDICTION_CONTEXT
+from typing import List, Dict, Any, AsyncGenerator, Callable, Optional, Set
+import time
+
+from cachetools import TTLCache
+from fastapi import HTTPException
+from sqlalchemy import cast, delete, select, Text
+
+import metrics
+from pubsub import PubSub, TopicAborted, create_pubsub
+from models import Conversation, ConversationArchive, ConversationStats, SearchDocument
+from transcript_codec import decode_transcript
+from .archive_service import rehydrate_conversation
+from .search_service import index_new_conversation, update_search_index
+from .embedding_service import notify_documents_changed
+from .tagging_service import describe_topics, tag_segments
+from .usage_service import check_quota
+from .stats_service import update_conversation_stats, describe_stats
+from .transcript_service import diff_segments, finalized_segments
+from responses import splice_json, dumps
+from .llm_service import admission, send_message, stream_message
+from llm_context import PREDICTION_INSTRUCTIONS, format_prediction_input, format_transcript
 from dependencies import db_dependency, user_dependency
 from exceptions import ConversationNotFoundException
 from schemas import ConversationUpdate, PredictionResponse
@@ -13,15 +33,20 @@ def create_conversation(db: db_dependency, user: user_dependency) -> Conversatio
     # Creating a new conversation with the default values:
     conversation = Conversation(user_id=user.id)
     db.add(conversation)
+    db.flush()
+    index_new_conversation(db, conversation)
     db.commit()
-    db.refresh(conversation)
-    
     return conversation
 
 
 def get_conversation(db: db_dependency, user: user_dependency, conversation_id: int) -> Conversation:
-    conversation = db.query(Conversation).filter_by(id=conversation_id, user_id=user.id).first()
+    with metrics.stage("db_fetch"):
+        conversation = db.query(Conversation).filter_by(id=conversation_id, user_id=user.id).first()
     if not conversation: raise ConversationNotFoundException
+
+    # Transparently bringing archived transcripts back on access:
+    if conversation.archived_at is not None:
+        rehydrate_conversation(db, conversation)
     return conversation
 
 
@@ -29,46 +54,378 @@ def get_conversations(db: db_dependency, user: user_dependency) -> List[Conversa
     return db.query(Conversation).filter_by(user_id=user.id).order_by(Conversation.updated_at.desc()).all()
 
 
-async def update_conversation(db: db_dependency, user: user_dependency, update_data: ConversationUpdate, ai_insights: bool = False) -> Conversation:
+def _raw_conversations_query(db: db_dependency, user: user_dependency):
+    # Selecting the stored transcript as JSON text, so that it can be returned without being parsed:
+    return db.query(
+        Conversation.id,
+        Conversation.user_id,
+        Conversation.name,
+        Conversation.summary,
+        Conversation.created_at,
+        Conversation.updated_at,
+        Conversation.archived_at,
+        cast(Conversation.transcript_json, Text).label("transcript_json"),
+        Conversation.transcript_blob,
+    ).filter(Conversation.user_id == user.id)
+
+
+def _conversation_json(row, blob: bytes = None) -> bytes:
+    fields = {
+        "id": row.id,
+        "user_id": row.user_id,
+        "name": row.name,
+        "summary": row.summary or "",
+        "created_at": row.created_at,
+        "updated_at": row.updated_at,
+    }
+    # Plain JSON transcripts are passed through as-is, and compressed ones are only decoded, never validated:
+    if blob is not None:
+        transcript = dumps(decode_transcript(blob))
+    elif row.transcript_json is not None:
+        transcript = row.transcript_json.encode("utf-8")
+    else:
+        transcript = None
+    return splice_json(fields, {"transcript": transcript})
+
+
+def _with_archived_transcripts(query):
+    return (
+        query.add_columns(ConversationArchive.transcript_blob.label("archived_blob"))
+        .outerjoin(ConversationArchive, ConversationArchive.conversation_id == Conversation.id)
+    )
+
+
+def get_conversation_json(db: db_dependency, user: user_dependency, conversation_id: int) -> bytes:
+    # Passthrough equivalent of get_conversation, returning a serialized ConversationResponse.
+    # Like listing, this reads archived transcripts from the cold table without writing, so that it can run on a replica.
+    # They are moved back when the conversation is next updated:
+    with metrics.stage("db_fetch"):
+        row = _with_archived_transcripts(_raw_conversations_query(db, user)).filter(Conversation.id == conversation_id).first()
+    if not row: raise ConversationNotFoundException
+    return _conversation_json(row, row.transcript_blob or row.archived_blob)
+
+
+def get_conversations_json(db: db_dependency, user: user_dependency) -> List[bytes]:
+    # Listing reads archived transcripts from the cold table without moving them back:
+    rows = (
+        _with_archived_transcripts(_raw_conversations_query(db, user))
+        .order_by(Conversation.updated_at.desc())
+        .all()
+    )
+    return [_conversation_json(row, row.transcript_blob or row.archived_blob) for row in rows]
+
+
+async def update_conversation(
+    db: db_dependency,
+    user: user_dependency,
+    update_data: ConversationUpdate,
+    ai_insights: bool = False,
+    speculate: bool = True
+) -> Conversation:
+    # Callers about to stream the prediction for the update themselves pass speculate=False, so that their request
+    # produces (and can cancel) its own upstream stream rather than attaching to a speculative one:
     conversation = get_conversation(db, user, update_data.id)
+    previous_transcript, previous_name, previous_summary = conversation.transcript, conversation.name, conversation.summary
         
     for field, value in update_data.model_dump(exclude_unset=True).items():
         setattr(conversation, field, value)
 
     if ai_insights:
-        result = await send_message(user, json.dumps(conversation.transcript))
+        result = await send_message(user, format_transcript(conversation.transcript))
         conversation.summary = result.summary
+
+    # Keeping the search index and stats in step with the changed segments, name and summary:
+    diff = diff_segments(previous_transcript, conversation.transcript)
+    update_conversation_stats(db, conversation, diff)
+    documents_removed = update_search_index(
+        db,
+        conversation.id,
+        user.id,
+        diff,
+        name=conversation.name if conversation.name != previous_name else None,
+        summary=conversation.summary if conversation.summary != previous_summary else None
+    )
         
     conversation.updated_at = datetime.now()
     
-    db.commit()
-    db.refresh(conversation)
+    with metrics.stage("db_commit"):
+        db.commit()
+
+    notify_documents_changed(user.id, removed=documents_removed)
+    tag_segments(user.id, conversation.id, diff)
+
+    if speculate and SPECULATIVE_PREDICTIONS_ENABLED and finalized_segments(diff):
+        speculator.speculate(
+            user, conversation.id, conversation.transcript, conversation.context, conversation.stats.stats,
+            describe_topics(db, conversation.id)
+        )
     
     return conversation
 
 
+def delete_conversation_rows(db: db_dependency, conversation_ids) -> int:
+    # Deleting conversations (given as IDs or a SELECT of IDs) and their rows with one DELETE per table, loading nothing.
+    # Children are deleted explicitly as well as by ON DELETE CASCADE, since tables created before the cascades lack it:
+    for model in (SearchDocument, ConversationStats, ConversationArchive):
+        db.execute(delete(model).where(model.conversation_id.in_(conversation_ids)))
+    return db.execute(delete(Conversation).where(Conversation.id.in_(conversation_ids))).rowcount
+
+
 def delete_conversation(db: db_dependency, user: user_dependency, conversation_id: int) -> None:
-    conversation = get_conversation(db, user, conversation_id)
-    
-    db.delete(conversation)
+    # Checking ownership in the DELETE itself, rather than loading the transcript and its search documents first:
+    owned = select(Conversation.id).where(Conversation.id == conversation_id, Conversation.user_id == user.id)
+    if not delete_conversation_rows(db, owned): raise ConversationNotFoundException
+
     db.commit()
+    notify_documents_changed(user.id, removed=True)
 
 
 async def stream_conversation_predictions(
     db: db_dependency,
     user: user_dependency, 
     update_data: ConversationUpdate = None
-) -> AsyncGenerator[str, None]:
-    
-    get_conversation(db, user, update_data.id)
-    conversation = await update_conversation(db, user, update_data, update_data)
+) -> AsyncGenerator[bytes, None]:
+    # Rejecting users over their daily quota before any work is done, from the in-memory usage totals where they are fresh:
+    await check_quota(user)
+
+    # Persisting the update before the response starts, so that errors are returned as normal HTTP errors
+    # and the DB stages are reported in the Server-Timing header:
+    conversation = await update_conversation(db, user, update_data, speculate=False)
     
-    transcript_string = json.dumps(conversation.transcript)
-    messages = [
-        {"role": "system", "content": f"{PREDICTION_CONTEXT.format(transcript=transcript_string, context=conversation.context)}\nAdditional context: {conversation.context}"},
+    with metrics.stage("prompt_build"):
+        messages = build_prediction_messages(
+            conversation.transcript, conversation.context, describe_stats(conversation.stats.stats), describe_topics(db, conversation.id)
+        )
+
+    # Devices viewing the same revision of the conversation share one upstream stream, which may already have been
+    # started speculatively when the revision's segments were finalized:
+    topic = prediction_topic(user.id, conversation.id, conversation.transcript, conversation.context)
+    return prediction_broadcaster.stream(topic, lambda: stream_message(user, messages))
+
+
+def prediction_topic(user_id: int, conversation_id: int, transcript: List[Dict[str, Any]], context: str) -> str:
+    # Tagging the topic with a hash of the transcript and context, so that it only matches the same revision of the
+    # conversation. Stats and topics are derived (topics asynchronously), so they are left out of the revision:
+    revision = hashlib.blake2b(f"{context}\n{format_transcript(transcript)}".encode(), digest_size=16).hexdigest()
+    return f"predictions:{user_id}:{conversation_id}:{revision}"
+
+
+def build_prediction_messages(transcript: List[Dict[str, Any]], context: str, stats: str = "", topics: str = "") -> List[Dict[str, str]]:
+    # Static instructions first and the growing transcript last, so consecutive requests share a cacheable prefix:
+    return [
+        {"role": "system", "content": PREDICTION_INSTRUCTIONS},
+        {"role": "user", "content": format_prediction_input(transcript, context, stats, topics)},
     ]
-    
-    async for prediction_chunk in stream_message(user, messages):
-        result = json.dumps(prediction_chunk)
-        print(f"\n\nGOT PREDICTION CHUNK: {result}\n\n")
-        yield result + "\n"
\ No newline at end of file
+
+
+# Finished predictions are replayed to devices that ask for the same revision within this many seconds:
+PREDICTION_REPLAY_SECONDS = float(os.getenv("PREDICTION_REPLAY_SECONDS", 30))
+
+# Longest a producer can hold a revision, in case its worker dies before closing it:
+PREDICTION_CLAIM_SECONDS = float(os.getenv("PREDICTION_CLAIM_SECONDS", 120))
+
+# Sent in place of the rest of a shared prediction whose producer failed or was cancelled, so that it does not look complete:
+PREDICTION_INTERRUPTED_MESSAGE = "The prediction was interrupted. Please try again."
+
+# Streamed chunks are logged at DEBUG through their own logger, which is sampled (see logging_config.LOG_SAMPLE_RATES):
+chunk_logger = logging.getLogger(f"{__name__}.chunks")
+
+SHARED_PREDICTIONS = metrics.registry.counter(
+    "prediction_streams_shared_total", "Prediction requests served from another request's upstream stream."
+)
+
+# Speculative predictions: when an update finalizes segments, the prediction for the new revision is started in the
+# background, so that the request for it attaches to the stream (or replays its result) instead of waiting for the TTFT:
+SPECULATIVE_PREDICTIONS_ENABLED = os.getenv("SPECULATIVE_PREDICTIONS_ENABLED", "false").lower() == "true"
+
+# Speculative runs start at most this often per conversation (later revisions wait for the interval, replacing each
+# other), at most this many times per user per hour, and never while upstream calls are queueing for a slot:
+SPECULATION_MIN_INTERVAL_SECONDS = float(os.getenv("SPECULATION_MIN_INTERVAL_SECONDS", 5))
+SPECULATIONS_PER_USER_PER_HOUR = int(os.getenv("SPECULATIONS_PER_USER_PER_HOUR", 120))
+
+# Speculative results are kept longer than shared ones, since the request for them may come well after the update:
+SPECULATION_RETAIN_SECONDS = float(os.getenv("SPECULATION_RETAIN_SECONDS", 120))
+
+SPECULATIONS = metrics.registry.counter("prediction_speculations_total", "Speculative prediction runs, by outcome.")
+
+
+class PredictionBroadcaster:
+    # Fans one upstream prediction stream out to every request for the same topic (user, conversation and revision).
+    # The first request produces it into the pub/sub topic, and later ones replay what was produced, then follow along:
+
+    def __init__(self, pubsub: PubSub):
+        self.pubsub = pubsub
+        self._producers: Dict[str, asyncio.Task] = {}
+        # Producers started without a listener (see PredictionSpeculator), which keep running when listeners leave:
+        self._detached: Set[str] = set()
+
+    async def start(
+        self,
+        topic: str,
+        predictions: Callable[[], AsyncGenerator[dict, None]],
+        retain: float = PREDICTION_REPLAY_SECONDS,
+        detached: bool = False
+    ) -> Optional[asyncio.Task]:
+        # Returns the started producer, or None when the topic is already being produced (or retained) elsewhere:
+        if not await self.pubsub.claim(topic, PREDICTION_CLAIM_SECONDS): return None
+        producer = self._producers[topic] = asyncio.create_task(self._produce(topic, predictions(), retain))
+        if detached: self._detached.add(topic)
+        return producer
+
+    async def stream(self, topic: str, predictions: Callable[[], AsyncGenerator[dict, None]]) -> AsyncGenerator[bytes, None]:
+        if await self.start(topic, predictions) is None:
+            SHARED_PREDICTIONS.inc()
+
+        await self.pubsub.join(topic, PREDICTION_CLAIM_SECONDS)
+        try:
+            async for message in self.pubsub.subscribe(topic):
+                yield message
+        except TopicAborted:
+            yield dumps({
+                "text": PREDICTION_INTERRUPTED_MESSAGE,
+                "timestamp": datetime.now().timestamp(),
+                "complete": True,
+                "error": True,
+                "new": True
+            }) + b"\n"
+        finally:
+            # Closing the upstream stream once nobody on any worker is listening, as before sharing.
+            # (A producer on another worker is left to finish, and its result is kept for replay):
+            remaining = await self.pubsub.leave(topic)
+            if not remaining and topic not in self._detached: self._cancel(topic)
+
+    async def abandon(self, topic: str) -> None:
+        # Cancelling the topic's producer on this worker, unless a request on any worker is listening to it:
+        if not await self.pubsub.listeners(topic): self._cancel(topic)
+
+    def _cancel(self, topic: str) -> None:
+        producer = self._producers.get(topic)
+        if producer is not None and not producer.done():
+            producer.cancel()
+
+    async def _produce(self, topic: str, predictions: AsyncGenerator[dict, None], retain: float) -> None:
+        failed = aborted = False
+
+        async def watched():
+            nonlocal failed
+            async for chunk in predictions:
+                failed = failed or bool(chunk.get("error"))
+                yield chunk
+
+        try:
+            async for line in _serialize_predictions(watched()):
+                await self.pubsub.publish(topic, line)
+        except BaseException:
+            # Cancelled or failed before the end, which subscribers must not mistake for a complete prediction:
+            aborted = True
+            raise
+        finally:
+            # Errors (including "busy") are not replayed, so that the next request tries again:
+            await self.pubsub.close(topic, 0 if failed or aborted else retain, aborted=aborted)
+            self._producers.pop(topic, None)
+            self._detached.discard(topic)
+
+
+prediction_broadcaster = PredictionBroadcaster(create_pubsub())
+
+
+class PredictionSpeculator:
+    # Starts the prediction for a conversation's latest finalized revision in the background. Only the latest revision
+    # is worth precomputing, so a newer one replaces the deferred or in-flight run for an older one:
+
+    def __init__(self, broadcaster: PredictionBroadcaster):
+        self.broadcaster = broadcaster
+        # The topic of each conversation's in-flight speculative run, and when its last run was scheduled:
+        self._in_flight: Dict[int, str] = {}
+        self._last_scheduled: TTLCache = TTLCache(maxsize=100_000, ttl=SPECULATION_MIN_INTERVAL_SECONDS)
+        self._deferred: Dict[int, asyncio.TimerHandle] = {}
+        # Runs started per (user, hour):
+        self._hourly_runs: TTLCache = TTLCache(maxsize=100_000, ttl=3600)
+        self._tasks: Set[asyncio.Task] = set()
+
+    def speculate(
+        self,
+        user: user_dependency,
+        conversation_id: int,
+        transcript: List[Dict[str, Any]],
+        context: str,
+        stats: dict,
+        topics: str = ""
+    ) -> None:
+        if not SPECULATIVE_PREDICTIONS_ENABLED: return
+        # Building the prompt straight away, since the transcript may change before a deferred run starts:
+        messages = build_prediction_messages(transcript, context, describe_stats(stats), topics)
+        topic = prediction_topic(user.id, conversation_id, transcript, context)
+
+        deferred = self._deferred.pop(conversation_id, None)
+        if deferred is not None: deferred.cancel()
+
+        last = self._last_scheduled.get(conversation_id)
+        if last is not None:
+            delay = last + SPECULATION_MIN_INTERVAL_SECONDS - time.monotonic()
+            self._deferred[conversation_id] = asyncio.get_running_loop().call_later(
+                delay, self._schedule, user, conversation_id, topic, messages
+            )
+            SPECULATIONS.inc(outcome="deferred")
+            return
+        self._schedule(user, conversation_id, topic, messages)
+
+    def _schedule(self, user: user_dependency, conversation_id: int, topic: str, messages: List[Dict[str, str]]) -> None:
+        self._deferred.pop(conversation_id, None)
+        self._last_scheduled[conversation_id] = time.monotonic()
+        task = asyncio.create_task(self._run(user, conversation_id, topic, messages))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, user: user_dependency, conversation_id: int, topic: str, messages: List[Dict[str, str]]) -> None:
+        hour = (user.id, int(time.time() // 3600))
+        if self._hourly_runs.get(hour, 0) >= SPECULATIONS_PER_USER_PER_HOUR:
+            SPECULATIONS.inc(outcome="user_limit")
+            return
+        # Leaving upstream capacity to requests someone is waiting for:
+        if admission.queued:
+            SPECULATIONS.inc(outcome="busy")
+            return
+        try:
+            await check_quota(user)
+        except HTTPException:
+            SPECULATIONS.inc(outcome="quota")
+            return
+
+        producer = await self.broadcaster.start(
+            topic, lambda: stream_message(user, messages), retain=SPECULATION_RETAIN_SECONDS, detached=True
+        )
+        if producer is None:
+            SPECULATIONS.inc(outcome="exists")
+            return
+
+        # Nobody will ask for the previous revision now, so stopping its run unless a request is already following it:
+        previous = self._in_flight.get(conversation_id)
+        if previous is not None: await self.broadcaster.abandon(previous)
+        self._in_flight[conversation_id] = topic
+        producer.add_done_callback(lambda _: self._finished(conversation_id, topic))
+
+        self._hourly_runs[hour] = self._hourly_runs.get(hour, 0) + 1
+        SPECULATIONS.inc(outcome="started")
+
+    def _finished(self, conversation_id: int, topic: str) -> None:
+        if self._in_flight.get(conversation_id) == topic: del self._in_flight[conversation_id]
+
+
+speculator = PredictionSpeculator(prediction_broadcaster)
+
+
+async def _serialize_predictions(predictions: AsyncGenerator[dict, None]) -> AsyncGenerator[bytes, None]:
+    serialization_seconds = 0.0
+
+    async for prediction_chunk in predictions:
+        start = time.perf_counter()
+        result = dumps(prediction_chunk)
+        serialization_seconds += time.perf_counter() - start
+
+        if chunk_logger.isEnabledFor(logging.DEBUG):
+            chunk_logger.debug("Prediction chunk: %s", result.decode())
+        yield result + b"\n"
+
+    # Recording the serialization time once per stream rather than once per chunk:
+    metrics.record_stage("serialization", serialization_seconds)
\ No newline at end of file
@@ -1,5 +1,5 @@
 import os
-import traceback
+import logging
 
 import boto3
 from botocore.exceptions import ClientError
@@ -10,6 +10,8 @@ from exceptions import APIRequestException
 AWS_REGION = os.getenv("AWS_REGION")
 SENDER_EMAIL = os.getenv("SENDER_EMAIL")
 
+logger = logging.getLogger(__name__)
+
 
 def send_email(recipient: str, subject: str, body: str) -> None:
     charset = "UTF-8"
@@ -35,5 +37,5 @@ def send_email(recipient: str, subject: str, body: str) -> None:
             Source=SENDER_EMAIL
         )
     except ClientError:
-        traceback.print_exc()
+        logger.exception("Sending email %r failed.", subject)
         raise APIRequestException
\ No newline at end of file
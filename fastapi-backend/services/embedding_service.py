@@ -0,0 +1,399 @@
+import os
+import asyncio
+import logging
+import threading
+from collections import defaultdict
+from typing import Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+from cachetools import TTLCache
+from sqlalchemy import select, update
+from starlette.concurrency import run_in_threadpool
+
+import metrics
+from database import SessionLocal
+from dependencies import db_dependency, user_dependency
+from exceptions import SemanticSearchUnavailableException, SegmentNotFoundException
+from models import Conversation, SearchDocument
+from schemas import SimilarMoment, SimilarMomentsResponse
+
+
+SEMANTIC_SEARCH_ENABLED = os.getenv("SEMANTIC_SEARCH_ENABLED", "false").lower() == "true"
+
+# New documents are embedded in batches of up to this size, at most this often:
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 128))
+EMBEDDING_INTERVAL_SECONDS = float(os.getenv("EMBEDDING_INTERVAL_SECONDS", 1))
+
+# Output size of all-MiniLM-L6-v2, used when a user has no embeddings yet:
+EMBEDDING_DIMENSION = int(os.getenv("EMBEDDING_DIMENSION", 384))
+EMBEDDING_DTYPE = np.float16
+
+# Users with more embeddings than this are searched through an approximate (IVF) index rather than exhaustively:
+EXACT_SEARCH_MAX_ROWS = int(os.getenv("SEMANTIC_EXACT_SEARCH_MAX_ROWS", 50000))
+IVF_PROBES = int(os.getenv("SEMANTIC_IVF_PROBES", 8))
+
+# Shards stay in memory per user. Appends from this process are applied in place, and the TTL bounds
+# how stale a shard can be when another worker process embedded new documents:
+SHARD_CACHE_SIZE = int(os.getenv("SEMANTIC_SHARD_CACHE_SIZE", 256))
+SHARD_CACHE_TTL = int(os.getenv("SEMANTIC_SHARD_CACHE_TTL", 300))
+
+# Names are left to full-text search, since they are too short to embed meaningfully:
+EMBEDDED_FIELDS = ("segment", "summary")
+
+# Scoring in blocks bounds the float32 working memory, however large the shard:
+_SCORE_BLOCK_ROWS = 8192
+
+EMBEDDED_DOCUMENTS = metrics.registry.counter("semantic_embeddings_total", "Search documents embedded for semantic search.")
+
+logger = logging.getLogger(__name__)
+
+
+def _score(vectors: np.ndarray, query: np.ndarray) -> np.ndarray:
+    scores = np.empty(len(vectors), dtype=np.float32)
+    for start in range(0, len(vectors), _SCORE_BLOCK_ROWS):
+        block = vectors[start:start + _SCORE_BLOCK_ROWS]
+        scores[start:start + len(block)] = block.astype(np.float32) @ query
+    return scores
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    k = min(k, len(scores))
+    if k <= 0: return np.zeros(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+class IVFIndex:
+    # Inverted-file index: rows are grouped by their nearest k-means centroid,
+    # and a query only scores the rows in the groups with the closest centroids:
+
+    def __init__(self, centroids: np.ndarray, lists: List[np.ndarray], built_size: int):
+        self.centroids = centroids
+        self.lists = lists
+        self.built_size = built_size
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, iterations: int = 10) -> "IVFIndex":
+        rng = np.random.default_rng(0)
+        n_lists = int(np.clip(np.sqrt(len(vectors)), 16, 4096))
+
+        # Training spherical k-means on a sample, since centroids only need to be roughly right:
+        sample = vectors[np.sort(rng.choice(len(vectors), min(len(vectors), n_lists * 64), replace=False))].astype(np.float32)
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            counts = np.bincount(assignment, minlength=n_lists)
+            # Keeping the previous centroid for groups that ended up empty:
+            sums[counts == 0] = centroids[counts == 0]
+            centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+
+        assignment = cls._assign(centroids, vectors)
+        order = np.argsort(assignment, kind="stable")
+        bounds = np.searchsorted(assignment[order], np.arange(n_lists + 1))
+        lists = [order[bounds[index]:bounds[index + 1]] for index in range(n_lists)]
+        return cls(centroids, lists, len(vectors))
+
+    @staticmethod
+    def _assign(centroids: np.ndarray, vectors: np.ndarray) -> np.ndarray:
+        assignment = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), _SCORE_BLOCK_ROWS):
+            block = vectors[start:start + _SCORE_BLOCK_ROWS].astype(np.float32)
+            assignment[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        return assignment
+
+    def is_stale(self, size: int) -> bool:
+        # Rebuilding once the shard has doubled, since centroids trained on old data drift from new data:
+        return size > 2 * self.built_size
+
+    def add(self, rows: np.ndarray, vectors: np.ndarray) -> None:
+        assignment = self._assign(self.centroids, vectors)
+        for group in np.unique(assignment):
+            self.lists[group] = np.concatenate([self.lists[group], rows[assignment == group]])
+
+    def candidates(self, query: np.ndarray, probes: int) -> np.ndarray:
+        nearest = _top_k(self.centroids @ query, probes)
+        return np.concatenate([self.lists[group] for group in nearest])
+
+
+class EmbeddingShard:
+    # One user's embeddings as a single contiguous float16 matrix, with the search document ID of each row:
+
+    def __init__(self, dimension: int, capacity: int = 1024):
+        self.size = 0
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.vectors = np.zeros((capacity, dimension), dtype=EMBEDDING_DTYPE)
+        self._index: Optional[IVFIndex] = None
+        self._lock = threading.Lock()
+
+    def append(self, ids: np.ndarray, vectors: np.ndarray) -> None:
+        with self._lock:
+            end = self.size + len(ids)
+
+            # Growing by doubling into new arrays, so that searches holding the old arrays are unaffected:
+            if end > len(self.ids):
+                capacity = max(end, 2 * len(self.ids))
+                grown_ids = np.zeros(capacity, dtype=np.int64)
+                grown_vectors = np.zeros((capacity, self.vectors.shape[1]), dtype=EMBEDDING_DTYPE)
+                grown_ids[:self.size] = self.ids[:self.size]
+                grown_vectors[:self.size] = self.vectors[:self.size]
+                self.ids, self.vectors = grown_ids, grown_vectors
+
+            self.ids[self.size:end] = ids
+            self.vectors[self.size:end] = vectors
+            if self._index is not None:
+                self._index.add(np.arange(self.size, end), vectors)
+            self.size = end
+
+    def needs_index(self) -> bool:
+        with self._lock:
+            return self.size > EXACT_SEARCH_MAX_ROWS and (self._index is None or self._index.is_stale(self.size))
+
+    def build_index(self) -> None:
+        # Run by the embedding worker, so that neither appends nor searches wait for k-means. The rows appended
+        # while the index was being built are added to it before it is swapped in:
+        with self._lock:
+            size, vectors = self.size, self.vectors
+        index = IVFIndex.build(vectors[:size])
+        with self._lock:
+            if self.size > size:
+                index.add(np.arange(size, self.size), self.vectors[size:self.size])
+            self._index = index
+
+    def search(self, query: np.ndarray, k: int, exclude_id: Optional[int] = None) -> List[Tuple[int, float]]:
+        with self._lock:
+            size, ids, vectors = self.size, self.ids, self.vectors
+            # Large shards are searched exhaustively until the worker has built their index:
+            index = self._index if size > EXACT_SEARCH_MAX_ROWS else None
+
+        # Scoring every row for small shards, and only the probed groups for large ones:
+        if index is None:
+            rows = np.arange(size)
+            scores = _score(vectors[:size], query)
+        else:
+            # Appends carry on adding rows to the index after the arrays were taken, which these arrays may not have:
+            rows = index.candidates(query, IVF_PROBES)
+            rows = rows[rows < size]
+            scores = _score(vectors[rows], query)
+
+        if exclude_id is not None:
+            scores[ids[rows] == exclude_id] = -np.inf
+
+        return [(int(ids[rows[position]]), float(scores[position])) for position in _top_k(scores, k)
+                if np.isfinite(scores[position])]
+
+
+_shards = TTLCache(maxsize=SHARD_CACHE_SIZE, ttl=SHARD_CACHE_TTL)
+_shards_lock = threading.Lock()
+
+_pending_users: Set[int] = set()
+_pending_lock = threading.Lock()
+
+
+def _extractor():
+    # Imported lazily, so that sentence-transformers is only needed when semantic search is enabled:
+    from .ml_services.keyword_extraction import KeywordExtractor
+    return KeywordExtractor()
+
+
+def _cached_shard(user_id: int) -> Optional[EmbeddingShard]:
+    with _shards_lock:
+        return _shards.get(user_id)
+
+
+def _load_shard(db: db_dependency, user_id: int) -> EmbeddingShard:
+    rows = db.execute(
+        select(SearchDocument.id, SearchDocument.embedding)
+        .where(SearchDocument.user_id == user_id, SearchDocument.embedding.is_not(None))
+        .order_by(SearchDocument.id)
+    ).all()
+
+    dimension = len(rows[0].embedding) // np.dtype(EMBEDDING_DTYPE).itemsize if rows else EMBEDDING_DIMENSION
+    shard = EmbeddingShard(dimension, capacity=max(1024, len(rows)))
+    if rows:
+        vectors = np.frombuffer(b"".join(row.embedding for row in rows), dtype=EMBEDDING_DTYPE).reshape(len(rows), dimension)
+        shard.append(np.fromiter((row.id for row in rows), dtype=np.int64, count=len(rows)), vectors)
+
+    with _shards_lock:
+        _shards[user_id] = shard
+    return shard
+
+
+def notify_documents_changed(user_id: int, removed: bool = False) -> None:
+    # Called after commits that changed a user's search documents. New documents are picked up by the worker,
+    # and removed ones are dropped from memory by reloading the shard on its next search:
+    if not SEMANTIC_SEARCH_ENABLED: return
+
+    with _pending_lock:
+        _pending_users.add(user_id)
+    if removed:
+        with _shards_lock:
+            _shards.pop(user_id, None)
+
+
+def _embed_pending(user_ids: Iterable[int]) -> Set[int]:
+    # Embedding one batch of documents across users, returning the users that may have more left:
+    db = SessionLocal()
+    try:
+        documents = db.execute(
+            select(SearchDocument.id, SearchDocument.user_id, SearchDocument.content)
+            .where(
+                SearchDocument.user_id.in_(list(user_ids)),
+                SearchDocument.embedding.is_(None),
+                SearchDocument.field.in_(EMBEDDED_FIELDS),
+                SearchDocument.content != "",
+            )
+            .order_by(SearchDocument.id)
+            .limit(EMBEDDING_BATCH_SIZE)
+        ).all()
+        if not documents: return set()
+
+        vectors = _extractor().embed([document.content for document in documents]).astype(EMBEDDING_DTYPE)
+        db.execute(update(SearchDocument), [
+            {"id": document.id, "embedding": vector.tobytes()} for document, vector in zip(documents, vectors)
+        ])
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+    EMBEDDED_DOCUMENTS.inc(len(documents))
+
+    # Appending to shards that are in memory, so that new moments are searchable without a reload:
+    positions = defaultdict(list)
+    for position, document in enumerate(documents):
+        positions[document.user_id].append(position)
+    for user_id, user_positions in positions.items():
+        shard = _cached_shard(user_id)
+        if shard is not None:
+            shard.append(np.array([documents[position].id for position in user_positions], dtype=np.int64), vectors[user_positions])
+
+    return set(positions) if len(documents) == EMBEDDING_BATCH_SIZE else set()
+
+
+def _build_indexes() -> None:
+    # (Re)building the IVF indexes of cached shards that have outgrown exhaustive search, or their index:
+    with _shards_lock:
+        shards = list(_shards.values())
+    for shard in shards:
+        if shard.needs_index(): shard.build_index()
+
+
+def _users_missing_embeddings() -> Set[int]:
+    db = SessionLocal()
+    try:
+        return set(db.execute(
+            select(SearchDocument.user_id).distinct()
+            .where(SearchDocument.embedding.is_(None), SearchDocument.field.in_(EMBEDDED_FIELDS), SearchDocument.content != "")
+        ).scalars())
+    finally:
+        db.close()
+
+
+async def run_embedding_worker() -> None:
+    try:
+        # Loading the model up front, so that a missing dependency is reported once rather than on every batch:
+        await run_in_threadpool(_extractor)
+        backlog = await run_in_threadpool(_users_missing_embeddings)
+    except Exception:
+        logger.exception("Semantic search is unavailable: the embedding model could not be loaded.")
+        return
+
+    with _pending_lock:
+        _pending_users.update(backlog)
+
+    while True:
+        await asyncio.sleep(EMBEDDING_INTERVAL_SECONDS)
+        with _pending_lock:
+            user_ids = set(_pending_users)
+            _pending_users.clear()
+
+        try:
+            while user_ids:
+                user_ids = await run_in_threadpool(_embed_pending, user_ids)
+        except Exception:
+            logger.exception("Embedding search documents failed.")
+            with _pending_lock:
+                _pending_users.update(user_ids)
+
+        try:
+            await run_in_threadpool(_build_indexes)
+        except Exception:
+            logger.exception("Building semantic search indexes failed.")
+
+
+def _search(db: db_dependency, user_id: int, query: np.ndarray, k: int, exclude_id: Optional[int] = None) -> List[Tuple[int, float]]:
+    shard = _cached_shard(user_id) or _load_shard(db, user_id)
+    # Asking for extra results, since rows removed since the shard was loaded are dropped afterwards:
+    return shard.search(query, 2 * k, exclude_id)
+
+
+def _resolve(db: db_dependency, user: user_dependency, hits: List[Tuple[int, float]], k: int) -> SimilarMomentsResponse:
+    if not hits: return SimilarMomentsResponse(results=[])
+
+    rows = db.execute(
+        select(
+            SearchDocument.id, SearchDocument.conversation_id, SearchDocument.field,
+            SearchDocument.segment_id, SearchDocument.content, Conversation.name,
+        )
+        .join(Conversation, Conversation.id == SearchDocument.conversation_id)
+        .where(SearchDocument.user_id == user.id, SearchDocument.id.in_([document_id for document_id, _ in hits]))
+    ).all()
+    documents = {row.id: row for row in rows}
+
+    results = [
+        SimilarMoment(
+            conversation_id=documents[document_id].conversation_id,
+            conversation_name=documents[document_id].name,
+            field=documents[document_id].field,
+            segment_id=documents[document_id].segment_id,
+            text=documents[document_id].content,
+            score=score,
+        )
+        for document_id, score in hits if document_id in documents
+    ]
+    return SimilarMomentsResponse(results=results[:k])
+
+
+async def find_similar_moments(db: db_dependency, user: user_dependency, query: str, k: int = 10) -> SimilarMomentsResponse:
+    if not SEMANTIC_SEARCH_ENABLED: raise SemanticSearchUnavailableException
+
+    with metrics.stage("query_embedding"):
+        vector = (await run_in_threadpool(lambda: _extractor().embed([query])))[0]
+    with metrics.stage("semantic_search"):
+        hits = await run_in_threadpool(_search, db, user.id, vector, k)
+    return _resolve(db, user, hits, k)
+
+
+async def find_moments_like_segment(
+    db: db_dependency,
+    user: user_dependency,
+    conversation_id: int,
+    segment_id: str,
+    k: int = 10
+) -> SimilarMomentsResponse:
+    if not SEMANTIC_SEARCH_ENABLED: raise SemanticSearchUnavailableException
+
+    document = db.execute(
+        select(SearchDocument.id, SearchDocument.content, SearchDocument.embedding)
+        .where(
+            SearchDocument.user_id == user.id,
+            SearchDocument.conversation_id == conversation_id,
+            SearchDocument.field == "segment",
+            SearchDocument.segment_id == segment_id,
+        )
+    ).first()
+    if document is None: raise SegmentNotFoundException
+
+    # Reusing the stored embedding, so that no model call is needed unless the segment is brand new:
+    if document.embedding is not None:
+        vector = np.frombuffer(document.embedding, dtype=EMBEDDING_DTYPE).astype(np.float32)
+    else:
+        vector = (await run_in_threadpool(lambda: _extractor().embed([document.content])))[0]
+
+    with metrics.stage("semantic_search"):
+        hits = await run_in_threadpool(_search, db, user.id, vector, k, document.id)
+    return _resolve(db, user, hits, k)
@@ -0,0 +1,131 @@
+import os
+import time
+import threading
+from typing import Dict, Iterable, List, Optional
+
+import metrics
+from enums import AIModel, AI_MODEL_CAPABILITIES, OPENAI_MODELS
+
+
+# Weight given to the newest observation in the moving averages:
+EWMA_ALPHA = float(os.getenv("LLM_ROUTING_EWMA_ALPHA", 0.2))
+
+# Alternatives must be this many times faster than the preferred model before they are routed to first:
+PREFERRED_MODEL_BIAS = float(os.getenv("LLM_ROUTING_PREFERRED_BIAS", 1.5))
+
+# Models that requests may be routed or hedged to, besides the one the caller asked for:
+ROUTING_MODELS = {
+    AIModel(value.strip())
+    for value in os.getenv("LLM_ROUTING_MODELS", "gpt-4o-mini,gemini-1.5-flash").split(",") if value.strip()
+}
+
+# Consecutive failures that open a model's circuit, and how long it stays open before a trial request:
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("LLM_BREAKER_FAILURE_THRESHOLD", 5))
+BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN_SECONDS", 30))
+
+TTFT_EWMA = metrics.registry.gauge("llm_model_ttft_ewma_seconds", "Moving average of time to first token, by model.")
+ERROR_RATE_EWMA = metrics.registry.gauge("llm_model_error_rate_ewma", "Moving average of the error rate, by model.")
+CIRCUIT_OPEN = metrics.registry.gauge("llm_model_circuit_open", "Whether the model's circuit breaker is open.")
+
+
+class ModelHealth:
+    def __init__(self):
+        self.ttft: Optional[float] = None
+        self.error_rate = 0.0
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+
+    def score(self) -> float:
+        # Models without observations yet are treated as neither fast nor slow:
+        ttft = self.ttft if self.ttft is not None else 1.0
+        return ttft * (1 + 4 * self.error_rate)
+
+
+class ModelRouter:
+    # Tracks per-model latency and errors, and picks which models to send a request to:
+
+    def __init__(self):
+        self._health: Dict[AIModel, ModelHealth] = {model: ModelHealth() for model in AIModel}
+        self._lock = threading.Lock()
+
+    def _ewma(self, current: Optional[float], value: float) -> float:
+        return value if current is None else EWMA_ALPHA * value + (1 - EWMA_ALPHA) * current
+
+    def record_slower_than(self, model: AIModel, elapsed: float) -> None:
+        # Recording that a cancelled attempt (e.g. a hedge loser) had no token after elapsed seconds. That is only a lower
+        # bound on its TTFT, so it is only recorded when it shows the model to be slower than its average, never faster:
+        with self._lock:
+            health = self._health[model]
+            if health.ttft is not None and elapsed <= health.ttft: return
+            health.ttft = self._ewma(health.ttft, elapsed)
+        TTFT_EWMA.set(health.ttft, model=model.value)
+
+    def record_success(self, model: AIModel, ttft: Optional[float] = None) -> None:
+        with self._lock:
+            health = self._health[model]
+            if ttft is not None:
+                health.ttft = self._ewma(health.ttft, ttft)
+            health.error_rate = self._ewma(health.error_rate, 0.0)
+            health.consecutive_failures = 0
+            health.opened_at = None
+
+        if ttft is not None: TTFT_EWMA.set(health.ttft, model=model.value)
+        ERROR_RATE_EWMA.set(health.error_rate, model=model.value)
+        CIRCUIT_OPEN.set(0, model=model.value)
+
+    def record_failure(self, model: AIModel) -> None:
+        with self._lock:
+            health = self._health[model]
+            health.error_rate = self._ewma(health.error_rate, 1.0)
+            health.consecutive_failures += 1
+
+            # Opening the circuit (or re-opening it after a failed trial):
+            if health.consecutive_failures >= BREAKER_FAILURE_THRESHOLD:
+                health.opened_at = time.monotonic()
+
+        ERROR_RATE_EWMA.set(health.error_rate, model=model.value)
+        CIRCUIT_OPEN.set(int(health.opened_at is not None), model=model.value)
+
+    def _is_available(self, health: ModelHealth) -> bool:
+        # Closed, or half-open once the cooldown has passed (the trial is only taken by begin_attempt):
+        return health.opened_at is None or time.monotonic() - health.opened_at >= BREAKER_COOLDOWN
+
+    def begin_attempt(self, model: AIModel, force: bool = False) -> bool:
+        # Called when a request is actually sent to the model, rather than when it is listed as a candidate.
+        # Half-open models let a single trial request through per cooldown period, so this takes the trial, and returns
+        # False when another request has taken it since the model was listed (unless forced):
+        with self._lock:
+            health = self._health[model]
+            if not force and not self._is_available(health): return False
+            if health.opened_at is not None: health.opened_at = time.monotonic()
+            return True
+
+    def ttft(self, model: AIModel) -> Optional[float]:
+        return self._health[model].ttft
+
+    def candidates(self, preferred: AIModel, required_capabilities: Iterable[str] = ()) -> List[AIModel]:
+        # Returning the available models that have the required capabilities, fastest first:
+        required = tuple(required_capabilities)
+        capable = [
+            model for model in AIModel
+            if model == preferred or (
+                model in ROUTING_MODELS and all(AI_MODEL_CAPABILITIES[model][capability] for capability in required)
+            )
+        ]
+
+        with self._lock:
+            scores = {
+                model: self._health[model].score() / (PREFERRED_MODEL_BIAS if model == preferred else 1)
+                for model in capable
+            }
+            # Breaking ties in favour of the other provider, so that hedges do not share an outage:
+            ordered = sorted(capable, key=lambda model: (
+                scores[model], model != preferred and (model in OPENAI_MODELS) == (preferred in OPENAI_MODELS)
+            ))
+            available = [model for model in ordered if self._is_available(self._health[model])]
+
+        # Falling back to the preferred model if every circuit is open, rather than failing outright:
+        return available or [preferred]
+
+
+router = ModelRouter()
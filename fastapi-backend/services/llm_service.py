@@ -1,16 +1,22 @@
 import os
-from typing import Optional, Any, AsyncGenerator
+import time
+import asyncio
+from collections import deque
+from typing import Optional, Any, AsyncGenerator, Deque, Dict, Iterable, List
 from datetime import datetime
 
 from pydantic import BaseModel
 from openai import OpenAI
 from starlette.concurrency import run_in_threadpool
 
-from llm_context import LLM_CONTEXT
+import metrics
+from llm_context import SUMMARY_INSTRUCTIONS, format_summary_input
 from schemas import AgentResponse
-from exceptions import UnprocessableMessageException
+from exceptions import UnprocessableMessageException, LLMBusyException
 from enums import AIModel, OPENAI_MODELS, GEMINI_MODELS
 from dependencies import user_dependency
+from . import llm_routing
+from .usage_service import record_usage
 
 openai_client = OpenAI()
 gemini_client = OpenAI(
@@ -18,14 +24,139 @@ gemini_client = OpenAI(
     base_url=os.getenv("GEMINI_BASE_URL")
 )
 
+# Hedging fires a second request to another capable model when the first has not produced a token in time:
+HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "false").lower() == "true"
+HEDGE_MIN_DEADLINE = float(os.getenv("LLM_HEDGE_MIN_DEADLINE_MS", 1500)) / 1000
+HEDGE_TTFT_MULTIPLIER = float(os.getenv("LLM_HEDGE_TTFT_MULTIPLIER", 2))
+
+# Upper bound on the models tried for one stream (the original request plus one hedge or failover):
+MAX_STREAM_ATTEMPTS = 2
+
+# Upstream calls allowed at once in this process and per user, and how many more may wait for a slot, for how long.
+# The global limit stays below the threadpool size (40 by default), so that other blocking work always has threads.
+# Requests that attach to a shared prediction stream make no upstream call and hold no slot. The per-user limit leaves
+# room for a user's devices (e.g. the PWA and glasses mode) streaming different revisions alongside a speculative run:
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 32))
+LLM_MAX_PER_USER = int(os.getenv("LLM_MAX_PER_USER", 4))
+LLM_MAX_QUEUED = int(os.getenv("LLM_MAX_QUEUED", 64))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT_MS", 2000)) / 1000
+
+BUSY_MESSAGE = "The assistant is busy. Please try again shortly."
+
+HEDGED_REQUESTS = metrics.registry.counter("llm_hedged_requests_total", "Hedged requests fired, by hedge model.")
+
+PROMPT_TOKENS = metrics.registry.counter("llm_prompt_tokens_total", "Prompt tokens reported by providers, by model.")
+CACHED_PROMPT_TOKENS = metrics.registry.counter(
+    "llm_cached_prompt_tokens_total", "Prompt tokens served from the provider's prompt cache, by model."
+)
+COMPLETION_TOKENS = metrics.registry.counter("llm_completion_tokens_total", "Completion tokens reported by providers, by model.")
+
+TOKENS_PER_SECOND = metrics.registry.histogram(
+    "llm_stream_tokens_per_second", "Streamed chunks per second after the first token.",
+    buckets=(5, 10, 20, 40, 60, 80, 100, 150, 200, 400)
+)
+
+
+ADMISSION_WAIT = metrics.registry.histogram(
+    "llm_admission_wait_seconds", "Time upstream calls waited for a concurrency slot.",
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5)
+)
+ADMISSION_REJECTIONS = metrics.registry.counter(
+    "llm_admission_rejections_total", "Upstream calls shed by the admission controller, by reason."
+)
+
+
+class AdmissionController:
+    # Limits upstream LLM calls globally and per user. Calls over the global limit wait in a bounded FIFO queue,
+    # and are shed once the queue is full or they have waited past the deadline.
+    # Only used from the event loop, so no locking is needed:
+
+    def __init__(self, capacity: int, per_user: int, max_queued: int, queue_timeout: float):
+        self.capacity = capacity
+        self.per_user = per_user
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+
+        self.in_flight = 0
+        self._user_calls: Dict[int, int] = {}
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def _reject(self, reason: str) -> bool:
+        ADMISSION_REJECTIONS.inc(reason=reason)
+        return False
+
+    def _release_user(self, user_id: int) -> None:
+        remaining = self._user_calls[user_id] - 1
+        if remaining: self._user_calls[user_id] = remaining
+        else: del self._user_calls[user_id]
+
+    async def acquire(self, user_id: int) -> bool:
+        # Returning whether the call was admitted, in which case release() must be called when it ends:
+        if self._user_calls.get(user_id, 0) >= self.per_user: return self._reject("user_limit")
+
+        if self.in_flight < self.capacity and not self._waiters:
+            self.in_flight += 1
+            self._user_calls[user_id] = self._user_calls.get(user_id, 0) + 1
+            ADMISSION_WAIT.observe(0)
+            return True
+
+        if len(self._waiters) >= self.max_queued: return self._reject("queue_full")
+
+        # Counting queued calls against the user's limit, so that one user cannot fill the queue:
+        self._user_calls[user_id] = self._user_calls.get(user_id, 0) + 1
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        start = time.perf_counter()
+
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except asyncio.TimeoutError:
+            # Handling the slot being handed over just as the deadline passed:
+            if not waiter.done():
+                waiter.cancel()
+                self._waiters.remove(waiter)
+                self._release_user(user_id)
+                return self._reject("timeout")
+        except asyncio.CancelledError:
+            if waiter.done():
+                self.release(user_id)
+            else:
+                waiter.cancel()
+                self._waiters.remove(waiter)
+                self._release_user(user_id)
+            raise
+
+        ADMISSION_WAIT.observe(time.perf_counter() - start)
+        return True
+
+    def release(self, user_id: int) -> None:
+        self._release_user(user_id)
+
+        # Handing the slot straight to the longest waiting call, if any:
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(True)
+                return
+        self.in_flight -= 1
+
+
+admission = AdmissionController(LLM_MAX_CONCURRENCY, LLM_MAX_PER_USER, LLM_MAX_QUEUED, LLM_QUEUE_TIMEOUT)
+
+metrics.registry.gauge("llm_in_flight", "Upstream LLM calls holding a concurrency slot.", lambda: admission.in_flight)
+metrics.registry.gauge("llm_admission_queue_depth", "Upstream LLM calls waiting for a concurrency slot.", lambda: admission.queued)
+
 
 def _get_api_arguments(user: user_dependency, model: AIModel, message: str, response_format=None) -> dict:
-    formatted_context = LLM_CONTEXT.format(user_name=user.name, transcript=message)
-    
+    # Keeping the system message identical across users and requests, so that it can be served from the prompt cache:
     api_arguments = {
         "messages": [
-            {"role": "system", "content": formatted_context},
-            {"role": "user", "content": message}
+            {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+            {"role": "user", "content": format_summary_input(user.name, message)}
         ], 
         "model": model.value
     }
@@ -35,6 +166,27 @@ def _get_api_arguments(user: user_dependency, model: AIModel, message: str, resp
     return api_arguments
 
 
+def _record_usage(user: user_dependency, model: AIModel, prompt_tokens: int, cached_tokens: int, completion_tokens: int) -> None:
+    # Recording cached prompt tokens, to verify that prompts keep a stable prefix:
+    PROMPT_TOKENS.inc(prompt_tokens, model=model.value)
+    CACHED_PROMPT_TOKENS.inc(cached_tokens, model=model.value)
+    COMPLETION_TOKENS.inc(completion_tokens, model=model.value)
+
+    # Attributing the usage to the user, for cost reporting and quotas:
+    record_usage(user, model, prompt_tokens, cached_tokens, completion_tokens)
+
+
+def _record_reported_usage(user: user_dependency, model: AIModel, usage) -> None:
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", None) if details is not None else None
+    _record_usage(user, model, usage.prompt_tokens or 0, cached_tokens or 0, usage.completion_tokens or 0)
+
+
+def _estimate_prompt_tokens(messages: list) -> int:
+    # Approximating 4 characters per token, for providers that do not report usage on streams:
+    return sum(len(str(message.get("content", ""))) for message in messages) // 4
+
+
 def _get_client(model: AIModel):
     if model in OPENAI_MODELS:
         return openai_client
@@ -47,12 +199,25 @@ def _get_client(model: AIModel):
 async def send_request(user: user_dependency, model: AIModel, message: str, response_format=None) -> None:
     client = _get_client(model)
     api_arguments = _get_api_arguments(user, model, message, response_format)
+
+    if not await admission.acquire(user.id): raise LLMBusyException
+    llm_routing.router.begin_attempt(model, force=True)
    
     # Wrapping the synchronous calls in run_in_threadpool:
-    if response_format:
-        response = await run_in_threadpool(client.beta.chat.completions.parse, **api_arguments)
-    else:
-        response = await run_in_threadpool(client.chat.completions.create, **api_arguments)   
+    try:
+        with metrics.stage("upstream_completion", model=model.value):
+            if response_format:
+                response = await run_in_threadpool(client.beta.chat.completions.parse, **api_arguments)
+            else:
+                response = await run_in_threadpool(client.chat.completions.create, **api_arguments)   
+    except Exception:
+        llm_routing.router.record_failure(model)
+        raise
+    finally:
+        admission.release(user.id)
+    llm_routing.router.record_success(model)
+    if getattr(response, "usage", None) is not None:
+        _record_reported_usage(user, model, response.usage)
     
     # Handling cases where the model refuses to respond:
     refusal = response.choices[0].message.refusal
@@ -68,6 +233,10 @@ async def send_message(
     response_format: Optional[BaseModel] = AgentResponse,
 ) -> str | BaseModel:
 
+    # Taking the requested model out of rotation if its circuit is open:
+    required_capabilities = ("supports_structured_outputs",) if response_format else ()
+    model = llm_routing.router.candidates(model, required_capabilities)[0]
+
     result = (await send_request(user, model, text, response_format)).choices[0].message
 
     # Adding the schema to the assistant message:
@@ -77,35 +246,174 @@ async def send_message(
     return result
 
 
+class _StreamAttempt:
+    # A single upstream streaming request, consumed through the threadpool so the event loop is never blocked:
+
+    def __init__(self, model: AIModel, messages: list):
+        self.model = model
+        self.messages = messages
+        self.start = time.perf_counter()
+        self.ttft: Optional[float] = None
+        self.stream = None
+        self.closed = False
+        self._iterator = None
+        # Chunks received up to and including the first one with content:
+        self._buffered = []
+
+    def _open(self):
+        # Asking for a final usage chunk where supported, to record prompt cache hits:
+        options = {"stream_options": {"include_usage": True}} if self.model.supports_stream_usage else {}
+        self.stream = _get_client(self.model).chat.completions.create(
+            messages=self.messages, model=self.model.value, stream=True, **options
+        )
+        self._iterator = iter(self.stream)
+
+        # Handling the attempt being discarded while the request was being opened:
+        if self.closed: self.stream.close()
+
+    def _next_chunk(self):
+        return next(self._iterator, None)
+
+    async def wait_for_first_token(self) -> "_StreamAttempt":
+        await run_in_threadpool(self._open)
+
+        while True:
+            chunk = await run_in_threadpool(self._next_chunk)
+            if chunk is None: break
+
+            self._buffered.append(chunk)
+            if _chunk_content(chunk): break
+
+        self.ttft = time.perf_counter() - self.start
+        return self
+
+    async def chunks(self) -> AsyncGenerator[Any, None]:
+        for chunk in self._buffered:
+            yield chunk
+
+        while True:
+            chunk = await run_in_threadpool(self._next_chunk)
+            if chunk is None: return
+            yield chunk
+
+    def close(self) -> None:
+        self.closed = True
+        if self.stream is not None:
+            self.stream.close()
+
+
+def _chunk_content(chunk) -> str:
+    return (chunk.choices[0].delta.content or "") if chunk.choices else ""
+
+
+def _hedge_deadline(model: AIModel) -> float:
+    # Waiting for a multiple of the model's usual TTFT before hedging, but never less than the minimum:
+    ttft = llm_routing.router.ttft(model)
+    if ttft is None: return HEDGE_MIN_DEADLINE
+    return max(HEDGE_MIN_DEADLINE, ttft * HEDGE_TTFT_MULTIPLIER)
+
+
+def _discard_attempt(task: asyncio.Task, attempt: _StreamAttempt) -> None:
+    # Cancelling the losing attempt and closing its connection without waiting for it:
+    task.cancel()
+    task.add_done_callback(lambda task: task.cancelled() or task.exception())
+    asyncio.get_running_loop().run_in_executor(None, attempt.close)
+    llm_routing.router.record_slower_than(attempt.model, time.perf_counter() - attempt.start)
+
+
+async def _first_responder(messages: list, candidates: List[AIModel]) -> _StreamAttempt:
+    # Starting the request on the first candidate, hedging to the next one if the first is slow to produce a token,
+    # and failing over if it errors. Whichever attempt produces a token first wins, and the other is cancelled:
+    remaining = candidates[:MAX_STREAM_ATTEMPTS]
+    attempts: Dict[asyncio.Task, _StreamAttempt] = {}
+    error: Optional[Exception] = None
+
+    def start_next() -> Optional[AIModel]:
+        # The first candidate was just checked by the router, or is its fallback, so it is always started. Later ones
+        # are skipped if another request has taken their half-open trial since they were listed:
+        while remaining:
+            model = remaining.pop(0)
+            if not llm_routing.router.begin_attempt(model, force=model == candidates[0]): continue
+            attempt = _StreamAttempt(model, messages)
+            attempts[asyncio.create_task(attempt.wait_for_first_token())] = attempt
+            return model
+        return None
+
+    start_next()
+    while attempts:
+        timeout = _hedge_deadline(candidates[0]) if HEDGE_ENABLED and remaining and len(attempts) == 1 else None
+        done, _ = await asyncio.wait(set(attempts), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+        if not done:
+            hedge = start_next()
+            if hedge is not None: HEDGED_REQUESTS.inc(model=hedge.value)
+            continue
+
+        for task in done:
+            attempt = attempts.pop(task)
+            if task.exception() is not None:
+                error = task.exception()
+                llm_routing.router.record_failure(attempt.model)
+                attempt.close()
+                continue
+
+            llm_routing.router.record_success(attempt.model, attempt.ttft)
+            for loser_task, loser in attempts.items():
+                _discard_attempt(loser_task, loser)
+            return attempt
+
+        # Failing over to the next candidate once every in-flight attempt has failed:
+        if not attempts and remaining:
+            start_next()
+
+    raise error
+
+
 async def stream_message(
     user: user_dependency,
     messages: list,
     model: AIModel = AIModel.GPT_4O_MINI,
+    required_capabilities: Iterable[str] = ("supports_developer_messages",),
 ) -> AsyncGenerator[dict, None]:
-
-    client = _get_client(model)
-    api_arguments = {
-        "messages": messages,
-        "model": model.value,
-        "stream": True
-    }
     
     # Start timestamp for when we began generating
     start_timestamp = datetime.now().timestamp()
+    chunk_count = 0
+    attempt = None
     
     # Full text accumulator
     full_text = ""
+    usage_reported = False
+
+    # Shedding load with a fast "busy" response, rather than hanging behind other requests:
+    if not await admission.acquire(user.id):
+        yield {
+            "text": BUSY_MESSAGE,
+            "timestamp": start_timestamp,
+            "complete": True,
+            "error": True,
+            "new": True
+        }
+        return
     
     try:
-        # Use the appropriate client based on model
-        stream = await run_in_threadpool(
-            client.chat.completions.create,
-            **api_arguments
-        )
+        # Routing to the fastest healthy model, which may differ from the requested one:
+        candidates = llm_routing.router.candidates(model, required_capabilities)
+        attempt = await _first_responder(messages, candidates)
+        model = attempt.model
+        metrics.record_stage("upstream_ttft", attempt.ttft, model=model.value)
+        first_token_time = time.perf_counter()
         
-        for chunk in stream:
+        async for chunk in attempt.chunks():
             # Extract content from chunk if available
-            content = chunk.choices[0].delta.content or ""
+            content = _chunk_content(chunk)
+            if content: chunk_count += 1
+
+            # The usage chunk comes last and has no content, so it is not sent to the client:
+            if getattr(chunk, "usage", None) is not None:
+                _record_reported_usage(user, model, chunk.usage)
+                usage_reported = True
+                if not content: continue
             
             # Add to accumulated text
             full_text += content
@@ -118,6 +426,14 @@ async def stream_message(
                 "new": True
             }
         
+        if not usage_reported:
+            _record_usage(user, model, _estimate_prompt_tokens(messages), 0, chunk_count)
+
+        # Recording the generation rate, using content chunks as a proxy for tokens:
+        elapsed = time.perf_counter() - first_token_time
+        if metrics.METRICS_ENABLED and elapsed > 0:
+            TOKENS_PER_SECOND.observe(chunk_count / elapsed, model=model.value)
+
         # Send the final complete message
         yield {
             "text": full_text,
@@ -127,6 +443,10 @@ async def stream_message(
         }
             
     except Exception as e:
+        # Errors after a model was selected count against it (failures before that are recorded when they happen):
+        if attempt is not None:
+            llm_routing.router.record_failure(model)
+
         # Handle errors by yielding an error message
         yield {
             "text": f"Error generating prediction: {str(e)}",
@@ -135,3 +455,9 @@ async def stream_message(
             "error": True,
             "new": True
         }
+
+    finally:
+        # Closing the upstream connection, including when the client disconnects mid-stream:
+        if attempt is not None:
+            attempt.close()
+        admission.release(user.id)
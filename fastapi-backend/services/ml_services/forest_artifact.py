@@ -0,0 +1,149 @@
+import os
+import json
+from typing import Dict
+
+import numpy as np
+
+# A fitted tree ensemble flattened into contiguous arrays in a single file, laid out as:
+#   MAGIC | header length (uint32) | JSON header | arrays, each aligned to ALIGNMENT bytes
+# The arrays are memory-mapped read-only, so every worker shares one copy through the page cache,
+# and loading never runs code from the file the way unpickling does.
+
+MAGIC = b"FOREST01"
+ALIGNMENT = 64
+
+# Node arrays, all indexed by global node ID across the trees. Leaves point to themselves as both children,
+# so that traversal can keep stepping every (sample, tree) pair for max_depth steps without branching:
+ARRAY_DTYPES = {
+    "feature": np.int32,
+    "threshold": np.float64,
+    "left": np.int32,
+    "right": np.int32,
+    "value": np.float64,
+    "roots": np.int32,
+}
+
+
+class ForestArtifactException(Exception):
+    pass
+
+
+def _flatten(model) -> Dict[str, np.ndarray]:
+    features, thresholds, lefts, rights, values, roots = [], [], [], [], [], []
+    offset = 0
+
+    for estimator in model.estimators_:
+        tree = estimator.tree_
+        n_nodes = tree.node_count
+        node_ids = np.arange(offset, offset + n_nodes, dtype=np.int64)
+        leaf = tree.children_left == -1
+
+        features.append(np.where(leaf, 0, tree.feature))
+        thresholds.append(np.where(leaf, np.inf, tree.threshold))
+        lefts.append(np.where(leaf, node_ids, tree.children_left + offset))
+        rights.append(np.where(leaf, node_ids, tree.children_right + offset))
+        # sklearn stores regression values as (nodes, outputs, 1):
+        values.append(tree.value.reshape(n_nodes, -1))
+        roots.append(offset)
+        offset += n_nodes
+
+    return {
+        "feature": np.concatenate(features),
+        "threshold": np.concatenate(thresholds),
+        "left": np.concatenate(lefts),
+        "right": np.concatenate(rights),
+        "value": np.concatenate(values),
+        "roots": np.array(roots),
+    }
+
+
+def export_forest(model, path: str, validation_data: np.ndarray = None) -> None:
+    # Writing to a temporary file and renaming it over the old one, so that workers that have the old file mapped
+    # keep reading it intact, and new loads only ever see a complete file:
+    arrays = {name: np.ascontiguousarray(array, dtype=ARRAY_DTYPES[name]) for name, array in _flatten(model).items()}
+    header = {
+        "n_features": int(model.n_features_in_),
+        "n_outputs": int(arrays["value"].shape[1]),
+        "max_depth": int(max(estimator.tree_.max_depth for estimator in model.estimators_)),
+        "arrays": {},
+    }
+
+    # Offsets are relative to the end of the header, which is only known once the header is serialized:
+    position = 0
+    for name, array in arrays.items():
+        position = -(-position // ALIGNMENT) * ALIGNMENT
+        header["arrays"][name] = {"offset": position, "shape": list(array.shape), "dtype": np.dtype(ARRAY_DTYPES[name]).str}
+        position += array.nbytes
+
+    header_bytes = json.dumps(header).encode()
+    data_start = -(-(len(MAGIC) + 4 + len(header_bytes)) // ALIGNMENT) * ALIGNMENT
+
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(len(header_bytes).to_bytes(4, "little"))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_start + header["arrays"][name]["offset"])
+            f.write(array.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+
+    # Refusing to publish an artifact whose predictions differ from the model it was exported from:
+    if validation_data is not None and len(validation_data):
+        expected = model.predict(validation_data)
+        actual = FlatForest.load(temporary_path).predict(validation_data)
+        if not np.allclose(actual, expected.reshape(actual.shape), rtol=1e-6, atol=1e-9):
+            os.remove(temporary_path)
+            raise ForestArtifactException("Exported forest does not match the model's predictions.")
+
+    os.replace(temporary_path, path)
+
+
+class FlatForest:
+    # Read-only, memory-mapped regression forest with vectorized inference:
+
+    def __init__(self, header: dict, arrays: Dict[str, np.ndarray]):
+        self.n_features = header["n_features"]
+        self.n_outputs = header["n_outputs"]
+        self.max_depth = header["max_depth"]
+        for name in ARRAY_DTYPES:
+            setattr(self, name, arrays[name])
+
+    @classmethod
+    def load(cls, path: str) -> "FlatForest":
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ForestArtifactException(f"{path} is not a forest artifact.")
+            header_length = int.from_bytes(f.read(4), "little")
+            header = json.loads(f.read(header_length))
+
+        data_start = -(-(len(MAGIC) + 4 + header_length) // ALIGNMENT) * ALIGNMENT
+        arrays = {}
+        for name, expected_dtype in ARRAY_DTYPES.items():
+            spec = header["arrays"][name]
+            if np.dtype(spec["dtype"]) != np.dtype(expected_dtype):
+                raise ForestArtifactException(f"Unexpected dtype for {name}: {spec['dtype']}.")
+            arrays[name] = np.memmap(
+                path, dtype=spec["dtype"], mode="r", offset=data_start + spec["offset"], shape=tuple(spec["shape"])
+            )
+        return cls(header, arrays)
+
+    def apply(self, X: np.ndarray) -> np.ndarray:
+        # Walking every (sample, tree) pair down one level per step, for the depth of the deepest tree.
+        # sklearn compares float32 features against float64 thresholds, so the same is done here to split identically:
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ForestArtifactException(f"Expected {self.n_features} features, got {X.shape}.")
+
+        rows = np.arange(len(X))[:, None]
+        nodes = np.broadcast_to(np.asarray(self.roots), (len(X), len(self.roots))).copy()
+        for _ in range(self.max_depth):
+            go_left = X[rows, self.feature[nodes]] <= self.threshold[nodes]
+            nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+        return nodes
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        # The mean of the trees' leaf values, as (samples, outputs), or (samples,) for a single output like sklearn:
+        predictions = self.value[self.apply(X)].mean(axis=1)
+        return predictions[:, 0] if self.n_outputs == 1 else predictions
@@ -1,10 +1,9 @@
 import os
 import sys
 import threading
-from typing import Dict
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple, Union
 
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
 from sentence_transformers import SentenceTransformer
 
 # Adding parent directory so enums import works when running standalone file (for testing):
@@ -78,34 +77,157 @@ class KeywordExtractor:
         }
 
 
-        # Pre-computing and storing the normalized average embeddings for each category:
-        self.CATEGORY_EMBEDDINGS = {}
-        for category, keywords in self.CATEGORY_KEYWORDS.items():
-            keyword_embeddings = self.model.encode(keywords, convert_to_tensor=False)
-            avg_embedding = np.mean(keyword_embeddings, axis=0)
-            norm = np.linalg.norm(avg_embedding)
-            normalized_embedding = avg_embedding / norm if norm != 0 else avg_embedding
-            self.CATEGORY_EMBEDDINGS[category] = normalized_embedding
+        # Registering the default categories, embedding all of their keywords in one batch:
+        self._keyword_embeddings: Dict[str, np.ndarray] = {}
+        self._definitions: Dict[Hashable, Dict[str, float]] = {}
+        self._category_weights: Dict[Hashable, float] = {}
+        self._index = _CategoryIndex.empty(self.model.get_sentence_embedding_dimension())
+        # Re-entrant, so that read-modify-write edits (e.g. add_keywords) can hold it around _update:
+        self._write_lock = threading.RLock()
+        self.set_categories(self.CATEGORY_KEYWORDS)
 
 
-    def score_categories(self, user_input: str) -> Dict[DescriptionCategory, float]:
+    def embed(self, texts: List[str]) -> np.ndarray:
+        # Encoding a batch of texts into unit-length vectors, so that dot products are cosine similarities:
+        if not texts:
+            return np.zeros((0, self.model.get_sentence_embedding_dimension()), dtype=np.float32)
+        return self.model.encode(texts, batch_size=64, convert_to_numpy=True, normalize_embeddings=True).astype(np.float32)
+
+
+    def _embed_keywords(self, keywords: Iterable[str]) -> None:
+        # Only encoding keywords that have not been seen before, since keyword embeddings never change:
+        missing = list(dict.fromkeys(keyword for keyword in keywords if keyword not in self._keyword_embeddings))
+        for keyword, embedding in zip(missing, self.model.encode(missing, convert_to_numpy=True) if missing else []):
+            self._keyword_embeddings[keyword] = embedding.astype(np.float32)
+
+
+    def _category_vector(self, keywords: Dict[str, float]) -> np.ndarray:
+        # The normalized weighted average of the category's keyword embeddings:
+        embeddings = np.stack([self._keyword_embeddings[keyword] for keyword in keywords])
+        weights = np.fromiter(keywords.values(), dtype=np.float32, count=len(keywords))
+        vector = weights @ embeddings / max(weights.sum(), 1e-12)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm != 0 else vector
+
+
+    def _update(self, changed: Dict[Hashable, Optional[Dict[str, float]]]) -> None:
+        # Applying changed categories (None removes one), re-embedding only their new keywords.
+        # The category matrix is copied and swapped in whole, so scoring never waits for, or sees half of, an update:
+        with self._write_lock:
+            self._embed_keywords(
+                keyword for keywords in changed.values() if keywords for keyword in keywords
+            )
+
+            index = self._index
+            keys = list(index.keys)
+            matrix = index.matrix.copy()
+            weights = index.weights.copy()
+
+            removed = [index.positions[category] for category, keywords in changed.items()
+                       if not keywords and category in index.positions]
+            updated = {category: keywords for category, keywords in changed.items() if keywords}
+
+            for category, keywords in updated.items():
+                self._definitions[category] = dict(keywords)
+                self._category_weights.setdefault(category, 1.0)
+            for category, keywords in changed.items():
+                if not keywords:
+                    self._definitions.pop(category, None)
+                    self._category_weights.pop(category, None)
+
+            existing = [category for category in updated if category in index.positions]
+            new = [category for category in updated if category not in index.positions]
+            if existing:
+                matrix[[index.positions[category] for category in existing]] = np.stack(
+                    [self._category_vector(updated[category]) for category in existing]
+                )
+            if new:
+                matrix = np.vstack([matrix, np.stack([self._category_vector(updated[category]) for category in new])])
+                weights = np.concatenate([weights, np.ones(len(new), dtype=np.float32)])
+                keys += new
+            if removed:
+                matrix = np.delete(matrix, removed, axis=0)
+                weights = np.delete(weights, removed)
+                keys = [category for position, category in enumerate(keys) if position not in removed]
+
+            self._index = _CategoryIndex(keys, matrix, weights)
+
+
+    @staticmethod
+    def _weighted(keywords: Union[Iterable[str], Dict[str, float]]) -> Dict[str, float]:
+        return dict(keywords) if isinstance(keywords, dict) else {keyword: 1.0 for keyword in keywords}
+
+
+    def set_categories(self, categories: Dict[Hashable, Union[Iterable[str], Dict[str, float]]]) -> None:
+        # Adding or replacing categories, given as lists of keywords or {keyword: weight} dicts:
+        self._update({category: self._weighted(keywords) for category, keywords in categories.items()})
+
+
+    def set_category(self, category: Hashable, keywords: Union[Iterable[str], Dict[str, float]]) -> None:
+        self.set_categories({category: keywords})
+
+
+    def add_keywords(self, category: Hashable, keywords: Union[Iterable[str], Dict[str, float]]) -> None:
+        # Reading and replacing the definition under the write lock, so that concurrent edits are not lost:
+        with self._write_lock:
+            self.set_category(category, {**self._definitions.get(category, {}), **self._weighted(keywords)})
+
+
+    def remove_keywords(self, category: Hashable, keywords: Iterable[str]) -> None:
+        keywords = set(keywords)
+        with self._write_lock:
+            remaining = {keyword: weight for keyword, weight in self._definitions.get(category, {}).items()
+                         if keyword not in keywords}
+            self._update({category: remaining or None})
+
+
+    def remove_category(self, category: Hashable) -> None:
+        self._update({category: None})
+
+
+    def set_category_weight(self, category: Hashable, weight: float) -> None:
+        # Scaling a category's scores, e.g. to favour a user's own tags over the built-in categories:
+        with self._write_lock:
+            index = self._index
+            if category not in index.positions: raise KeyError(category)
+            weights = index.weights.copy()
+            weights[index.positions[category]] = weight
+            self._category_weights[category] = weight
+            self._index = _CategoryIndex(index.keys, index.matrix, weights)
+
+
+    def categories(self) -> List[Hashable]:
+        return list(self._index.keys)
+
+
+    def score_embeddings(self, embeddings: np.ndarray) -> Tuple[List[Hashable], np.ndarray]:
+        # Scoring unit-length embeddings against every category with one matrix multiply,
+        # returning the categories and a (texts x categories) score matrix:
+        index = self._index
+        return list(index.keys), (embeddings @ index.matrix.T) * index.weights
+
+
+    def score_categories(self, user_input: str) -> Dict[Hashable, float]:
+        index = self._index
         if not user_input.strip():
-            return {category: 0.0 for category in self.CATEGORY_EMBEDDINGS}
-
-        # Encoding and normalizing the user input:
-        input_embedding = self.model.encode([user_input], convert_to_tensor=False)[0]
-        norm = np.linalg.norm(input_embedding)
-        input_embedding = input_embedding / norm if norm != 0 else input_embedding
-
-        scores = {}
-        for category, embedding in self.CATEGORY_EMBEDDINGS.items():
-            similarity = cosine_similarity(
-                input_embedding.reshape(1, -1),
-                embedding.reshape(1, -1)
-            )[0][0]
-            scores[category] = float(similarity)
-
-        return scores
+            return {category: 0.0 for category in index.keys}
+
+        keys, scores = self.score_embeddings(self.embed([user_input]))
+        return dict(zip(keys, scores[0].tolist()))
+
+
+class _CategoryIndex:
+    # An immutable snapshot of the registered categories as one stacked, normalized matrix:
+
+    def __init__(self, keys: List[Hashable], matrix: np.ndarray, weights: np.ndarray):
+        self.keys = tuple(keys)
+        self.positions = {category: position for position, category in enumerate(self.keys)}
+        self.matrix = matrix
+        self.weights = weights
+
+    @classmethod
+    def empty(cls, dimension: int) -> "_CategoryIndex":
+        return cls([], np.zeros((0, dimension), dtype=np.float32), np.zeros(0, dtype=np.float32))
 
 
 def test_scoring():
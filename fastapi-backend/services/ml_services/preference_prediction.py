@@ -5,18 +5,19 @@ import logging
 from sklearn.ensemble import RandomForestRegressor
 from sqlalchemy.orm import Session, sessionmaker
 import numpy as np
-import pickle
+from typing import Dict, List
 from apscheduler.schedulers.background import BackgroundScheduler
 
 from models import User, Message, MessageInsight, MessageFeedback
 from enums import MessageType, DescriptionCategory
 from database import engine
+from ..preference_service import CATEGORIES, load_feature_matrix
+from .forest_artifact import FlatForest, export_forest
 
-# Configuring logging:
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-MODEL_PATH = 'preference_model.pkl'
+# Flattened forest (see forest_artifact), memory-mapped by every worker rather than unpickled into each:
+MODEL_PATH = os.getenv('PREFERENCE_MODEL_PATH', 'preference_model.forest')
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
@@ -71,7 +72,7 @@ def prepare_training_data(db: Session):
             labels.append(label_vector)
 
     
-    print(f"\033[1;34mPrepared training data for user.\033[0m")
+    logger.debug("Prepared training data for %d samples.", len(training_data))
 
     # Returning the training data and labels as NumPy arrays:
     return np.array(training_data), np.array(labels)
@@ -80,7 +81,7 @@ def prepare_training_data(db: Session):
 def train_preference_model():
     db = SessionLocal()
     try:
-        print(f"\033[1;34mPreparing training data.\033[0m")
+        logger.info("Preparing training data.")
         training_data, labels = prepare_training_data(db)
 
         # Checking if there is enough data to train the model:
@@ -100,25 +101,20 @@ def train_preference_model():
         # Setting n_estimators=100 to use 100 trees in the forest:
         # Setting random_state=42 for reproducibility:
         model = RandomForestRegressor(n_estimators=100, random_state=42)
-        print(f"\033[1;34mInitialized Random Forest Regressor.\033[0m")
-
 
         # Fitting the model to the training data:
         # training_data: feature matrix (input features)
         # labels: target values (output labels)
         model.fit(training_data, labels)
-        print(f"\033[1;34mModel fitted to training data.\033[0m")
-
-        # Saving the trained model to a file using pickle:
-        print(f"\033[1;34mSaving trained model to file.\033[0m")
-        with open(MODEL_PATH, 'wb') as f:
-            pickle.dump(model, f)
-        print(f"\033[1;34mModel trained and saved successfully.\033[0m")
-    except Exception as e:
-        print(f"\033[1;31mError during model training: {e}\033[0m")
+        logger.info("Model fitted to %d samples.", training_data.shape[0])
+
+        # Exporting the trained model, checking that the export predicts the same as the model on the training data:
+        export_forest(model, MODEL_PATH, validation_data=training_data)
+        logger.info("Model saved to %s.", MODEL_PATH)
+    except Exception:
+        logger.exception("Training the preference model failed.")
     finally:
         # Closing the database session:
-        print(f"\033[1;34mDatabase session closed.\033[0m")
         db.close()
 
 
@@ -130,62 +126,47 @@ def schedule_model_training(scheduler: BackgroundScheduler):
     # Scheduling the job to run every 1 minute for testing purposes - TODO: Set correct interval:
     scheduler.add_job(train_preference_model_job, 'interval', minutes=1, id='train_preference_model')
     scheduler.start()
-    print(f"\033[1;34mModel training scheduled successfully.\033[0m")
+    logger.info("Model training scheduled.")
 
 
 def shutdown_scheduler(scheduler: BackgroundScheduler):
     if scheduler.running:
         scheduler.shutdown(wait=False)
-        print(f"\033[1;34mScheduler shut down successfully.\033[0m")
+        logger.info("Model training scheduler shut down.")
 
 
-def predict_preferences(db: Session, user_id: int):
+_model_cache = {}
+
+
+def _load_model():
+    # Mapping the model file again only when it has been replaced since it was last loaded:
     if not os.path.exists(MODEL_PATH):
-        print(f"\033[1;31mModel has not been trained yet.\033[0m")
-        return {}
+        return None
 
-    print(f"\033[1;34mLoading trained model from file.\033[0m")
-    # Loading the trained model from the file:
-    with open(MODEL_PATH, 'rb') as f:
-        model = pickle.load(f)
+    modified = os.path.getmtime(MODEL_PATH)
+    if _model_cache.get("modified") != modified:
+        _model_cache.update(model=FlatForest.load(MODEL_PATH), modified=modified)
+    return _model_cache["model"]
 
-    # Getting the list of categories and mapping them to indices:
-    categories = [category for category in DescriptionCategory]
-    category_to_index = {category: idx for idx, category in enumerate(categories)}
-    n_categories = len(categories)
 
-    # Initializing the feature vector with zeros for all categories:
-    feature_vector = [0.0] * n_categories
-
-    # Fetching recent messages to help focus on recent interactions:
-    print(f"\033[1;34mFetching recent messages for user ID: {user_id}\033[0m")
-    messages = db.query(Message).filter_by(user_id=user_id).order_by(Message.timestamp.desc()).limit(10).all()
-
-    # Aggregating MessageInsight scores from recent messages:
-    print(f"\033[1;34mAggregating message insights.\033[0m")
-    message_count = 0
-    for message in messages:
-        message_insights = db.query(MessageInsight).filter_by(message_id=message.id).all()
-        if not message_insights:
-            continue
-        for insight in message_insights:
-            idx = category_to_index[insight.category]
-            feature_vector[idx] += insight.score
-        message_count += 1
-
-    # Averaging the feature vector if messages were found:
-    if message_count > 0:
-        print(f"\033[1;34mAveraging feature vector.\033[0m")
-        feature_vector = [score / message_count for score in feature_vector]
-
-    # Reshaping the feature vector into a 2D array for prediction:
-    feature_vector = np.array([feature_vector])
-
-    # Predicting preferences using the trained model:
-    # model.predict() returns the predicted labels (preferences) for the input feature vector.
-    # The output is an array where each element corresponds to a category's predicted score.
-    print(f"\033[1;34mPredicting preferences.\033[0m")
-    predicted_scores = model.predict(feature_vector)[0]
+def predict_preferences_batch(db: Session, user_ids: List[int]) -> Dict[int, Dict[DescriptionCategory, float]]:
+    # Scoring many users with one query for their feature vectors and one model.predict call:
+    model = _load_model()
+    if model is None:
+        logger.warning("Model has not been trained yet.")
+        return {}
+    if not user_ids:
+        return {}
+
+    user_ids = list(dict.fromkeys(user_ids))
+    predicted_scores = model.predict(load_feature_matrix(db, user_ids))
 
     # Mapping predictions back to categories:
-    return {category: score for category, score in zip(categories, predicted_scores)}
+    return {
+        user_id: {category: float(score) for category, score in zip(CATEGORIES, scores)}
+        for user_id, scores in zip(user_ids, predicted_scores)
+    }
+
+
+def predict_preferences(db: Session, user_id: int):
+    return predict_preferences_batch(db, [user_id]).get(user_id, {})
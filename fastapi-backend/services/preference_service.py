@@ -0,0 +1,68 @@
+import os
+from typing import Dict, List
+
+import numpy as np
+from sqlalchemy import select
+
+from dependencies import db_dependency
+from enums import DescriptionCategory
+from models import UserPreferenceFeatures
+
+
+# Weight of each new message's insights in a user's feature vector. Older messages fade by (1 - decay) per message,
+# so the default approximates the average over the last 10 messages that preferences used to be computed from:
+PREFERENCE_DECAY = float(os.getenv("PREFERENCE_DECAY", 2 / 11))
+
+CATEGORIES = list(DescriptionCategory)
+CATEGORY_INDEX = {category: index for index, category in enumerate(CATEGORIES)}
+
+FEATURE_DTYPE = np.float32
+
+
+def _decode(features: bytes) -> np.ndarray:
+    vector = np.frombuffer(features, dtype=FEATURE_DTYPE)
+    # Vectors stored before categories were added or removed are reset rather than misread:
+    return vector if len(vector) == len(CATEGORIES) else np.zeros(len(CATEGORIES), dtype=FEATURE_DTYPE)
+
+
+def insight_vector(scores: Dict[DescriptionCategory, float]) -> np.ndarray:
+    vector = np.zeros(len(CATEGORIES), dtype=FEATURE_DTYPE)
+    for category, score in scores.items():
+        vector[CATEGORY_INDEX[category]] = score
+    return vector
+
+
+def record_message_insights(db: db_dependency, user_id: int, scores: Dict[DescriptionCategory, float]) -> None:
+    # Folding one message's category scores into the user's feature vector, in O(categories).
+    # The row is locked (on Postgres) so that concurrent messages from the same user are not lost:
+    if not scores: return
+
+    row = db.execute(
+        select(UserPreferenceFeatures).where(UserPreferenceFeatures.user_id == user_id).with_for_update()
+    ).scalar_one_or_none()
+    update = insight_vector(scores)
+
+    if row is None:
+        db.add(UserPreferenceFeatures(user_id=user_id, features=update.tobytes(), message_count=1))
+        return
+
+    # The first messages are averaged, so that a new user's vector is not dominated by zeros:
+    decay = max(PREFERENCE_DECAY, 1 / (row.message_count + 1))
+    row.features = ((1 - decay) * _decode(row.features) + decay * update).astype(FEATURE_DTYPE).tobytes()
+    row.message_count += 1
+
+
+def load_feature_matrix(db: db_dependency, user_ids: List[int]) -> np.ndarray:
+    # Reading many users' vectors in one query, as a (users x categories) matrix in the order given.
+    # Users without any insights yet get zeros, as they did before:
+    rows = db.execute(
+        select(UserPreferenceFeatures.user_id, UserPreferenceFeatures.features)
+        .where(UserPreferenceFeatures.user_id.in_(set(user_ids)))
+    ).all()
+    features = {row.user_id: _decode(row.features) for row in rows}
+
+    matrix = np.zeros((len(user_ids), len(CATEGORIES)), dtype=FEATURE_DTYPE)
+    for position, user_id in enumerate(user_ids):
+        if user_id in features:
+            matrix[position] = features[user_id]
+    return matrix
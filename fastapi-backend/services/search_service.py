@@ -0,0 +1,235 @@
+import os
+import re
+import json
+import base64
+import asyncio
+import logging
+import binascii
+from typing import List, Optional, Tuple
+
+from sqlalchemy import text, delete, exists, insert, select
+from starlette.concurrency import run_in_threadpool
+
+from database import SessionLocal
+from dependencies import db_dependency, user_dependency
+from exceptions import InvalidSearchCursorException
+from models import Conversation, ConversationArchive, SearchDocument
+from schemas import SearchResponse, SearchResult
+from transcript_codec import decode_transcript
+from .embedding_service import notify_documents_changed
+from .transcript_service import SegmentDiff
+
+SNIPPET_START = "<mark>"
+SNIPPET_END = "</mark>"
+
+# Conversations indexed per transaction when backfilling those created before search existed:
+SEARCH_BACKFILL_BATCH_SIZE = int(os.getenv("SEARCH_BACKFILL_BATCH_SIZE", 100))
+
+logger = logging.getLogger(__name__)
+
+# Restricting results to segments tagged with a category (see tagging_service), when one is given:
+_CATEGORY_FILTER = """(:category IS NULL OR EXISTS (
+    SELECT 1 FROM segment_tags t
+    WHERE t.conversation_id = d.conversation_id AND t.segment_id = d.segment_id AND t.category = :category
+))"""
+
+# ts_rank is a float4, cast to float8 so that the rank sent back in a cursor compares equal to the one it came from:
+_POSTGRES_SEARCH = text("""
+    SELECT * FROM (
+        SELECT d.id, d.conversation_id, d.field, d.segment_id, c.name AS conversation_name,
+               ts_rank(d.search_vector, query)::float8 AS rank,
+               ts_headline('english', d.content, query,
+                           'StartSel=<mark>, StopSel=</mark>, MaxFragments=1, MaxWords=24, MinWords=8') AS snippet
+        FROM conversation_search_documents d
+        JOIN conversations c ON c.id = d.conversation_id,
+             websearch_to_tsquery('english', :query) query
+        WHERE d.user_id = :user_id AND d.search_vector @@ query AND {category_filter}
+    ) ranked
+    WHERE :after_rank IS NULL OR ranked.rank < :after_rank OR (ranked.rank = :after_rank AND ranked.id < :after_id)
+    ORDER BY ranked.rank DESC, ranked.id DESC
+    LIMIT :limit
+""".format(category_filter=_CATEGORY_FILTER))
+
+# bm25() is lower for better matches, so it is negated to rank in the same direction as Postgres:
+_SQLITE_SEARCH = text("""
+    SELECT * FROM (
+        SELECT d.id, d.conversation_id, d.field, d.segment_id, c.name AS conversation_name,
+               -bm25(conversation_search_fts) AS rank,
+               snippet(conversation_search_fts, 0, '<mark>', '</mark>', '…', 16) AS snippet
+        FROM conversation_search_fts
+        JOIN conversation_search_documents d ON d.id = conversation_search_fts.rowid
+        JOIN conversations c ON c.id = d.conversation_id
+        WHERE conversation_search_fts MATCH :query AND d.user_id = :user_id AND {category_filter}
+    ) ranked
+    WHERE :after_rank IS NULL OR ranked.rank < :after_rank OR (ranked.rank = :after_rank AND ranked.id < :after_id)
+    ORDER BY ranked.rank DESC, ranked.id DESC
+    LIMIT :limit
+""".format(category_filter=_CATEGORY_FILTER))
+
+
+def _document(conversation_id: int, user_id: int, field: str, content: str, segment_id=None) -> dict:
+    return {
+        "conversation_id": conversation_id,
+        "user_id": user_id,
+        "field": field,
+        "segment_id": str(segment_id) if segment_id is not None else None,
+        "content": content or "",
+    }
+
+
+def index_new_conversation(db: db_dependency, conversation: Conversation) -> None:
+    db.execute(insert(SearchDocument), [_document(conversation.id, conversation.user_id, "name", conversation.name)])
+
+
+def update_search_index(
+    db: db_dependency,
+    conversation_id: int,
+    user_id: int,
+    diff: SegmentDiff,
+    name: Optional[str] = None,
+    summary: Optional[str] = None
+) -> bool:
+    # Only touching the rows for what changed (name and summary are passed only when they changed),
+    # so that appending segments costs O(new segments). Returns whether any documents were removed.
+    # Documents are inserted as plain rows in one statement, since their IDs are never needed here:
+    documents = []
+    for field, content in (("name", name), ("summary", summary)):
+        if content is None: continue
+        db.execute(delete(SearchDocument).where(
+            SearchDocument.conversation_id == conversation_id, SearchDocument.field == field
+        ))
+        documents.append(_document(conversation_id, user_id, field, content))
+
+    stale_ids = [str(segment.get("id")) for segment in diff.removed]
+    stale_ids += [str(old.get("id")) for old, new in diff.changed if old.get("text") != new.get("text")]
+    if stale_ids:
+        db.execute(delete(SearchDocument).where(
+            SearchDocument.conversation_id == conversation_id,
+            SearchDocument.field == "segment",
+            SearchDocument.segment_id.in_(stale_ids)
+        ))
+
+    fresh = diff.added + [new for old, new in diff.changed if old.get("text") != new.get("text")]
+    documents += [_document(conversation_id, user_id, "segment", segment.get("text"), segment.get("id")) for segment in fresh]
+    # Sending NULL segment IDs explicitly, so that name, summary and segment rows go in one batch:
+    if documents: db.execute(insert(SearchDocument).execution_options(render_nulls=True), documents)
+    return bool(stale_ids or name is not None or summary is not None)
+
+
+def _backfill_batch() -> int:
+    # Indexing conversations that have no name document, which every conversation gets once it is indexed.
+    # Rows are locked (and skipped when another worker holds them), and their documents are replaced rather than added,
+    # so that concurrent backfills and updates never leave duplicates:
+    db = SessionLocal()
+    try:
+        indexed = exists().where(SearchDocument.conversation_id == Conversation.id, SearchDocument.field == "name")
+        rows = db.execute(
+            select(Conversation, ConversationArchive.transcript_blob.label("archived_blob"))
+            .outerjoin(ConversationArchive, ConversationArchive.conversation_id == Conversation.id)
+            .where(~indexed)
+            .order_by(Conversation.id)
+            .limit(SEARCH_BACKFILL_BATCH_SIZE)
+            .with_for_update(of=Conversation, skip_locked=True)
+        ).all()
+        if not rows: return 0
+
+        ids = [row.Conversation.id for row in rows]
+        db.execute(delete(SearchDocument).where(SearchDocument.conversation_id.in_(ids)))
+        documents = []
+        for conversation, archived_blob in rows:
+            transcript = decode_transcript(archived_blob) if archived_blob is not None else conversation.transcript
+            documents.append(_document(conversation.id, conversation.user_id, "name", conversation.name))
+            if conversation.summary:
+                documents.append(_document(conversation.id, conversation.user_id, "summary", conversation.summary))
+            documents += [
+                _document(conversation.id, conversation.user_id, "segment", segment.get("text"), segment.get("id"))
+                for segment in transcript or []
+            ]
+        db.execute(insert(SearchDocument).execution_options(render_nulls=True), documents)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+    for user_id in {conversation.user_id for conversation, _ in rows}:
+        notify_documents_changed(user_id)
+    return len(rows)
+
+
+async def run_search_backfill() -> None:
+    # Runs once at startup, and does nothing once every conversation has been indexed:
+    total = 0
+    try:
+        while True:
+            indexed = await run_in_threadpool(_backfill_batch)
+            total += indexed
+            if indexed < SEARCH_BACKFILL_BATCH_SIZE: break
+    except Exception:
+        logger.exception("Backfilling the search index failed.")
+    if total: logger.info("Indexed %d conversations for search.", total)
+
+
+def _fts5_query(query: str) -> str:
+    # Quoting every term, so that user input cannot be interpreted as FTS5 query syntax,
+    # while keeping "OR" as an operator as in Postgres' websearch_to_tsquery:
+    terms = [term if term == "OR" else f'"{term}"' for term in re.findall(r"\w+", query)]
+    while terms and terms[0] == "OR": terms.pop(0)
+    while terms and terms[-1] == "OR": terms.pop()
+    return " ".join(term for index, term in enumerate(terms) if not (term == "OR" and terms[index - 1] == "OR"))
+
+
+def _encode_cursor(rank: float, document_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([rank, document_id]).encode()).decode()
+
+
+def _decode_cursor(cursor: Optional[str]) -> Tuple[Optional[float], Optional[int]]:
+    if not cursor: return None, None
+    try:
+        rank, document_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(rank), int(document_id)
+    except (ValueError, TypeError, binascii.Error):
+        raise InvalidSearchCursorException
+
+
+def search_conversations(
+    db: db_dependency,
+    user: user_dependency,
+    query: str,
+    limit: int = 20,
+    cursor: str = None,
+    category: Optional[str] = None
+) -> SearchResponse:
+    after_rank, after_id = _decode_cursor(cursor)
+
+    if db.get_bind().dialect.name == "postgresql":
+        statement, query_text = _POSTGRES_SEARCH, query
+    else:
+        statement, query_text = _SQLITE_SEARCH, _fts5_query(query)
+
+    if not query_text.strip(): return SearchResponse(results=[], next_cursor=None)
+
+    # Fetching one extra row to know whether there is a next page:
+    rows = db.execute(statement, {
+        "query": query_text,
+        "user_id": user.id,
+        "after_rank": after_rank,
+        "after_id": after_id,
+        "category": category,
+        "limit": limit + 1,
+    }).all()
+
+    results: List[SearchResult] = [
+        SearchResult(
+            conversation_id=row.conversation_id,
+            conversation_name=row.conversation_name,
+            field=row.field,
+            segment_id=row.segment_id,
+            snippet=row.snippet,
+            rank=row.rank,
+        )
+        for row in rows[:limit]
+    ]
+    next_cursor = _encode_cursor(rows[limit - 1].rank, rows[limit - 1].id) if len(rows) > limit else None
+    return SearchResponse(results=results, next_cursor=next_cursor)
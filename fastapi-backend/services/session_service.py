@@ -0,0 +1,236 @@
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime
+from typing import List, Dict, Any, Optional
+
+import orjson
+from fastapi import WebSocket, WebSocketDisconnect, HTTPException, status as st
+from pydantic import ValidationError
+from starlette.concurrency import run_in_threadpool
+
+import metrics
+from database import SessionLocal
+from dependencies import get_user
+from exceptions import JWTException
+from models import Conversation, User, transcript_values
+from schemas import PredictionResponse, SessionMessage, TRANSCRIPT_ADAPTER
+from security import decode_token
+from .conversation_service import build_prediction_messages, get_conversation, prediction_broadcaster, prediction_topic, speculator
+from .llm_service import stream_message
+from .search_service import update_search_index
+from .embedding_service import notify_documents_changed
+from .tagging_service import describe_topics, tag_segments
+from .usage_service import check_quota
+from .stats_service import apply_segment_diff, describe_stats, load_stats, save_stats
+from .transcript_service import SegmentDiff
+from .transcript_service import diff_segments, finalized_segments
+
+
+# Transcript changes are persisted once this many segments have changed, or this many seconds have passed:
+SESSION_FLUSH_SEGMENTS = int(os.getenv("SESSION_FLUSH_SEGMENTS", 10))
+SESSION_FLUSH_SECONDS = float(os.getenv("SESSION_FLUSH_SECONDS", 5))
+
+ACTIVE_SESSIONS = metrics.registry.gauge("recording_sessions_active", "Open WebSocket recording sessions.")
+SESSION_FLUSHES = metrics.registry.counter("recording_session_flushes_total", "Batched transcript writes from sessions.")
+
+logger = logging.getLogger(__name__)
+
+
+class TranscriptSession:
+    # In-memory state of a live recording, persisted to the DB in batches:
+
+    def __init__(self, user: User, conversation: Conversation, stats: Dict[str, Any], topics: str = ""):
+        self.user = user
+        self.conversation_id = conversation.id
+        self.context = conversation.context or ""
+        self.segments: List[Dict[str, Any]] = list(conversation.transcript or [])
+        self._positions = {segment.get("id"): index for index, segment in enumerate(self.segments)}
+
+        # The transcript as last written, for updating per-segment data by diff on each flush:
+        self._persisted = list(self.segments)
+
+        # Kept up to date in memory as segments arrive, and written with each flush:
+        self.stats = stats
+
+        # The conversation's main tagged topics, for the prompt, re-read on each flush as the tagging worker catches up:
+        self.topics = topics
+
+        self.pending_changes = 0
+        self.last_flush = time.monotonic()
+        self._flush_lock = asyncio.Lock()
+
+    def apply_segments(self, segments: List[Dict[str, Any]]) -> SegmentDiff:
+        # Replacing segments that already exist (e.g. finalized text or new translations) and appending new ones:
+        added, changed = [], []
+        for segment in segments:
+            position = self._positions.get(segment.get("id"))
+            if position is None:
+                self._positions[segment.get("id")] = len(self.segments)
+                self.segments.append(segment)
+                added.append(segment)
+            else:
+                changed.append((self.segments[position], segment))
+                self.segments[position] = segment
+        diff = SegmentDiff(added, changed, [])
+        self.stats = apply_segment_diff(self.stats, diff, self.segments)
+        self.pending_changes += len(segments)
+        return diff
+
+    def should_flush(self) -> bool:
+        if not self.pending_changes: return False
+        return (self.pending_changes >= SESSION_FLUSH_SEGMENTS
+                or time.monotonic() - self.last_flush >= SESSION_FLUSH_SECONDS)
+
+    def _write(self, segments: List[Dict[str, Any]], context: str, stats: Dict[str, Any]) -> SegmentDiff:
+        # Returns the changes written, since they were last persisted:
+        db = SessionLocal()
+        db.info["user_id"] = self.user.id
+        try:
+            diff = diff_segments(self._persisted, segments)
+            save_stats(db, self.conversation_id, stats)
+            documents_removed = update_search_index(db, self.conversation_id, self.user.id, diff)
+
+            # A single UPDATE, without loading the stored transcript first:
+            db.query(Conversation).filter_by(id=self.conversation_id, user_id=self.user.id).update({
+                **{getattr(Conversation, column): value for column, value in transcript_values(segments).items()},
+                Conversation.context: context,
+                Conversation.updated_at: datetime.now(),
+            }, synchronize_session=False)
+            db.commit()
+            self._persisted = segments
+            notify_documents_changed(self.user.id, removed=documents_removed)
+            self.topics = describe_topics(db, self.conversation_id)
+            return diff
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    async def flush(self, force: bool = False) -> int:
+        async with self._flush_lock:
+            if not self.pending_changes or not (force or self.should_flush()): return 0
+
+            flushed = self.pending_changes
+            self.pending_changes = 0
+            self.last_flush = time.monotonic()
+
+            try:
+                with metrics.stage("session_flush"):
+                    diff = await run_in_threadpool(self._write, list(self.segments), self.context, self.stats)
+            except Exception:
+                # Keeping the changes pending, so that the next flush retries them:
+                self.pending_changes += flushed
+                raise
+            tag_segments(self.user.id, self.conversation_id, diff)
+            SESSION_FLUSHES.inc()
+            return flushed
+
+
+def _load_session(token: str, conversation_id: int) -> TranscriptSession:
+    # Authenticating once for the lifetime of the connection:
+    user_id = decode_token(token).get("sub")
+    if user_id is None: raise JWTException
+
+    db = SessionLocal()
+    try:
+        user = get_user(db, int(user_id))
+        conversation = get_conversation(db, user, conversation_id)
+        return TranscriptSession(
+            user, conversation, load_stats(db, conversation.id, conversation.transcript), describe_topics(db, conversation.id)
+        )
+    finally:
+        db.close()
+
+
+async def _send_predictions(websocket: WebSocket, session: TranscriptSession) -> None:
+    try:
+        await check_quota(session.user)
+    except HTTPException as e:
+        await websocket.send_json({"type": "error", "detail": e.detail})
+        return
+
+    # Sharing the stream with other devices (and with a speculative run) for the same revision of the conversation:
+    messages = build_prediction_messages(session.segments, session.context, describe_stats(session.stats), session.topics)
+    topic = prediction_topic(session.user.id, session.conversation_id, session.segments, session.context)
+    async for line in prediction_broadcaster.stream(topic, lambda: stream_message(session.user, messages)):
+        await websocket.send_json({"type": "prediction", **PredictionResponse(**orjson.loads(line)).model_dump()})
+
+
+def _log_prediction_failure(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Sending session predictions failed.", exc_info=task.exception())
+
+
+async def _flush_periodically(session: TranscriptSession) -> None:
+    # Making sure quiet periods still get persisted within SESSION_FLUSH_SECONDS:
+    while True:
+        await asyncio.sleep(SESSION_FLUSH_SECONDS)
+        try:
+            await session.flush()
+        except Exception:
+            # The changes stay pending, so carrying on lets the next flush retry them:
+            logger.exception("Flushing recording session for conversation %d failed.", session.conversation_id)
+
+
+async def run_transcript_session(websocket: WebSocket, conversation_id: int, token: str) -> None:
+    try:
+        session = await run_in_threadpool(_load_session, token, conversation_id)
+    except HTTPException as e:
+        await websocket.close(code=st.WS_1008_POLICY_VIOLATION, reason=str(e.detail))
+        return
+
+    await websocket.accept()
+    ACTIVE_SESSIONS.inc()
+    flusher = asyncio.create_task(_flush_periodically(session))
+    prediction: Optional[asyncio.Task] = None
+
+    try:
+        while True:
+            try:
+                message = SessionMessage.model_validate(await websocket.receive_json())
+            except (ValidationError, ValueError) as e:
+                await websocket.send_json({"type": "error", "detail": f"Invalid message: {e}"})
+                continue
+
+            if message.segments:
+                diff = session.apply_segments(TRANSCRIPT_ADAPTER.dump_python(message.segments, exclude_unset=True))
+                # Not speculating when the message asks for the prediction itself, which then owns its upstream stream:
+                if finalized_segments(diff) and not (message.type == "predict" or message.predict):
+                    speculator.speculate(
+                        session.user, session.conversation_id, session.segments, session.context, session.stats, session.topics
+                    )
+            if message.context is not None:
+                session.context = message.context
+                session.pending_changes += 1
+
+            try:
+                flushed = await session.flush(force=message.type == "flush")
+            except Exception:
+                # The changes stay pending, so keeping the recording open lets a later flush retry them:
+                logger.exception("Flushing recording session for conversation %d failed.", session.conversation_id)
+                await websocket.send_json({"type": "error", "detail": "Saving the transcript failed. It will be retried."})
+            else:
+                if message.type == "flush": await websocket.send_json({"type": "saved", "segments": flushed})
+
+            if message.type == "predict" or message.predict:
+                # Only the prediction for the latest transcript is useful, so replacing any in-flight one:
+                if prediction is not None and not prediction.done():
+                    prediction.cancel()
+                prediction = asyncio.create_task(_send_predictions(websocket, session))
+                prediction.add_done_callback(_log_prediction_failure)
+
+    except WebSocketDisconnect:
+        pass
+
+    finally:
+        ACTIVE_SESSIONS.dec()
+        flusher.cancel()
+        if prediction is not None:
+            prediction.cancel()
+        try:
+            await session.flush(force=True)
+        except Exception:
+            logger.exception("Saving recording session for conversation %d on close failed.", session.conversation_id)
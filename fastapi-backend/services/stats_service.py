@@ -0,0 +1,178 @@
+import os
+import copy
+from typing import Any, Dict, List
+
+from sqlalchemy import select
+
+from dependencies import db_dependency, user_dependency
+from exceptions import ConversationNotFoundException
+from models import Conversation, ConversationStats
+from schemas import ConversationStatsResponse, SpeakerStats
+from .archive_service import rehydrate_conversation
+from .transcript_service import SegmentDiff
+
+# Gaps between segment timestamps (in ms) longer than this are treated as silence, not talk time:
+MAX_SEGMENT_GAP_MS = int(os.getenv("STATS_MAX_SEGMENT_GAP_MS", 30000))
+
+Stats = Dict[str, Any]
+
+
+def _empty_stats() -> Stats:
+    return {
+        "speakers": {},
+        "segments": 0,
+        "words": 0,
+        "first_timestamp": None,
+        "last_timestamp": None,
+        "last_speaker": None,
+        "last_segment_id": None,
+    }
+
+
+def _words(segment: dict) -> int:
+    return len(str(segment.get("text") or "").split())
+
+
+def _append(stats: Stats, segments: List[dict]) -> None:
+    # Adding segments to the end of the transcript in O(len(segments)).
+    # A segment's talk time is the gap until the next segment, so it is counted once that segment arrives:
+    for segment in segments:
+        speaker = segment.get("speaker") or ""
+        words = _words(segment)
+        timestamp = segment.get("timestamp")
+
+        totals = stats["speakers"].setdefault(speaker, {"words": 0, "segments": 0, "turns": 0, "talk_ms": 0})
+        totals["words"] += words
+        totals["segments"] += 1
+        if speaker != stats["last_speaker"] or not stats["segments"]:
+            totals["turns"] += 1
+
+        if timestamp is not None:
+            if stats["last_timestamp"] is not None and stats["last_speaker"] is not None:
+                gap = min(max(timestamp - stats["last_timestamp"], 0), MAX_SEGMENT_GAP_MS)
+                stats["speakers"][stats["last_speaker"]]["talk_ms"] += gap
+            if stats["first_timestamp"] is None:
+                stats["first_timestamp"] = timestamp
+            stats["last_timestamp"] = timestamp
+
+        stats["segments"] += 1
+        stats["words"] += words
+        stats["last_speaker"] = speaker
+        stats["last_segment_id"] = str(segment.get("id"))
+
+
+def compute_stats(transcript: List[dict]) -> Stats:
+    stats = _empty_stats()
+    _append(stats, transcript or [])
+    return stats
+
+
+def _is_append(stats: Stats, added: List[dict], transcript: List[dict]) -> bool:
+    # Whether the added segments are exactly the end of the transcript, following the last segment counted so far:
+    if len(added) > len(transcript): return False
+    if [segment.get("id") for segment in transcript[-len(added):]] != [segment.get("id") for segment in added]:
+        return False
+
+    previous = transcript[-len(added) - 1] if len(transcript) > len(added) else None
+    if previous is None: return stats["segments"] == 0
+    return str(previous.get("id")) == stats["last_segment_id"]
+
+
+def apply_segment_diff(stats: Stats, diff: SegmentDiff, transcript: List[dict]) -> Stats:
+    # Updating in O(changes) for the common cases (new segments at the end, and text edits),
+    # and recomputing only when segments were removed, reordered, or moved between speakers or in time:
+    if not diff: return stats
+
+    text_only = all(
+        old.get("speaker") == new.get("speaker") and old.get("timestamp") == new.get("timestamp")
+        and (new.get("speaker") or "") in stats["speakers"]
+        for old, new in diff.changed
+    )
+    if diff.removed or not text_only or (diff.added and not _is_append(stats, diff.added, transcript)):
+        return compute_stats(transcript)
+
+    stats = copy.deepcopy(stats)
+    for old, new in diff.changed:
+        delta = _words(new) - _words(old)
+        stats["speakers"][new.get("speaker") or ""]["words"] += delta
+        stats["words"] += delta
+    _append(stats, diff.added)
+    return stats
+
+
+def update_conversation_stats(db: db_dependency, conversation: Conversation, diff: SegmentDiff) -> None:
+    if not diff and conversation.stats is not None: return
+
+    if conversation.stats is None:
+        # Computing the stats in full the first time, which also covers conversations created before them:
+        conversation.stats = ConversationStats(stats=compute_stats(conversation.transcript))
+    else:
+        conversation.stats.stats = apply_segment_diff(conversation.stats.stats, diff, conversation.transcript or [])
+
+
+def load_stats(db: db_dependency, conversation_id: int, transcript: List[dict]) -> Stats:
+    stats = db.get(ConversationStats, conversation_id)
+    return stats.stats if stats is not None else compute_stats(transcript)
+
+
+def save_stats(db: db_dependency, conversation_id: int, stats: Stats) -> None:
+    # Writing the stats as-is, for callers that maintain them in memory (e.g. recording sessions):
+    db.merge(ConversationStats(conversation_id=conversation_id, stats=stats))
+
+
+def build_stats_response(conversation_id: int, stats: Stats) -> ConversationStatsResponse:
+    total_talk_ms = sum(totals["talk_ms"] for totals in stats["speakers"].values())
+
+    def per_minute(words: int, milliseconds: float):
+        return round(words / (milliseconds / 60000), 1) if milliseconds > 0 else None
+
+    duration_ms = (stats["last_timestamp"] - stats["first_timestamp"]) if stats["first_timestamp"] is not None else 0
+    speakers = [
+        SpeakerStats(
+            speaker=speaker,
+            words=totals["words"],
+            segments=totals["segments"],
+            turns=totals["turns"],
+            talk_time_seconds=totals["talk_ms"] / 1000,
+            talk_time_share=round(totals["talk_ms"] / total_talk_ms, 3) if total_talk_ms else 0.0,
+            words_per_minute=per_minute(totals["words"], totals["talk_ms"]),
+        )
+        for speaker, totals in sorted(stats["speakers"].items(), key=lambda item: -item[1]["words"])
+    ]
+    return ConversationStatsResponse(
+        conversation_id=conversation_id,
+        segments=stats["segments"],
+        words=stats["words"],
+        duration_seconds=duration_ms / 1000,
+        words_per_minute=per_minute(stats["words"], duration_ms),
+        speakers=speakers,
+    )
+
+
+def describe_stats(stats: Stats) -> str:
+    # A compact summary of the stats for the prediction prompt:
+    response = build_stats_response(0, stats)
+    return "; ".join(
+        f"{speaker.speaker or 'Unknown'}: {speaker.turns} turns, {speaker.words} words, "
+        f"{speaker.talk_time_share:.0%} of talk time"
+        + (f", {speaker.words_per_minute:.0f} wpm" if speaker.words_per_minute else "")
+        for speaker in response.speakers
+    )
+
+
+def get_conversation_stats(db: db_dependency, user: user_dependency, conversation_id: int) -> ConversationStatsResponse:
+    # Reading only the stats row (and the conversation's owner), never the transcript, unless the stats do not exist yet:
+    row = db.execute(
+        select(Conversation.id, ConversationStats.stats)
+        .outerjoin(ConversationStats, ConversationStats.conversation_id == Conversation.id)
+        .where(Conversation.id == conversation_id, Conversation.user_id == user.id)
+    ).first()
+    if row is None: raise ConversationNotFoundException
+    if row.stats is not None: return build_stats_response(conversation_id, row.stats)
+
+    conversation = db.get(Conversation, conversation_id)
+    if conversation.archived_at is not None:
+        rehydrate_conversation(db, conversation)
+    update_conversation_stats(db, conversation, SegmentDiff([], [], []))
+    db.commit()
+    return build_stats_response(conversation_id, conversation.stats.stats)
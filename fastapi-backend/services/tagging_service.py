@@ -0,0 +1,232 @@
+import os
+import asyncio
+import logging
+from collections import defaultdict
+from enum import Enum
+from typing import Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+from sqlalchemy import delete, exists, func, insert, select
+from starlette.concurrency import run_in_threadpool
+
+import metrics
+from database import SessionLocal
+from dependencies import db_dependency
+from models import Conversation, SearchDocument, SegmentTag
+from .transcript_service import SegmentDiff, finalized_segments
+
+
+TOPIC_TAGGING_ENABLED = os.getenv("TOPIC_TAGGING_ENABLED", "false").lower() == "true"
+
+# Segments waiting to be tagged, and how many are scored together. Once the queue is full, ingestion carries on and the
+# affected conversations are caught up from their search documents when the worker has drained the queue:
+TAGGING_QUEUE_SIZE = int(os.getenv("TAGGING_QUEUE_SIZE", 2000))
+TAGGING_BATCH_SIZE = int(os.getenv("TAGGING_BATCH_SIZE", 64))
+TAGGING_RETRY_SECONDS = float(os.getenv("TAGGING_RETRY_SECONDS", 30))
+
+# Each segment keeps its best category, and up to TAGS_PER_SEGMENT in total that score at least TAG_MIN_SCORE:
+TAGS_PER_SEGMENT = int(os.getenv("TAGS_PER_SEGMENT", 2))
+TAG_MIN_SCORE = float(os.getenv("TAG_MIN_SCORE", 0.3))
+
+# Topics named in the prediction prompt, the most tagged first:
+PROMPT_TOPICS = int(os.getenv("PROMPT_TOPICS", 3))
+
+TAGGED_SEGMENTS = metrics.registry.counter("segment_tagging_segments_total", "Transcript segments scored by the tagging worker.")
+TAGGING_OVERFLOWS = metrics.registry.counter(
+    "segment_tagging_overflows_total", "Segment changes left to catch-up because the tagging queue was full."
+)
+metrics.registry.gauge("segment_tagging_queue_depth", "Segment changes waiting to be tagged.", lambda: _queue.qsize())
+
+# (user ID, conversation ID, segment ID, text), where no text means the segment's tags are to be removed:
+TagItem = Tuple[int, int, str, Optional[str]]
+
+_queue: "asyncio.Queue[TagItem]" = asyncio.Queue(maxsize=TAGGING_QUEUE_SIZE)
+_overflowed: Set[int] = set()
+
+# Cleared when the model cannot be loaded, so that changes stop being queued for nothing:
+_available = True
+
+logger = logging.getLogger(__name__)
+
+
+def _extractor():
+    # Imported lazily, so that sentence-transformers is only needed when tagging is enabled:
+    from .ml_services.keyword_extraction import KeywordExtractor
+    return KeywordExtractor()
+
+
+def _category_name(category: Hashable) -> str:
+    return category.value if isinstance(category, Enum) else str(category)
+
+
+def tag_segments(user_id: int, conversation_id: int, diff: SegmentDiff) -> None:
+    # Called on the event loop after commits that changed a transcript. Never waits, so that ingestion is unaffected:
+    if not TOPIC_TAGGING_ENABLED or not _available or not diff: return
+
+    items: List[TagItem] = [(user_id, conversation_id, str(segment.get("id")), None) for segment in diff.removed]
+    items += [
+        (user_id, conversation_id, str(segment.get("id")), segment.get("text") or None)
+        for segment in finalized_segments(diff)
+    ]
+    for item in items:
+        try:
+            _queue.put_nowait(item)
+        except asyncio.QueueFull:
+            TAGGING_OVERFLOWS.inc()
+            _overflowed.add(conversation_id)
+            return
+
+
+def _score(texts: List[str]) -> List[List[Tuple[str, float]]]:
+    # The categories kept for each text, scored in one batch:
+    extractor = _extractor()
+    keys, scores = extractor.score_embeddings(extractor.embed(texts))
+    tags = []
+    for row in scores:
+        best = np.argsort(-row)[:TAGS_PER_SEGMENT]
+        tags.append([
+            (_category_name(keys[position]), float(row[position]))
+            for rank, position in enumerate(best) if rank == 0 or row[position] >= TAG_MIN_SCORE
+        ])
+    return tags
+
+
+def _tag_batch(items: Iterable[TagItem]) -> None:
+    # Keeping only the latest change of each segment in the batch:
+    latest: Dict[Tuple[int, str], Tuple[int, Optional[str]]] = {}
+    for user_id, conversation_id, segment_id, text in items:
+        latest[(conversation_id, segment_id)] = (user_id, text)
+
+    scored = [(key, user_id, text) for key, (user_id, text) in latest.items() if text]
+    rows = []
+    if scored:
+        for ((conversation_id, segment_id), user_id, _), tags in zip(scored, _score([text for _, _, text in scored])):
+            rows += [
+                {"conversation_id": conversation_id, "user_id": user_id, "segment_id": segment_id, "category": category, "score": score}
+                for category, score in tags
+            ]
+    TAGGED_SEGMENTS.inc(len(scored))
+
+    segments = defaultdict(list)
+    for conversation_id, segment_id in latest:
+        segments[conversation_id].append(segment_id)
+
+    db = SessionLocal()
+    try:
+        # Skipping conversations deleted since their segments were queued:
+        live = set(db.scalars(select(Conversation.id).where(Conversation.id.in_(list(segments)))))
+        for conversation_id, segment_ids in segments.items():
+            if conversation_id not in live: continue
+            db.execute(delete(SegmentTag).where(
+                SegmentTag.conversation_id == conversation_id, SegmentTag.segment_id.in_(segment_ids)
+            ))
+        rows = [row for row in rows if row["conversation_id"] in live]
+        if rows: db.execute(insert(SegmentTag), rows)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def _untagged_segments(conversation_ids: List[int]) -> List[TagItem]:
+    # Catching conversations up from their segment search documents: tagging segments without tags, and removing
+    # the tags of segments that no longer exist. Every tagged segment has at least one tag, so nothing is scored twice:
+    db = SessionLocal()
+    try:
+        tagged = exists().where(
+            SegmentTag.conversation_id == SearchDocument.conversation_id, SegmentTag.segment_id == SearchDocument.segment_id
+        )
+        documents = db.execute(
+            select(SearchDocument.user_id, SearchDocument.conversation_id, SearchDocument.segment_id, SearchDocument.content)
+            .where(
+                SearchDocument.conversation_id.in_(conversation_ids),
+                SearchDocument.field == "segment",
+                SearchDocument.content != "",
+                ~tagged,
+            )
+        ).all()
+
+        current = exists().where(
+            SearchDocument.conversation_id == SegmentTag.conversation_id,
+            SearchDocument.field == "segment",
+            SearchDocument.segment_id == SegmentTag.segment_id,
+        )
+        db.execute(delete(SegmentTag).where(SegmentTag.conversation_id.in_(conversation_ids), ~current))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+    return [(document.user_id, document.conversation_id, document.segment_id, document.content) for document in documents]
+
+
+def _conversations_missing_tags() -> Set[int]:
+    db = SessionLocal()
+    try:
+        tagged = exists().where(
+            SegmentTag.conversation_id == SearchDocument.conversation_id, SegmentTag.segment_id == SearchDocument.segment_id
+        )
+        return set(db.scalars(
+            select(SearchDocument.conversation_id).distinct()
+            .where(SearchDocument.field == "segment", SearchDocument.content != "", ~tagged)
+        ))
+    finally:
+        db.close()
+
+
+async def _catch_up() -> None:
+    conversation_ids = list(_overflowed)
+    _overflowed.clear()
+    try:
+        items = await run_in_threadpool(_untagged_segments, conversation_ids)
+        for start in range(0, len(items), TAGGING_BATCH_SIZE):
+            await run_in_threadpool(_tag_batch, items[start:start + TAGGING_BATCH_SIZE])
+    except Exception:
+        logger.exception("Catching up segment tags failed.")
+        _overflowed.update(conversation_ids)
+        await asyncio.sleep(TAGGING_RETRY_SECONDS)
+
+
+async def run_tagging_worker() -> None:
+    global _available
+    try:
+        # Loading the model up front, so that a missing dependency is reported once rather than on every batch:
+        await run_in_threadpool(_extractor)
+        # Picking up segments that were never tagged, e.g. queued before a restart or ingested before tagging:
+        _overflowed.update(await run_in_threadpool(_conversations_missing_tags))
+    except Exception:
+        _available = False
+        logger.exception("Topic tagging is unavailable: the embedding model could not be loaded.")
+        return
+
+    while True:
+        if _overflowed and _queue.empty():
+            await _catch_up()
+            continue
+
+        batch = [await _queue.get()]
+        while len(batch) < TAGGING_BATCH_SIZE and not _queue.empty():
+            batch.append(_queue.get_nowait())
+
+        try:
+            await run_in_threadpool(_tag_batch, batch)
+        except Exception:
+            logger.exception("Tagging transcript segments failed.")
+            _overflowed.update(conversation_id for _, conversation_id, _, _ in batch)
+
+
+def describe_topics(db: db_dependency, conversation_id: int) -> str:
+    # The conversation's most tagged categories, for the prediction prompt, from stored tags rather than re-scoring:
+    if not TOPIC_TAGGING_ENABLED: return ""
+    count = func.count().label("count")
+    rows = db.execute(
+        select(SegmentTag.category, count)
+        .where(SegmentTag.conversation_id == conversation_id)
+        .group_by(SegmentTag.category)
+        .order_by(count.desc(), SegmentTag.category)
+        .limit(PROMPT_TOPICS)
+    ).all()
+    return ", ".join(row.category for row in rows)
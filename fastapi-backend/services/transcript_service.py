@@ -0,0 +1,50 @@
+from typing import Any, Dict, List, Optional, Tuple
+
+
+Segment = Dict[str, Any]
+
+
+class SegmentDiff:
+    # Segments added, changed (as old/new pairs) and removed between two versions of a transcript:
+
+    def __init__(self, added: List[Segment], changed: List[Tuple[Segment, Segment]], removed: List[Segment]):
+        self.added = added
+        self.changed = changed
+        self.removed = removed
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.changed or self.removed)
+
+
+def diff_segments(old: Optional[List[Segment]], new: Optional[List[Segment]]) -> SegmentDiff:
+    # Matching segments by id, so that per-segment derived data can be maintained in O(changes) writes:
+    old_by_id = {segment.get("id"): segment for segment in old or []}
+    new_ids = set()
+    added, changed = [], []
+
+    for segment in new or []:
+        segment_id = segment.get("id")
+        new_ids.add(segment_id)
+        previous = old_by_id.get(segment_id)
+
+        if previous is None:
+            added.append(segment)
+        elif previous != segment:
+            changed.append((previous, segment))
+
+    removed = [segment for segment_id, segment in old_by_id.items() if segment_id not in new_ids]
+    return SegmentDiff(added, changed, removed)
+
+
+def is_final(segment: Segment) -> bool:
+    # Segments are final unless the client marks them as interim (e.g. live speech recognition) with "final": false:
+    return segment.get("final", True) is not False
+
+
+def finalized_segments(diff: SegmentDiff) -> List[Segment]:
+    # Segments that became final with this change: new final ones, interim ones that were finalized,
+    # and final ones whose text was corrected. Translations being added do not count:
+    return [segment for segment in diff.added if is_final(segment)] + [
+        new for old, new in diff.changed
+        if is_final(new) and (not is_final(old) or old.get("text") != new.get("text"))
+    ]
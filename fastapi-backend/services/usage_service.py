@@ -0,0 +1,202 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import defaultdict
+from datetime import datetime, date, UTC
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import select, func
+from sqlalchemy.dialects import postgresql, sqlite
+from starlette.concurrency import run_in_threadpool
+
+import metrics
+from database import SessionLocal
+from dependencies import user_dependency
+from enums import AIModel
+from exceptions import QuotaExceededException
+from models import TokenUsage
+
+
+# Tokens (prompt + completion) each user may use per UTC day, where 0 means unlimited. Admins are exempt:
+DAILY_TOKEN_QUOTA = int(os.getenv("DAILY_TOKEN_QUOTA", 0))
+
+# Usage is held in memory and written in batches this often:
+USAGE_FLUSH_SECONDS = float(os.getenv("USAGE_FLUSH_SECONDS", 10))
+
+# How long a user's stored daily total is trusted before re-reading it, which picks up usage from other workers:
+QUOTA_REFRESH_SECONDS = float(os.getenv("QUOTA_REFRESH_SECONDS", 60))
+
+USAGE_FLUSHES = metrics.registry.counter("usage_flushes_total", "Batched token usage writes.")
+QUOTA_REJECTIONS = metrics.registry.counter("usage_quota_rejections_total", "Prediction requests rejected by the daily quota.")
+
+logger = logging.getLogger(__name__)
+
+UsageKey = Tuple[int, str, date]
+
+
+class _QuotaState:
+    # A user's daily total as last read from the DB, plus what this process has recorded since:
+
+    def __init__(self, stored: int, local: int):
+        self.stored = stored
+        self.local = local
+        self.loaded_at = time.monotonic()
+
+    @property
+    def total(self) -> int:
+        return self.stored + self.local
+
+
+class UsageAggregator:
+    # Token usage aggregated per user, model and day, so that the request path never writes to the DB:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Held for the whole of a flush, and while a stored total is read, so that no usage moves from pending
+        # to the DB between reading the one and the other:
+        self._flush_lock = threading.Lock()
+        # Counts of [requests, prompt, cached, completion] tokens that have not been written yet:
+        self._pending: Dict[UsageKey, List[int]] = defaultdict(lambda: [0, 0, 0, 0])
+        self._quotas: Dict[Tuple[int, date], _QuotaState] = {}
+
+    def record(self, user_id: int, model: AIModel, prompt_tokens: int, cached_tokens: int, completion_tokens: int) -> None:
+        today = datetime.now(UTC).date()
+        with self._lock:
+            counts = self._pending[(user_id, model.value, today)]
+            counts[0] += 1
+            counts[1] += prompt_tokens
+            counts[2] += cached_tokens
+            counts[3] += completion_tokens
+
+            state = self._quotas.get((user_id, today))
+            if state is not None:
+                state.local += prompt_tokens + completion_tokens
+
+    def _pending_tokens(self, user_id: int, day: date) -> int:
+        return sum(
+            counts[1] + counts[3] for (pending_user, _, pending_day), counts in self._pending.items()
+            if pending_user == user_id and pending_day == day
+        )
+
+    def _stored_tokens(self, user_id: int, day: date) -> int:
+        db = SessionLocal()
+        try:
+            return db.execute(
+                select(func.coalesce(func.sum(TokenUsage.prompt_tokens + TokenUsage.completion_tokens), 0))
+                .where(TokenUsage.user_id == user_id, TokenUsage.day == day)
+            ).scalar_one()
+        finally:
+            db.close()
+
+    def cached_tokens_used_today(self, user_id: int) -> Optional[int]:
+        # Answering from memory, or None when the user's stored total has not been read for QUOTA_REFRESH_SECONDS:
+        today = datetime.now(UTC).date()
+        with self._lock:
+            state = self._quotas.get((user_id, today))
+            if state is not None and time.monotonic() - state.loaded_at < QUOTA_REFRESH_SECONDS:
+                return state.total
+        return None
+
+    def tokens_used_today(self, user_id: int) -> int:
+        # Reads the DB when the cached total is stale, so it is called through the threadpool:
+        cached = self.cached_tokens_used_today(user_id)
+        if cached is not None: return cached
+
+        today = datetime.now(UTC).date()
+        with self._flush_lock:
+            stored = self._stored_tokens(user_id, today)
+            with self._lock:
+                # Usage that is still pending is not in the DB yet, so it is carried over:
+                state = _QuotaState(stored, self._pending_tokens(user_id, today))
+                self._quotas[(user_id, today)] = state
+
+                # Dropping quota states from previous days:
+                for key in [key for key in self._quotas if key[1] != today]:
+                    del self._quotas[key]
+                return state.total
+
+    def discard_user(self, user_id: int) -> None:
+        # Forgetting a deleted user's usage, which could no longer be written:
+        with self._lock:
+            for key in [key for key in self._pending if key[0] == user_id]:
+                del self._pending[key]
+            for key in [key for key in self._quotas if key[0] == user_id]:
+                del self._quotas[key]
+
+    def flush(self) -> int:
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self) -> int:
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(lambda: [0, 0, 0, 0])
+        if not pending: return 0
+
+        rows = [
+            {
+                "user_id": user_id, "model": model, "day": day, "requests": counts[0],
+                "prompt_tokens": counts[1], "cached_tokens": counts[2], "completion_tokens": counts[3],
+            }
+            for (user_id, model, day), counts in pending.items()
+        ]
+
+        db = SessionLocal()
+        try:
+            # Adding to existing rows in a single upsert, rather than reading them first:
+            dialect = postgresql if db.get_bind().dialect.name == "postgresql" else sqlite
+            statement = dialect.insert(TokenUsage).values(rows)
+            db.execute(statement.on_conflict_do_update(
+                index_elements=["user_id", "model", "day"],
+                set_={
+                    column: getattr(TokenUsage, column) + getattr(statement.excluded, column)
+                    for column in ("requests", "prompt_tokens", "cached_tokens", "completion_tokens")
+                },
+            ))
+            db.commit()
+        except Exception:
+            db.rollback()
+            # Putting the usage back, so that the next flush retries it:
+            with self._lock:
+                for key, counts in pending.items():
+                    merged = self._pending[key]
+                    for index, count in enumerate(counts):
+                        merged[index] += count
+            raise
+        finally:
+            db.close()
+
+        USAGE_FLUSHES.inc()
+        return len(rows)
+
+
+aggregator = UsageAggregator()
+
+
+def record_usage(user: user_dependency, model: AIModel, prompt_tokens: int, cached_tokens: int, completion_tokens: int) -> None:
+    aggregator.record(user.id, model, prompt_tokens, cached_tokens, completion_tokens)
+
+
+async def check_quota(user: user_dependency) -> None:
+    if not DAILY_TOKEN_QUOTA or user.is_admin: return
+
+    # Only going to the threadpool when the stored total has to be re-read:
+    used = aggregator.cached_tokens_used_today(user.id)
+    if used is None: used = await run_in_threadpool(aggregator.tokens_used_today, user.id)
+    if used >= DAILY_TOKEN_QUOTA:
+        QUOTA_REJECTIONS.inc()
+        raise QuotaExceededException
+
+
+async def run_usage_flush_periodically() -> None:
+    try:
+        while True:
+            await asyncio.sleep(USAGE_FLUSH_SECONDS)
+            try:
+                await run_in_threadpool(aggregator.flush)
+            except Exception:
+                logger.exception("Writing token usage failed.")
+    finally:
+        # Writing what is left when the application shuts down:
+        await run_in_threadpool(aggregator.flush)
@@ -1,21 +1,48 @@
 import os
+import asyncio
+import logging
 import secrets
 from datetime import datetime, timedelta, UTC
+from typing import Optional
 
+from sqlalchemy import delete, func, select, update
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.attributes import set_committed_value
 from fastapi import BackgroundTasks
+from starlette.concurrency import run_in_threadpool
 
 from exceptions import UserExistsException, UserNotFoundException, InvalidCodeException, OAuthProviderException
 from dependencies import db_dependency, user_dependency
 from schemas import UserRequest
 from enums import CodeType
 from .email_service import send_email
-from models import User
-from security import bcrypt_context
+from .conversation_service import delete_conversation_rows
+from .embedding_service import notify_documents_changed
+from .usage_service import aggregator
+from models import Conversation, SearchDocument, TokenUsage, User, UserPreferenceFeatures
+from database import SessionLocal
+from security import bcrypt_context, hash_code, verify_code_hash
 
 VERIFICATION_CODE_TTL = int(os.getenv("VERIFICATION_CODE_TTL"))
 RESET_PASSWORD_CODE_TTL = int(os.getenv("RESET_PASSWORD_CODE_TTL"))
 
+# Wrong guesses allowed per code before it is invalidated, which is what keeps 6-digit codes safe:
+MAX_CODE_ATTEMPTS = int(os.getenv("MAX_CODE_ATTEMPTS", 5))
+CODE_SWEEP_INTERVAL_SECONDS = int(os.getenv("CODE_SWEEP_INTERVAL_SECONDS", 600))
+
+# Accounts with more conversations than this are deleted in the background, this many conversations per transaction:
+USER_DELETE_SYNC_LIMIT = int(os.getenv("USER_DELETE_SYNC_LIMIT", 100))
+USER_DELETE_BATCH_SIZE = int(os.getenv("USER_DELETE_BATCH_SIZE", 100))
+USER_DELETE_RETRY_SECONDS = int(os.getenv("USER_DELETE_RETRY_SECONDS", 300))
+
+# The user columns holding each type of code, its expiry, and the number of attempts made:
+CODE_COLUMNS = {
+    CodeType.VERIFICATION: (User.verification_code, User.verification_code_expires, User.verification_code_attempts),
+    CodeType.RESET_PASSWORD: (User.reset_password_code, User.reset_password_code_expires, User.reset_password_code_attempts),
+}
+
+logger = logging.getLogger(__name__)
+
 
 def create_user(db: db_dependency, user_data: UserRequest, background_tasks: BackgroundTasks) -> User:
     new_user = User(
@@ -25,10 +52,11 @@ def create_user(db: db_dependency, user_data: UserRequest, background_tasks: Bac
     )
 
     try:
+        # Inserting (which returns the new ID) and storing the verification code in one transaction:
         db.add(new_user)
-        db.commit()
-        db.refresh(new_user) 
-        
+        db.flush()
+        db.info["user_id"] = new_user.id
+
         # Automatically sending verification code:
         generate_code(db, new_user, CodeType.VERIFICATION, email=True, background_tasks=background_tasks)
 
@@ -41,7 +69,7 @@ def create_user(db: db_dependency, user_data: UserRequest, background_tasks: Bac
 
 def get_user_by_email(db: db_dependency, email: str, exclude_oauth: bool = False) -> User:
     user = db.query(User).filter_by(email=email.lower()).first()
-    if user is None: raise UserNotFoundException
+    if user is None or user.deletion_requested_at is not None: raise UserNotFoundException
     if exclude_oauth and user.oauth_provider: raise OAuthProviderException
     return user
 
@@ -60,31 +88,51 @@ def generate_code(
     
     now_utc = datetime.now(UTC)
     plaintext_code = _generate_code()
-    hashed_code = bcrypt_context.hash(plaintext_code)
+    hashed_code = hash_code(user.id, type.value, plaintext_code)
 
     if type == CodeType.VERIFICATION:
         user.verification_code = hashed_code
         user.verification_code_expires = now_utc + timedelta(minutes=VERIFICATION_CODE_TTL)
+        user.verification_code_attempts = 0
 
     elif type == CodeType.RESET_PASSWORD:
         user.reset_password_code = hashed_code
         user.reset_password_code_expires = now_utc + timedelta(minutes=RESET_PASSWORD_CODE_TTL)
+        user.reset_password_code_attempts = 0
 
     db.commit()
-    db.refresh(user)
-    
+
     if email:
         subject = "Verification Code" if type == CodeType.VERIFICATION else "Reset Password Code"
         body = f"Your {type.name.lower()} code is {plaintext_code}"
         if background_tasks:
             background_tasks.add_task(send_email, user.email, subject, body)
 
-    print(f"\033[1;34mCode (plaintext): {plaintext_code}\033[0m")
+    # Only for local development, where codes are not emailed:
+    logger.debug("Generated %s code for user %d: %s", type.name.lower(), user.id, plaintext_code)
 
     return plaintext_code
 
 
-def verify_code(user: user_dependency, code: str, type: CodeType) -> None:
+def _count_attempt(db: db_dependency, user: user_dependency, type: CodeType) -> bool:
+    # Counting the attempt with a conditional UPDATE before checking the code, so that concurrent guesses
+    # cannot exceed the limit. Returns whether the attempt is allowed:
+    _, _, attempts = CODE_COLUMNS[type]
+    counted = db.execute(
+        update(User)
+        .where(User.id == user.id, attempts < MAX_CODE_ATTEMPTS)
+        .values({attempts: attempts + 1})
+        .returning(attempts)
+        .execution_options(synchronize_session=False)
+    ).scalar_one_or_none()
+    db.commit()
+
+    # Keeping the loaded user in step, since objects are not expired on commit:
+    if counted is not None: set_committed_value(user, attempts.key, counted)
+    return counted is not None
+
+
+def verify_code(db: db_dependency, user: user_dependency, code: str, type: CodeType) -> None:
     if type == CodeType.VERIFICATION:
         correct_hash = user.verification_code
         expires = user.verification_code_expires
@@ -92,9 +140,16 @@ def verify_code(user: user_dependency, code: str, type: CodeType) -> None:
         correct_hash = user.reset_password_code
         expires = user.reset_password_code_expires
 
-    expired = expires and expires < datetime.now(UTC)
-    # Ensuring the code is correct and not expired:
-    if expired or (not bcrypt_context.verify(code, correct_hash)):
+    # SQLite returns naive datetimes, which are stored in UTC:
+    if expires is not None and expires.tzinfo is None:
+        expires = expires.replace(tzinfo=UTC)
+
+    expired = expires is None or expires < datetime.now(UTC)
+    if correct_hash is None or expired or not _count_attempt(db, user, type):
+        raise InvalidCodeException
+
+    # Ensuring the code is correct, in constant time:
+    if not verify_code_hash(user.id, type.value, code, correct_hash):
         raise InvalidCodeException
 
     # If we get here, the code matches and is not expired, so clearing the fields to prevent reuse:
@@ -102,10 +157,12 @@ def verify_code(user: user_dependency, code: str, type: CodeType) -> None:
         user.is_verified = True
         user.verification_code = None
         user.verification_code_expires = None
+        user.verification_code_attempts = 0
 
     elif type == CodeType.RESET_PASSWORD:
         user.reset_password_code = None
         user.reset_password_code_expires = None
+        user.reset_password_code_attempts = 0
 
 
 def request_user_verification(db: db_dependency, user: user_dependency, background_tasks: BackgroundTasks) -> None:
@@ -113,9 +170,8 @@ def request_user_verification(db: db_dependency, user: user_dependency, backgrou
 
 
 def verify_user(db: db_dependency, user: user_dependency, code: str) -> User:
-    verify_code(user, code, CodeType.VERIFICATION)
+    verify_code(db, user, code, CodeType.VERIFICATION)
     db.commit()
-    db.refresh(user)
     return user
 
 
@@ -124,22 +180,140 @@ def request_password_reset(db: db_dependency, user: user_dependency, background_
     
 
 def reset_password(db: db_dependency, user: user_dependency, code: str, new_password: str) -> User:
-    verify_code(user, code, CodeType.RESET_PASSWORD)
+    verify_code(db, user, code, CodeType.RESET_PASSWORD)
 
     # Setting new password:
     user.password = bcrypt_context.hash(new_password)
     db.commit()
-    db.refresh(user)
     return user
 
 
 def update_user(db: db_dependency, user: user_dependency, name: str) -> User:
     user.name = name.title()
     db.commit()
-    db.refresh(user)
     return user
 
 
-def delete_user(db: db_dependency, user: user_dependency) -> None:
-    db.delete(user)
+# Set when an account is queued for deletion, to wake the deletion worker:
+_deletions_requested = asyncio.Event()
+
+
+def _delete_account_rows(db: db_dependency, user_id: int) -> None:
+    # Deleting everything left of an account once its conversations are gone, with one DELETE per table:
+    for model in (SearchDocument, TokenUsage, UserPreferenceFeatures):
+        db.execute(delete(model).where(model.user_id == user_id))
+    db.execute(delete(User).where(User.id == user_id))
+
+
+def _forget_user(user_id: int) -> None:
+    # Dropping what is held in memory for the user, so that it is not written back for a user that no longer exists:
+    aggregator.discard_user(user_id)
+    notify_documents_changed(user_id, removed=True)
+
+
+def delete_user(db: db_dependency, user: user_dependency) -> bool:
+    # Returns whether the account was deleted, or was queued for the deletion worker because it is large:
+    conversations = db.scalar(select(func.count()).select_from(Conversation).where(Conversation.user_id == user.id))
+
+    if conversations > USER_DELETE_SYNC_LIMIT:
+        # Locking the account out straight away, and removing its data in bounded batches outside the request:
+        db.execute(update(User).where(User.id == user.id).values(deletion_requested_at=datetime.now(UTC)))
+        db.commit()
+        _deletions_requested.set()
+        return False
+
+    delete_conversation_rows(db, select(Conversation.id).where(Conversation.user_id == user.id))
+    _delete_account_rows(db, user.id)
     db.commit()
+    _forget_user(user.id)
+    return True
+
+
+def _delete_next_batch() -> Optional[bool]:
+    # Deleting one batch of conversations from the oldest queued account, and the account itself once none are left.
+    # Every worker process runs this, so the account is claimed by locking its row for the transaction, and accounts
+    # that another worker is deleting are skipped rather than waited for.
+    # Returns None when no account is left to claim, otherwise whether an account was finished:
+    db = SessionLocal()
+    try:
+        user_id = db.scalar(
+            select(User.id)
+            .where(User.deletion_requested_at.is_not(None))
+            .order_by(User.deletion_requested_at)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        )
+        if user_id is None: return None
+
+        batch = db.scalars(
+            select(Conversation.id).where(Conversation.user_id == user_id).limit(USER_DELETE_BATCH_SIZE)
+        ).all()
+        if batch:
+            delete_conversation_rows(db, batch)
+        else:
+            _delete_account_rows(db, user_id)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+    if batch: return False
+    _forget_user(user_id)
+    logger.info("Deleted queued account %d.", user_id)
+    return True
+
+
+async def run_user_deletion_worker() -> None:
+    while True:
+        _deletions_requested.clear()
+        try:
+            # Yielding to the event loop between batches, each of which is its own short transaction:
+            while await run_in_threadpool(_delete_next_batch) is not None:
+                pass
+        except Exception:
+            logger.exception("Deleting queued accounts failed.")
+
+        # Waking up when a deletion is queued, and periodically to retry failures and resume after restarts:
+        try:
+            await asyncio.wait_for(_deletions_requested.wait(), USER_DELETE_RETRY_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+
+def sweep_expired_codes(db: db_dependency) -> int:
+    # Clearing expired codes, so that they do not linger in the users table:
+    now_utc = datetime.now(UTC)
+    cleared = 0
+    for code, expires, attempts in CODE_COLUMNS.values():
+        result = db.execute(
+            update(User)
+            .where(expires < now_utc)
+            .values({code: None, expires: None, attempts: 0})
+            .execution_options(synchronize_session=False)
+        )
+        cleared += result.rowcount
+    db.commit()
+    return cleared
+
+
+def _sweep_expired_codes() -> int:
+    db = SessionLocal()
+    try:
+        return sweep_expired_codes(db)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+async def run_code_sweeper_periodically() -> None:
+    while True:
+        try:
+            cleared = await run_in_threadpool(_sweep_expired_codes)
+            if cleared: logger.info("Cleared %d expired one-time codes.", cleared)
+        except Exception:
+            logger.exception("Sweeping expired one-time codes failed.")
+        await asyncio.sleep(CODE_SWEEP_INTERVAL_SECONDS)
@@ -0,0 +1,80 @@
+import os
+import zlib
+from typing import Any, Dict, List
+
+import orjson
+
+
+# Codec for new transcript writes: "none" keeps plain JSON, "zlib" or "zstd" store a compressed columnar blob:
+TRANSCRIPT_COMPRESSION = os.getenv("TRANSCRIPT_COMPRESSION", "none").lower()
+ZSTD_LEVEL = int(os.getenv("TRANSCRIPT_ZSTD_LEVEL", 9))
+ZLIB_LEVEL = int(os.getenv("TRANSCRIPT_ZLIB_LEVEL", 6))
+
+# Every blob starts with a codec tag, so that blobs written with different settings can always be decoded:
+_ZSTD_TAG = b"TZ1"
+_ZLIB_TAG = b"TD1"
+
+# Keys stored once per transcript as columns, rather than once per segment:
+COLUMNS = ("id", "text", "speaker", "translations", "timestamp")
+
+
+def compression_enabled() -> bool:
+    return TRANSCRIPT_COMPRESSION in ("zlib", "zstd")
+
+
+def _to_columns(segments: List[Dict[str, Any]]) -> dict:
+    columns = {name: [segment.get(name) for segment in segments] for name in COLUMNS}
+
+    # Recording which segments lack a column key, so they decode without it (rather than with a null):
+    missing = {
+        name: [index for index, segment in enumerate(segments) if name not in segment]
+        for name in COLUMNS
+    }
+    # Keeping any non-standard keys per segment:
+    extra = {
+        str(index): {key: value for key, value in segment.items() if key not in COLUMNS}
+        for index, segment in enumerate(segments) if segment.keys() - set(COLUMNS)
+    }
+
+    layout = {"n": len(segments), "columns": columns}
+    missing = {name: indices for name, indices in missing.items() if indices}
+    if missing: layout["missing"] = missing
+    if extra: layout["extra"] = extra
+    return layout
+
+
+def _from_columns(layout: dict) -> List[Dict[str, Any]]:
+    columns = layout["columns"]
+    segments = [{name: columns[name][index] for name in COLUMNS} for index in range(layout["n"])]
+
+    for name, indices in layout.get("missing", {}).items():
+        for index in indices:
+            del segments[index][name]
+    for index, values in layout.get("extra", {}).items():
+        segments[int(index)].update(values)
+    return segments
+
+
+def encode_transcript(segments: List[Dict[str, Any]], codec: str = None) -> bytes:
+    payload = orjson.dumps(_to_columns(segments or []))
+    codec = codec or TRANSCRIPT_COMPRESSION
+
+    if codec == "zstd":
+        # Imported lazily, so that zstandard is only needed when the zstd codec is in use:
+        import zstandard
+        return _ZSTD_TAG + zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(payload)
+    return _ZLIB_TAG + zlib.compress(payload, ZLIB_LEVEL)
+
+
+def decode_transcript(blob: bytes) -> List[Dict[str, Any]]:
+    blob = bytes(blob)
+    tag, data = blob[:3], blob[3:]
+
+    if tag == _ZSTD_TAG:
+        import zstandard
+        payload = zstandard.ZstdDecompressor().decompress(data)
+    elif tag == _ZLIB_TAG:
+        payload = zlib.decompress(data)
+    else:
+        raise ValueError("Unknown transcript encoding.")
+    return _from_columns(orjson.loads(payload))